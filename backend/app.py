@@ -1,30 +1,84 @@
 import os
+import time
 from flask import Flask, render_template
 from flask_cors import CORS
-from database import create_tables, insert_initial_data
+from migrations import bootstrap
+from models import JSONProvider
+from plans import plan_scheduler
+from pool import release_connection
+import profiling
+from config import TENANTS, UPLOAD_FOLDER, USE_X_SENDFILE
 from routes import register_routes
+from tenants import TenantMiddleware
 
-app = Flask(__name__, template_folder='../frontend')
-CORS(app)
-app.config['UPLOAD_FOLDER'] = 'uploads/'
-
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
 
+def run_bootstrap(app):
+    """
+    Bring the schema up to date (a single PRAGMA read when it already is)
+    and record how long it took in the app's startup timings, then start
+    the plan scheduler so deadlines fire without waiting for a request.
+    """
+    start = time.perf_counter()
+    applied = bootstrap()
+    plan_scheduler.start()
+    seconds = time.perf_counter() - start
+    app.config['STARTUP_TIMINGS']['bootstrap'] = seconds
+    if applied is None:
+        app.logger.info("schema is current, bootstrap skipped (%.1f ms)", seconds * 1000)
+    else:
+        app.logger.info("bootstrap applied %d migrations in %.1f ms", len(applied), seconds * 1000)
+    return applied
 
-register_routes(app)
 
-@app.route('/')
-def index():
+def create_app(bootstrap=False):
     """
-    Renders the index.html template.
-
-    Returns:
-        The rendered index.html template.
+    Build the Flask app. Multi-worker servers can run the factory in every
+    worker with bootstrap=True, e.g. gunicorn 'app:create_app(bootstrap=True)':
+    only the first worker to take the bootstrap lock runs DDL.
     """
-    return render_template('index.html')
+    start = time.perf_counter()
+    app = Flask(__name__, template_folder='../frontend')
+    # Typed rows and orjson serialization for jsonify() (see models.py)
+    app.json_provider_class = JSONProvider
+    app.json = JSONProvider(app)
+    CORS(app)
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+    app.config['STARTUP_TIMINGS'] = {}
+
+    if not os.path.exists(app.config['UPLOAD_FOLDER']):
+        os.makedirs(app.config['UPLOAD_FOLDER'])
+
+    register_routes(app)
+
+    # Run each request against the database of the library it names
+    if TENANTS:
+        app.wsgi_app = TenantMiddleware(app.wsgi_app)
+
+    # Per-route timings, query stats and the optional Server-Timing header
+    profiling.init_app(app)
+
+    # Return any connection a handler left checked out to the pool
+    app.teardown_appcontext(release_connection)
+
+    @app.route('/')
+    def index():
+        """
+        Renders the index.html template.
+
+        Returns:
+            The rendered index.html template.
+        """
+        return render_template('index.html')
+
+    app.config['STARTUP_TIMINGS']['create_app'] = time.perf_counter() - start
+    if bootstrap:
+        run_bootstrap(app)
+    return app
+
+
+app = create_app()
 
 if __name__ == '__main__':
-    create_tables()
-    insert_initial_data()
+    run_bootstrap(app)
     app.run(debug=True)
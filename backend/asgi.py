@@ -0,0 +1,315 @@
+"""
+ASGI entry point for production serving.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+Every blueprint still runs as the Flask (WSGI) app, bridged with a2wsgi onto
+a bounded pool of ASGI_WSGI_THREADS threads, so at most that many requests
+touch SQLite at once and idle keep-alive connections cost no thread at all.
+PDF and thumbnail downloads are served natively here instead: the file is
+read in chunks on a separate I/O executor and each chunk is awaited out to
+the client, so a slow reader holds no worker thread between chunks. The
+/changes/stream feed is served natively too, so long-lived event streams
+do not use up the thread pool. Both bind the library the request names
+(see tenants.py) the way TenantMiddleware does for Flask.
+"""
+import asyncio
+import contextvars
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from a2wsgi import WSGIMiddleware
+from urllib.parse import parse_qs
+from config import (ASGI_WSGI_THREADS, ASGI_FILE_THREADS, UPLOAD_CHUNK_SIZE, CHANGE_FEED_KEEPALIVE,
+                    TENANTS, TENANT_HEADER)
+from app import app as flask_app, run_bootstrap
+from changefeed import change_feed, next_events, parse_feed_args
+from pdf_jobs import pdf_pipeline
+from pdf_store import blob_store, file_etag
+from plans import plan_scheduler
+from pool import get_connection, pool, use_pool
+from similar import similar_index
+from tenants import UnknownLibrary, tenant_name, tenant_router
+from write_behind import write_behind
+
+_file_executor = ThreadPoolExecutor(max_workers=ASGI_FILE_THREADS, thread_name_prefix='asgi-file')
+_db_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix='asgi-db')
+
+_FILE_ROUTES = [
+    (re.compile(r'^/view_pdf/(\d+)$'), "SELECT pdf_path FROM Book WHERE id = ?", 'application/pdf', "PDF not found"),
+    (re.compile(r'^/thumbnail/(\d+)$'), "SELECT thumbnail_path FROM PdfInfo WHERE book_id = ?", 'image/png', "縮圖不存在")
+]
+
+
+def _run_db(fn, *args):
+    """
+    Run `fn` on the database executor with the request's library bound.
+    """
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(_db_executor, context.run, fn, *args)
+
+
+def _lookup_path(sql, row_id):
+    conn = get_connection()
+    try:
+        row = conn.execute(sql, (row_id,)).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def _parse_range(value, size):
+    """
+    Parse a single `bytes=` range. Returns (start, end) inclusive, None to
+    serve the whole file, or False if the range cannot be satisfied.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', value.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+async def _send_json(send, status, body):
+    data = body.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(data)).encode()),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def serve_file(scope, send, path, mimetype):
+    """
+    Send a file with conditional GET and single-range support.
+    """
+    loop = asyncio.get_running_loop()
+    # Open before any header goes out: a file removed after this point is
+    # still read through the fd, so FileNotFoundError can only come from here
+    fd = await loop.run_in_executor(_file_executor, os.open, path, os.O_RDONLY)
+    try:
+        await _send_fd(scope, send, loop, fd, mimetype)
+    finally:
+        os.close(fd)
+
+
+async def _send_fd(scope, send, loop, fd, mimetype):
+    stat = await loop.run_in_executor(_file_executor, os.fstat, fd)
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    etag = f'"{file_etag(stat)}"'
+    mtime = int(stat.st_mtime)
+    base_headers = [
+        (b'etag', etag.encode()),
+        (b'last-modified', formatdate(mtime, usegmt=True).encode()),
+        (b'accept-ranges', b'bytes'),
+        (b'cache-control', b'no-cache'),
+        (b'access-control-allow-origin', b'*')
+    ]
+
+    if_none_match = headers.get('if-none-match')
+    not_modified = False
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]
+    elif 'if-modified-since' in headers:
+        try:
+            not_modified = mtime <= parsedate_to_datetime(headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            pass
+    if not_modified:
+        await send({'type': 'http.response.start', 'status': 304, 'headers': base_headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    size = stat.st_size
+    byte_range = None
+    if 'range' in headers:
+        if_range = headers.get('if-range')
+        if if_range is None or if_range.strip() == etag:
+            byte_range = _parse_range(headers['range'], size)
+    if byte_range is False:
+        await send({'type': 'http.response.start', 'status': 416,
+                    'headers': base_headers + [(b'content-range', f'bytes */{size}'.encode())]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    if byte_range is None:
+        status, start, end = 200, 0, size - 1
+        extra = []
+    else:
+        status, (start, end) = 206, byte_range
+        extra = [(b'content-range', f'bytes {start}-{end}/{size}'.encode())]
+    length = end - start + 1 if size else 0
+    await send({'type': 'http.response.start', 'status': status, 'headers': base_headers + extra + [
+        (b'content-type', mimetype.encode()),
+        (b'content-length', str(length).encode())
+    ]})
+    if scope['method'] == 'HEAD' or length == 0:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    offset = start
+    while offset <= end:
+        chunk = await loop.run_in_executor(
+            _file_executor, os.pread, fd, min(UPLOAD_CHUNK_SIZE, end - offset + 1), offset)
+        if not chunk:
+            break
+        offset += len(chunk)
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset <= end})
+
+
+async def change_stream(scope, receive, send):
+    """
+    The /changes/stream feed without a worker thread per client: the stream
+    sleeps on the event loop and only each read of new changes runs on the
+    database executor.
+    """
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    try:
+        since, tables = parse_feed_args(query.get('since', [None])[0], headers.get('last-event-id'),
+                                        query.get('tables', [None])[0])
+    except ValueError:
+        return await _send_json(send, 400, '{"message": "無效的變更參數！"}')
+    if since is None:
+        since = await _run_db(change_feed.position)
+    else:
+        # A resumed stream (every browser reconnect sends Last-Event-ID) must
+        # start the poller too, or change_feed.latest never moves
+        await _run_db(change_feed.start)
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    position = since
+    try:
+        with change_feed.subscription():
+            await send({'type': 'http.response.body', 'body': f"retry: 2000\nid: {position}\n\n".encode(), 'more_body': True})
+            idle = 0.0
+            while not disconnected.is_set():
+                text, position = await _run_db(next_events, position, tables)
+                if text:
+                    await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+                    idle = 0.0
+                    continue
+                while change_feed.latest <= position and not disconnected.is_set() and idle < CHANGE_FEED_KEEPALIVE:
+                    await asyncio.sleep(change_feed.interval)
+                    idle += change_feed.interval
+                if idle >= CHANGE_FEED_KEEPALIVE:
+                    await send({'type': 'http.response.body', 'body': b": keep-alive\n\n", 'more_body': True})
+                    idle = 0.0
+    except OSError:
+        pass
+    finally:
+        watcher.cancel()
+    if not disconnected.is_set():
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+class LibraryASGI:
+    """
+    Routes file downloads to serve_file, the change feed to change_stream
+    and everything else to Flask.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=ASGI_WSGI_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.native_route(scope, receive, send) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+        if not TENANTS:
+            return await handler()
+        headers = dict(scope['headers'])
+        try:
+            name = tenant_name(headers.get(TENANT_HEADER.lower().encode(), b'').decode('latin-1'),
+                               headers.get(b'host', b'').decode('latin-1'))
+        except ValueError:
+            return await _send_json(send, 400, '{"message": "無效的圖書館名稱！"}')
+        try:
+            conn_pool = await asyncio.get_running_loop().run_in_executor(_db_executor, tenant_router.pool, name)
+        except UnknownLibrary:
+            return await _send_json(send, 404, '{"message": "圖書館不存在！"}')
+        with use_pool(conn_pool):
+            return await handler()
+
+    def native_route(self, scope, receive, send):
+        """
+        The handler for a request served here instead of by Flask, or None.
+        """
+        if scope['method'] == 'GET' and scope['path'] == '/changes/stream':
+            return lambda: change_stream(scope, receive, send)
+        if scope['method'] in ('GET', 'HEAD'):
+            for pattern, sql, mimetype, missing in _FILE_ROUTES:
+                match = pattern.match(scope['path'])
+                if match:
+                    return lambda: self.file_route(scope, send, sql, int(match.group(1)), mimetype, missing)
+        return None
+
+    async def file_route(self, scope, send, sql, row_id, mimetype, missing):
+        path = await _run_db(_lookup_path, sql, row_id)
+        if not path:
+            return await _send_json(send, 404, f'{{"message": "{missing}"}}')
+        try:
+            await serve_file(scope, send, path, mimetype)
+        except FileNotFoundError:
+            await _send_json(send, 404, f'{{"message": "{missing}"}}')
+
+    async def lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await loop.run_in_executor(_db_executor, self._bootstrap)
+                pdf_pipeline.start()
+                blob_store.start()
+                similar_index.start()
+                plan_scheduler.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                pdf_pipeline.stop()
+                await loop.run_in_executor(_db_executor, blob_store.stop)
+                await loop.run_in_executor(_db_executor, similar_index.stop)
+                await loop.run_in_executor(_db_executor, plan_scheduler.stop)
+                await loop.run_in_executor(_db_executor, write_behind.stop)
+                await loop.run_in_executor(_db_executor, tenant_router.stop)
+                pool.close_all()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _bootstrap():
+        run_bootstrap(flask_app)
+        pool.release_thread()
+
+
+app = LibraryASGI(flask_app)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.environ.get('HOST', '127.0.0.1'), port=int(os.environ.get('PORT', 8000)))
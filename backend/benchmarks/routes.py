@@ -0,0 +1,295 @@
+"""
+Load test for every route in the app.
+
+Builds a synthetic library (see synthetic.py), then drives each route
+through Flask's test client and/or a real threaded HTTP server with
+concurrent keep-alive clients. Reports p50/p95/p99 latency, throughput and
+peak RSS per route as JSON, so runs can be compared between versions.
+
+    python3 -m benchmarks.routes --books 10000 --requests 200 --concurrency 8 --out results.json
+
+--url points the server mode at an already running instance (for example
+`uvicorn asgi:app`) instead of starting one; that server must use the same
+database, so pass --db with the file it serves.
+"""
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+_PDF = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+        b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+        b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+        b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+
+class Scenario:
+    """
+    One route to exercise. `build(i, ctx)` returns (path, json_body, raw_body,
+    content_type) for the i-th request.
+    """
+
+    def __init__(self, name, method, build, limit=None):
+        self.name = name
+        self.method = method
+        self.build = build
+        self.limit = limit
+
+
+def _scenarios(ctx):
+    books = ctx['books']
+    rng = random.Random(1)
+
+    def book_id(i):
+        return rng.randint(1, books)
+
+    # Deletes consume ids from a range reserved for them at the top of the table
+    doomed = itertools.count(ctx['doomed_start'])
+
+    return [
+        Scenario('check_book', 'POST', lambda i, c: ('/check_book', {"book_title": "紅樓 夢"}, None, None)),
+        Scenario('add_book', 'POST', lambda i, c: ('/add_book', {
+            "book_title": "Benchmark Book", "ISBN": 9789999999999, "author": "Author 1", "price": 100,
+            "category": "科學", "edition": 1, "current_page": 0}, None, None)),
+        Scenario('update_page', 'PUT', lambda i, c: ('/update_page', {"book_id": book_id(i), "current_page": i % 400}, None, None)),
+        Scenario('upload_pdf', 'POST', lambda i, c: (f'/upload_pdf?book_id={book_id(i)}', None, _PDF, 'application/pdf'), limit=50),
+        Scenario('view_pdf', 'GET', lambda i, c: (f'/view_pdf/{c["pdf_book"]}', None, None, None)),
+        Scenario('add_history', 'POST', lambda i, c: ('/add_history', {"book_id": str(book_id(i)), "bookpage": "12", "note": "bench"}, None, None)),
+        Scenario('delete_history', 'DELETE', lambda i, c: (f'/delete_history/{i + 1}', None, None, None)),
+        Scenario('add_plan', 'POST', lambda i, c: ('/add_plan', {"book_id": book_id(i), "expired_date": "2030-01-01"}, None, None)),
+        Scenario('delete_plan', 'DELETE', lambda i, c: (f'/delete_plan/{i + 1}', None, None, None)),
+        Scenario('plans_due', 'GET', lambda i, c: ('/plans/due?within=30&limit=100', None, None, None)),
+        Scenario('view_notes', 'GET', lambda i, c: (f'/notes/{book_id(i)}', None, None, None)),
+        Scenario('note_list', 'GET', lambda i, c: (f'/notes/{book_id(i)}/list?limit=20', None, None, None)),
+        Scenario('get_note', 'GET', lambda i, c: (f'/note/{i + 1}', None, None, None)),
+        Scenario('add_note', 'POST', lambda i, c: ('/add_note', {"book_id": book_id(i), "title": "bench", "content": "benchmark note"}, None, None)),
+        Scenario('update_note', 'PUT', lambda i, c: ('/update_note', {"id": i + 1, "title": "bench", "content": "updated"}, None, None)),
+        Scenario('delete_note', 'DELETE', lambda i, c: (f'/delete_note/{i + 1}', None, None, None)),
+        Scenario('view_favorites_page', 'GET', lambda i, c: ('/view_data/favorites?limit=100', None, None, None)),
+        Scenario('add_favorite', 'POST', lambda i, c: ('/add_favorite', {"book_id": book_id(i)}, None, None)),
+        Scenario('delete_favorite', 'DELETE', lambda i, c: (f'/delete_favorite/{book_id(i)}', None, None, None)),
+        Scenario('search_by_category', 'GET', lambda i, c: (f'/search_by_category?category={quote("哲學")}', None, None, None), limit=20),
+        Scenario('book_detail', 'GET', lambda i, c: (f'/books/{book_id(i)}/detail', None, None, None)),
+        Scenario('book_detail_shelf', 'GET', lambda i, c: (
+            '/books/detail?ids=' + ','.join(str(book_id(i)) for _ in range(50)), None, None, None)),
+        Scenario('similar_books', 'GET', lambda i, c: (f'/books/{book_id(i)}/similar', None, None, None)),
+        Scenario('search_book', 'GET', lambda i, c: (f'/search_book/{book_id(i)}', None, None, None)),
+        Scenario('search_id_by_book_title', 'GET', lambda i, c: (f'/search_id_by_book_title/{quote("紅樓 夢")}', None, None, None)),
+        Scenario('search', 'GET', lambda i, c: (f'/search?q={quote(rng.choice(["紅樓", "Kafka", "Garden", "理性"]))}', None, None, None)),
+        Scenario('search_by_name', 'GET', lambda i, c: (f'/search_by_name?name={quote("Walden")}', None, None, None), limit=20),
+        Scenario('view_books_page', 'GET', lambda i, c: (f'/view_data/books?limit=100&after={book_id(i)}', None, None, None)),
+        Scenario('view_history_page', 'GET', lambda i, c: (f'/view_data/history?limit=100&after={i * 100}', None, None, None)),
+        Scenario('view_plan_page', 'GET', lambda i, c: ('/view_data/plan?limit=100', None, None, None)),
+        Scenario('view_books_full', 'GET', lambda i, c: ('/view_data/books', None, None, None), limit=5),
+        Scenario('add_author', 'POST', lambda i, c: ('/add_author', {
+            "author_name": f"Bench Author {c['run']}-{i}", "introduction": "x", "nationality": "UK", "Birth_year": 1900}, None, None)),
+        Scenario('get_author', 'GET', lambda i, c: (f'/get_author/{quote("Author 1")}', None, None, None)),
+        Scenario('update_author', 'PUT', lambda i, c: ('/update_author', {
+            "author_id": 1, "author_name": "Author 1", "introduction": f"rev {i}", "nationality": "UK", "Birth_year": 1900}, None, None)),
+        Scenario('bulk_books', 'POST', lambda i, c: ('/bulk/books?format=jsonl', None, ''.join(
+            json.dumps({"book_title": f"Bulk {i}-{n}", "author": "Author 2", "price": 1, "category": "科學", "edition": 1})
+            + '\n' for n in range(100)).encode(), 'application/x-ndjson'), limit=20),
+        Scenario('pdf_job', 'GET', lambda i, c: (f'/pdf_jobs/book/{c["pdf_book"]}', None, None, None)),
+        Scenario('batch', 'POST', lambda i, c: ('/batch', {"ops": [
+            {"method": "POST", "path": "/add_history", "body": {"book_id": str(book_id(i)), "bookpage": "5", "note": "batch"}},
+            {"method": "PUT", "path": "/update_page", "body": {"book_id": book_id(i), "current_page": i % 400}},
+            {"method": "POST", "path": "/add_note", "body": {"book_id": book_id(i), "title": "batch", "content": "batched note"}}]}, None, None)),
+        Scenario('stats_daily', 'GET', lambda i, c: (f'/stats/daily?dim=book&key={book_id(i)}', None, None, None)),
+        Scenario('stats_totals', 'GET', lambda i, c: ('/stats/totals?dim=category', None, None, None)),
+        Scenario('stats_streak', 'GET', lambda i, c: ('/stats/streak', None, None, None)),
+        # delete_plan consumes the lowest plan ids, so read from the top
+        Scenario('stats_plan', 'GET', lambda i, c: (f'/stats/plan/{c["plans"] - i % max(c["plans"] // 2, 1)}', None, None, None)),
+        Scenario('changes', 'GET', lambda i, c: (f'/changes?since={c["change_seq"]}', None, None, None)),
+        Scenario('thumbnail', 'GET', lambda i, c: (f'/thumbnail/{c["pdf_book"]}', None, None, None)),
+        Scenario('metrics_pool', 'GET', lambda i, c: ('/metrics/pool', None, None, None)),
+        Scenario('metrics_cache', 'GET', lambda i, c: ('/metrics/cache', None, None, None)),
+        Scenario('delete_book', 'DELETE', lambda i, c: (f'/delete_book/{next(doomed)}', None, None, None))
+    ]
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _summarize(name, mode, timings, statuses, elapsed):
+    timings = sorted(timings)
+    ms = [t * 1000 for t in timings]
+    return {
+        "route": name,
+        "mode": mode,
+        "requests": len(timings),
+        "errors": sum(1 for s in statuses if s >= 500),
+        "status_codes": {str(s): statuses.count(s) for s in sorted(set(statuses))},
+        "p50_ms": _percentile(ms, 0.50),
+        "p95_ms": _percentile(ms, 0.95),
+        "p99_ms": _percentile(ms, 0.99),
+        "throughput_rps": len(timings) / elapsed if elapsed > 0 else None,
+        "peak_rss_kb": _peak_rss_kb()
+    }
+
+
+def _peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB on Linux
+    return rss // 1024 if platform.system() == 'Darwin' else rss
+
+
+def run_test_client(app, scenario, ctx, requests):
+    client = app.test_client()
+    timings, statuses = [], []
+    start = time.perf_counter()
+    for i in range(requests):
+        path, body, raw, content_type = scenario.build(i, ctx)
+        t0 = time.perf_counter()
+        response = client.open(path, method=scenario.method, json=body, data=raw, content_type=content_type)
+        response.get_data()
+        timings.append(time.perf_counter() - t0)
+        statuses.append(response.status_code)
+    return _summarize(scenario.name, 'test_client', timings, statuses, time.perf_counter() - start)
+
+
+def run_server(base_url, scenario, ctx, requests, concurrency):
+    parts = urlsplit(base_url)
+    local = threading.local()
+
+    def one(i):
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        path, body, raw, content_type = scenario.build(i, ctx)
+        headers = {}
+        payload = raw
+        if body is not None:
+            payload = json.dumps(body).encode()
+            content_type = 'application/json'
+        if content_type:
+            headers['Content-Type'] = content_type
+        t0 = time.perf_counter()
+        try:
+            conn.request(scenario.method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            local.conn = None
+            status = 599
+        return time.perf_counter() - t0, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    return _summarize(scenario.name, f'server_c{concurrency}', [r[0] for r in results], [r[1] for r in results], elapsed)
+
+
+def _start_server(app):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every route of the library app.")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200, help="requests per route and mode")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=['test_client', 'server', 'both'], default='both')
+    parser.add_argument('--url', help="benchmark this running server instead of starting one")
+    parser.add_argument('--db', help="database file to build (default: a temp file)")
+    parser.add_argument('--routes', nargs='*', help="only run these scenarios")
+    parser.add_argument('--no-cache', action='store_true', help="disable the response cache")
+    parser.add_argument('--out', help="write JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_routes_')
+    db_path = os.path.abspath(args.db or os.path.join(workdir, 'library.db'))
+    os.chdir(workdir)
+
+    from benchmarks.synthetic import build_database
+    t0 = time.perf_counter()
+    counts = build_database(db_path, args.books)
+    build_seconds = time.perf_counter() - t0
+    print(f"built {counts} in {build_seconds:.1f}s", file=sys.stderr)
+
+    from app import app
+    from cache import response_cache
+    if args.no_cache:
+        response_cache.max_entries = 0
+
+    # Reserve the highest book ids for delete_book and give one book a PDF
+    ctx = {'books': args.books - args.requests * 2, 'doomed_start': args.books - args.requests * 2 + 1,
+           'pdf_book': 1, 'plans': counts['ReadingPlan'], 'run': int(time.time())}
+    app.test_client().post(f'/upload_pdf?book_id={ctx["pdf_book"]}', data=_PDF, content_type='application/pdf')
+    # Read the feed from a recent position, as a connected client would
+    ctx['change_seq'] = max(app.test_client().get('/changes').get_json()['last_seq'] - 500, 0)
+
+    scenarios = _scenarios(ctx)
+    if args.routes:
+        scenarios = [s for s in scenarios if s.name in args.routes]
+
+    server = None
+    base_url = args.url
+    if args.mode in ('server', 'both') and base_url is None:
+        server, base_url = _start_server(app)
+
+    results = []
+    # Some routes print progress messages; keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        for scenario in scenarios:
+            requests = min(args.requests, scenario.limit or args.requests)
+            if args.mode in ('test_client', 'both'):
+                results.append(run_test_client(app, scenario, ctx, requests))
+                print(json.dumps(results[-1], ensure_ascii=False))
+            if args.mode in ('server', 'both'):
+                if scenario.name == 'delete_book':
+                    ctx['doomed_start'] += requests
+                    scenario = _scenarios(ctx)[-1]
+                ctx['run'] += 1
+                results.append(run_server(base_url, scenario, ctx, requests, args.concurrency))
+                print(json.dumps(results[-1], ensure_ascii=False))
+
+    if server is not None:
+        server.shutdown()
+
+    report = {
+        "benchmark": "routes",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "books": args.books,
+        "rows": counts,
+        "build_seconds": build_seconds,
+        "requests_per_route": args.requests,
+        "concurrency": args.concurrency,
+        "cache": not args.no_cache,
+        "peak_rss_kb": _peak_rss_kb(),
+        "results": results
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
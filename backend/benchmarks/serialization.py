@@ -0,0 +1,91 @@
+"""
+Benchmark: turning query rows into a JSON response body.
+
+Builds a synthetic library (see synthetic.py) and serializes every row of
+--table both ways, --samples times:
+
+- legacy: SELECT *, a dict built per row by position, json.dumps with the
+  Flask defaults (sorted keys, ASCII escapes)
+- models: the model's SELECT, rows built with starmap into slotted
+  dataclasses, models.dumps (orjson when installed)
+
+Reports time per row and the tracemalloc peak of one pass as JSON.
+
+    python3 -m benchmarks.serialization --books 100000 --table Book
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import starmap
+
+
+def _legacy(cursor, model):
+    cursor.execute(f"SELECT * FROM {model.TABLE}")
+    rows = cursor.fetchall()
+    columns = model.COLUMNS
+    items = [{column: row[i] for i, column in enumerate(columns)} for row in rows]
+    return json.dumps(items, sort_keys=True, ensure_ascii=True).encode('utf-8'), len(items)
+
+
+def _models(cursor, model):
+    from models import dumps
+    cursor.execute(model.SELECT)
+    items = list(starmap(model, cursor.fetchall()))
+    return dumps(items), len(items)
+
+
+def _measure(fn, cursor, model, samples):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        body, rows = fn(cursor, model)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(cursor, model)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "rows": rows,
+        "bytes": len(body),
+        "per_row_us": statistics.median(timings) / rows * 1e6,
+        "peak_mb": peak / 2**20
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--table', default='Book')
+    parser.add_argument('--samples', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_serialization_')
+    from benchmarks.synthetic import build_database
+    build_database(os.path.join(workdir, 'library.db'), args.books)
+    import models
+    from pool import get_connection
+
+    model = models.MODELS[args.table]
+    conn = get_connection()
+    cursor = conn.cursor()
+    results = {"benchmark": "serialization", "table": args.table,
+               "orjson": models.orjson is not None}
+    for name, fn in (('legacy', _legacy), ('models', _models)):
+        results[name] = _measure(fn, cursor, model, args.samples)
+        print(json.dumps({name: results[name]}), file=sys.stderr)
+    results["speedup"] = results['legacy']['per_row_us'] / results['models']['per_row_us']
+
+    conn.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark: process startup time until the app can answer its first request.
+
+Each sample is a fresh interpreter that imports the app, runs the startup
+bootstrap and serves one GET through the test client. Variants cover eager
+vs lazy blueprint registration (LIBRARY_LAZY_ROUTES), a database whose
+schema is already current vs a brand-new file, and the old startup path
+that re-ran every CREATE ... IF NOT EXISTS plus the seed-data counts on
+each launch.
+
+Run from the backend directory:
+
+    python3 -m benchmarks.startup --samples 20
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CHILD = '''
+import json, time
+start = time.perf_counter()
+import app as app_module
+imported = time.perf_counter()
+if {legacy}:
+    from database import create_tables, insert_initial_data
+    create_tables()
+    insert_initial_data()
+else:
+    app_module.run_bootstrap(app_module.app)
+ready = time.perf_counter()
+response = app_module.app.test_client().get({path!r})
+done = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({{"import": imported - start, "bootstrap": ready - imported, "first_request": done - ready}}))
+'''
+
+VARIANTS = [
+    # (name, lazy routes, fresh database, legacy bootstrap)
+    ('legacy_eager_current', False, False, True),
+    ('eager_current', False, False, False),
+    ('lazy_current', True, False, False),
+    ('eager_fresh', False, True, False),
+    ('lazy_fresh', True, True, False),
+]
+
+
+def _ms(values):
+    values = sorted(values)
+    return {"p50_ms": values[len(values) // 2] * 1000, "mean_ms": statistics.mean(values) * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--samples', type=int, default=20)
+    parser.add_argument('--path', default='/view_data/books', help="first request to serve")
+    parser.add_argument('--variants', nargs='*', help="only run these variants")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    current_db = os.path.join(workdir, 'current.db')
+    env = dict(os.environ, LIBRARY_DATABASE=current_db)
+    subprocess.run([sys.executable, '-c', 'from migrations import bootstrap; bootstrap()'], env=env, check=True)
+
+    results = []
+    for name, lazy, fresh, legacy in VARIANTS:
+        if args.variants and name not in args.variants:
+            continue
+        env = dict(os.environ, LIBRARY_LAZY_ROUTES='1' if lazy else '0', LIBRARY_DATABASE=current_db)
+        code = CHILD.format(legacy=legacy, path=args.path)
+        samples = []
+        for i in range(args.samples):
+            if fresh:
+                env['LIBRARY_DATABASE'] = os.path.join(workdir, f'{name}_{i}.db')
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True)
+            sample = json.loads(out.stdout.strip().splitlines()[-1])
+            sample['process'] = time.perf_counter() - start
+            samples.append(sample)
+        results.append({"variant": name, **{key: _ms([s[key] for s in samples])
+                                            for key in ('process', 'import', 'bootstrap', 'first_request')}})
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    json.dump({"benchmark": "startup", "samples": args.samples, "results": results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
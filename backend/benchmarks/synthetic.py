@@ -0,0 +1,140 @@
+"""
+Synthetic library generator for benchmarks.
+
+Row shapes follow the seed data in database.insert_initial_data; the number
+of books sets the scale and every other table is sized relative to it.
+
+    python3 -m benchmarks.synthetic --books 100000 --db /tmp/bench.db
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+CATEGORIES = ["文學", "科學", "歷史", "哲學", "社會學", "西洋文學", "中國文學", "科幻", "奇幻"]
+NATIONALITIES = ["USA", "UK", "Germany", "China", "India", "Colombia", "Spain", "Czech Republic"]
+TITLE_WORDS = ["麥田", "捕手", "生物", "資訊", "理性", "批判", "資本", "傲慢", "偏見", "紅樓", "夢",
+               "前程", "物種", "起源", "孤寂", "變形", "三體", "冰與火", "Pride", "Catcher", "Origin",
+               "Kafka", "Walden", "Quixote", "Dream", "Empire", "Garden", "River"]
+
+# Rows per book for the dependent tables
+HISTORY_PER_BOOK = 3
+NOTES_PER_BOOK = 1
+PLAN_RATIO = 0.25
+FAVORITE_RATIO = 0.1
+BOOKS_PER_AUTHOR = 50
+
+_BATCH = 20000
+
+
+def _batches(rows, size=_BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(conn, books, seed=0):
+    """
+    Fill an empty, already-created database with `books` books and matching
+    authors, history, notes, plans and favorites. Returns row counts.
+    """
+    from note_bodies import note_values
+    rng = random.Random(seed)
+    cursor = conn.cursor()
+    authors = max(1, books // BOOKS_PER_AUTHOR)
+    today = date.today()
+
+    def author_rows():
+        for i in range(1, authors + 1):
+            yield (f"Author {i}", f"Author {i} is a synthetic writer used for benchmarking.",
+                   rng.choice(NATIONALITIES), rng.randint(1500, 2000))
+
+    def book_rows():
+        for i in range(1, books + 1):
+            author_id = rng.randint(1, authors)
+            title = ' '.join(rng.sample(TITLE_WORDS, 2))
+            yield (9780000000000 + i, title, f"Author {author_id}", rng.randint(100, 900),
+                   rng.choice(CATEGORIES), rng.randint(1, 3), rng.randint(0, 500), author_id)
+
+    def history_rows():
+        for _ in range(books * HISTORY_PER_BOOK):
+            day = today - timedelta(days=rng.randint(0, 730))
+            yield (day.isoformat(), rng.randint(1, books), rng.randint(1, 500), "synthetic reading session")
+
+    def note_rows():
+        for _ in range(books * NOTES_PER_BOOK):
+            stamp = (today - timedelta(days=rng.randint(0, 730))).isoformat() + 'T12:00:00'
+            yield (rng.randint(1, books), f"Note on page {rng.randint(1, 500)}",
+                   *note_values(' '.join(rng.choices(TITLE_WORDS, k=40))), stamp, stamp)
+
+    def plan_rows():
+        for book_id in rng.sample(range(1, books + 1), int(books * PLAN_RATIO)):
+            due = today + timedelta(days=rng.randint(-60, 180))
+            yield (book_id, due.isoformat(), rng.randint(0, 1))
+
+    def favorite_rows():
+        for book_id in rng.sample(range(1, books + 1), int(books * FAVORITE_RATIO)):
+            yield (book_id, None)
+
+    tables = [
+        ('Author', "INSERT INTO Author (author_name, introduction, nationality, birth_year) VALUES (?, ?, ?, ?)", author_rows),
+        ('Book', "INSERT INTO Book (ISBN, book_title, author, price, category, edition, current_page, author_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", book_rows),
+        ('ReadingHistory', "INSERT INTO ReadingHistory (time_stamp, book_id, bookpage, note) VALUES (?, ?, ?, ?)", history_rows),
+        ('Note', "INSERT INTO Note (book_id, title, body, snippet, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)", note_rows),
+        ('ReadingPlan', "INSERT INTO ReadingPlan (book_id, expired_date, is_complete) VALUES (?, ?, ?)", plan_rows),
+        ('FavoriteList', "INSERT INTO FavoriteList (book_id, book_title) VALUES (?, ?)", favorite_rows)
+    ]
+    counts = {}
+    for table, sql, rows in tables:
+        count = 0
+        for batch in _batches(rows()):
+            cursor.executemany(sql, batch)
+            conn.commit()
+            count += len(batch)
+        counts[table] = count
+    cursor.execute("UPDATE FavoriteList SET book_title = (SELECT book_title FROM Book WHERE Book.id = FavoriteList.book_id)")
+    conn.commit()
+    cursor.execute("ANALYZE")
+    return counts
+
+
+def build_database(path, books, seed=0):
+    """
+    Create a fresh database at `path` and fill it. Must run before the app
+    modules are imported, since they read LIBRARY_DATABASE at import time.
+    """
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.environ['LIBRARY_DATABASE'] = path
+    from migrations import migrate
+    from pool import get_connection
+
+    migrate()
+    conn = get_connection()
+    try:
+        return generate(conn, books, seed)
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic library database.")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    counts = build_database(args.db, args.books, args.seed)
+    print(f"{counts} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
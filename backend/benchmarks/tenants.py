@@ -0,0 +1,93 @@
+"""
+Benchmark: concurrent writes to one library versus one library per writer.
+
+Starts --writers threads that each POST --requests notes through Flask's
+test client, first all against the same library and then each against a
+library of its own (see tenants.py), and reports write throughput and
+latency percentiles for both layouts as JSON. Every write is its own
+committed transaction, as in production.
+
+    python3 -m benchmarks.tenants --writers 8 --requests 500
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+def _run(client, headers_for, writers, requests):
+    latencies = [[] for _ in range(writers)]
+    errors = []
+    barrier = threading.Barrier(writers + 1)
+
+    def writer(i):
+        headers = headers_for(i)
+        client.post('/add_book', headers=headers, json={
+            "book_title": f"Benchmark {i}", "ISBN": 9789999999999, "author": "Author 1", "price": 100,
+            "category": "科學", "edition": 1, "current_page": 0})
+        barrier.wait()
+        for n in range(requests):
+            start = time.perf_counter()
+            r = client.post('/add_note', headers=headers, json={"book_id": 1, "title": f"note {n}", "content": "x" * 200})
+            latencies[i].append(time.perf_counter() - start)
+            if r.status_code != 201:
+                errors.append(r.status_code)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    flat = sorted(x for per_writer in latencies for x in per_writer)
+    q = statistics.quantiles(flat, n=100)
+    return {
+        "writes": len(flat),
+        "errors": len(errors),
+        "writes_per_second": len(flat) / elapsed,
+        "p50_ms": q[49] * 1000,
+        "p99_ms": q[98] * 1000
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_tenants_')
+    os.chdir(workdir)
+    os.environ['LIBRARY_TENANTS'] = '1'
+    os.environ['LIBRARY_TENANT_FOLDER'] = os.path.join(workdir, 'libraries')
+    os.environ['LIBRARY_WRITE_BEHIND'] = '0'
+    os.environ['LIBRARY_PROFILE'] = '0'
+    from app import app
+    from tenants import tenant_router
+    client = app.test_client()
+    for library in ['shared'] + [f"library-{i}" for i in range(args.writers)]:
+        tenant_router.create(library)
+
+    results = {"benchmark": "tenants", "writers": args.writers, "requests": args.requests}
+    layouts = (('one_library', lambda i: {"X-Library": "shared"}),
+               ('library_per_writer', lambda i: {"X-Library": f"library-{i}"}))
+    for name, headers_for in layouts:
+        results[name] = _run(client, headers_for, args.writers, args.requests)
+        print(json.dumps({name: results[name]}), file=sys.stderr)
+    results["speedup"] = (results['library_per_writer']['writes_per_second'] /
+                          results['one_library']['writes_per_second'])
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark: cost of adding a duplicate title as the Book table grows.
+
+Builds a throwaway database, fills it up to each size in --sizes, and at each
+size times --samples inserts of a title that already has --duplicates copies.
+With the base_title index the per-insert time should stay flat; the old
+probe loop's query count is reported alongside for comparison.
+
+Run from the backend directory:
+
+    python3 -m benchmarks.title_suffix --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--duplicates', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='bench_titles_')
+    os.environ['LIBRARY_DATABASE'] = os.path.join(workdir, 'library.db')
+    from migrations import migrate
+    from pool import get_connection
+    from titles import next_book_title
+
+    migrate()
+    conn = get_connection()
+    cursor = conn.cursor()
+    insert = "INSERT INTO Book (ISBN, book_title, author, price, category, edition, current_page) VALUES (?, ?, ?, 1, 'bench', 1, 0)"
+
+    cursor.executemany(insert, [(i, 'Hot' if i == 0 else f'Hot({i})', 'bench') for i in range(args.duplicates)])
+    conn.commit()
+    count = args.duplicates
+    results = []
+    for size in sorted(args.sizes):
+        while count < size:
+            batch = min(50000, size - count)
+            cursor.executemany(insert, ((count + i, f'filler {count + i}', 'bench') for i in range(batch)))
+            conn.commit()
+            count += batch
+
+        timings = []
+        for _ in range(args.samples):
+            start = time.perf_counter()
+            cursor.execute("BEGIN IMMEDIATE")
+            title = next_book_title(cursor, 'Hot')
+            cursor.execute(insert, (0, title, 'bench'))
+            conn.commit()
+            timings.append(time.perf_counter() - start)
+        count += args.samples
+
+        cursor.execute("SELECT COUNT(*) FROM Book WHERE base_title = 'Hot'")
+        copies = cursor.fetchone()[0]
+        timings.sort()
+        results.append({
+            "books": count,
+            "existing_copies": copies,
+            "legacy_probe_queries": copies + 1,
+            "insert_mean_us": statistics.mean(timings) * 1e6,
+            "insert_p50_us": timings[len(timings) // 2] * 1e6,
+            "insert_p99_us": timings[int(len(timings) * 0.99) - 1] * 1e6
+        })
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    conn.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    json.dump({"benchmark": "title_suffix", "results": results}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Denormalized per-book summary for the detail endpoints.
+
+BookDetail holds what would otherwise take a count or a scan per book: note
+and history counts, the last page read, the book's reading plan and whether
+it is a favorite. Triggers on Note, ReadingHistory, ReadingPlan and
+FavoriteList keep it current in the writing transaction. Reading a shelf is
+then one query joining Book, BookDetail, Author and PdfInfo on their
+primary keys.
+"""
+
+BOOK_DETAIL_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS BookDetail (
+        book_id INTEGER PRIMARY KEY,
+        note_count INTEGER NOT NULL DEFAULT 0,
+        history_count INTEGER NOT NULL DEFAULT 0,
+        last_history_id INTEGER,
+        last_read_page INTEGER,
+        last_read_at TEXT,
+        plan_id INTEGER,
+        plan_expired_date TEXT,
+        plan_is_complete INTEGER,
+        is_favorite INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(book_id) REFERENCES Book(id) ON DELETE CASCADE
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_book_ai AFTER INSERT ON Book BEGIN
+        INSERT OR IGNORE INTO BookDetail (book_id) VALUES (new.id);
+    END
+    ''',
+    # Notes
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_note_ai AFTER INSERT ON Note BEGIN
+        UPDATE BookDetail SET note_count = note_count + 1 WHERE book_id = new.book_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_note_ad AFTER DELETE ON Note BEGIN
+        UPDATE BookDetail SET note_count = note_count - 1 WHERE book_id = old.book_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_note_au AFTER UPDATE OF book_id ON Note BEGIN
+        UPDATE BookDetail SET note_count = note_count - 1 WHERE book_id = old.book_id;
+        UPDATE BookDetail SET note_count = note_count + 1 WHERE book_id = new.book_id;
+    END
+    ''',
+    # Reading history: count and the latest entry
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_history_ai AFTER INSERT ON ReadingHistory BEGIN
+        UPDATE BookDetail SET history_count = history_count + 1,
+            last_history_id = new.id, last_read_page = new.bookpage, last_read_at = new.time_stamp
+        WHERE book_id = new.book_id AND (last_history_id IS NULL OR last_history_id < new.id);
+        UPDATE BookDetail SET history_count = history_count + 1
+        WHERE book_id = new.book_id AND last_history_id > new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_history_ad AFTER DELETE ON ReadingHistory BEGIN
+        UPDATE BookDetail SET history_count = history_count - 1 WHERE book_id = old.book_id;
+        UPDATE BookDetail SET
+            (last_history_id, last_read_page, last_read_at) = (
+                SELECT id, bookpage, time_stamp FROM ReadingHistory
+                WHERE book_id = old.book_id ORDER BY id DESC LIMIT 1)
+        WHERE book_id = old.book_id AND last_history_id = old.id;
+    END
+    ''',
+    # Reading plan: add_plan keeps one plan per book, the newest one is shown
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_plan_ai AFTER INSERT ON ReadingPlan BEGIN
+        UPDATE BookDetail SET plan_id = new.id, plan_expired_date = new.expired_date,
+            plan_is_complete = new.is_complete
+        WHERE book_id = new.book_id AND (plan_id IS NULL OR plan_id <= new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_plan_au AFTER UPDATE ON ReadingPlan BEGIN
+        UPDATE BookDetail SET plan_id = new.id, plan_expired_date = new.expired_date,
+            plan_is_complete = new.is_complete
+        WHERE book_id = new.book_id AND (plan_id IS NULL OR plan_id <= new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_plan_ad AFTER DELETE ON ReadingPlan BEGIN
+        UPDATE BookDetail SET
+            (plan_id, plan_expired_date, plan_is_complete) = (
+                SELECT id, expired_date, is_complete FROM ReadingPlan
+                WHERE book_id = old.book_id ORDER BY id DESC LIMIT 1)
+        WHERE book_id = old.book_id AND plan_id = old.id;
+    END
+    ''',
+    # Favorites
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_favorite_ai AFTER INSERT ON FavoriteList BEGIN
+        UPDATE BookDetail SET is_favorite = 1 WHERE book_id = new.book_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS detail_favorite_ad AFTER DELETE ON FavoriteList BEGIN
+        UPDATE BookDetail SET is_favorite = EXISTS (SELECT 1 FROM FavoriteList WHERE book_id = old.book_id)
+        WHERE book_id = old.book_id;
+    END
+    '''
+]
+
+
+def create_book_detail(cursor):
+    """
+    Create BookDetail and its triggers, filling it from the existing rows
+    the first time.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'BookDetail'")
+    exists = cursor.fetchone() is not None
+    for statement in BOOK_DETAIL_DDL:
+        cursor.execute(statement)
+    if not exists:
+        rebuild_book_detail(cursor)
+
+
+def rebuild_book_detail(cursor):
+    cursor.execute("DELETE FROM BookDetail")
+    cursor.execute('''
+        INSERT INTO BookDetail (book_id, note_count, history_count, is_favorite)
+        SELECT b.id,
+               (SELECT COUNT(*) FROM Note WHERE book_id = b.id),
+               (SELECT COUNT(*) FROM ReadingHistory WHERE book_id = b.id),
+               EXISTS (SELECT 1 FROM FavoriteList WHERE book_id = b.id)
+        FROM Book b
+    ''')
+    cursor.execute('''
+        UPDATE BookDetail SET (last_history_id, last_read_page, last_read_at) = (
+            SELECT id, bookpage, time_stamp FROM ReadingHistory
+            WHERE book_id = BookDetail.book_id ORDER BY id DESC LIMIT 1)
+        WHERE history_count > 0
+    ''')
+    cursor.execute('''
+        UPDATE BookDetail SET (plan_id, plan_expired_date, plan_is_complete) = (
+            SELECT id, expired_date, is_complete FROM ReadingPlan
+            WHERE book_id = BookDetail.book_id ORDER BY id DESC LIMIT 1)
+        WHERE book_id IN (SELECT book_id FROM ReadingPlan)
+    ''')
+
+
+# Books added before author_id was filled in are matched by author name
+DETAIL_SQL = '''
+    SELECT b.id, b.ISBN, b.book_title, b.author, b.price, b.category, b.edition, b.current_page,
+           b.pdf_path IS NOT NULL, i.page_count,
+           a.author_id, a.author_name, a.introduction, a.nationality, a.birth_year,
+           d.note_count, d.history_count, d.last_read_page, d.last_read_at,
+           d.plan_id, d.plan_expired_date, d.plan_is_complete, d.is_favorite
+    FROM Book b
+    LEFT JOIN BookDetail d ON d.book_id = b.id
+    LEFT JOIN Author a ON a.author_id = coalesce(b.author_id, (SELECT author_id FROM Author WHERE author_name = b.author))
+    LEFT JOIN PdfInfo i ON i.book_id = b.id
+'''
+
+
+def detail_to_dict(row):
+    (book_id, isbn, title, author, price, category, edition, current_page, has_pdf, page_count,
+     author_id, author_name, introduction, nationality, birth_year,
+     note_count, history_count, last_read_page, last_read_at,
+     plan_id, plan_expired_date, plan_is_complete, is_favorite) = row
+    return {
+        "id": book_id,
+        "ISBN": isbn,
+        "book_title": title,
+        "author": author,
+        "price": price,
+        "category": category,
+        "edition": edition,
+        "current_page": current_page,
+        "has_pdf": bool(has_pdf),
+        "page_count": page_count,
+        "author_info": None if author_id is None else {
+            "author_id": author_id,
+            "author_name": author_name,
+            "introduction": introduction,
+            "nationality": nationality,
+            "birth_year": birth_year
+        },
+        "plan": None if plan_id is None else {
+            "id": plan_id,
+            "expired_date": plan_expired_date,
+            "is_complete": bool(plan_is_complete)
+        },
+        "is_favorite": bool(is_favorite),
+        "note_count": note_count or 0,
+        "history_count": history_count or 0,
+        "last_read_page": last_read_page,
+        "last_read_at": last_read_at
+    }
+
+
+def book_details(cursor, book_ids):
+    """
+    Details for the given ids, in the order given; unknown ids are skipped.
+    """
+    if not book_ids:
+        return []
+    placeholders = ','.join('?' * len(book_ids))
+    cursor.execute(f"{DETAIL_SQL} WHERE b.id IN ({placeholders})", list(book_ids))
+    by_id = {row[0]: detail_to_dict(row) for row in cursor.fetchall()}
+    return [by_id[book_id] for book_id in book_ids if book_id in by_id]
+
+
+def book_details_page(cursor, after, limit):
+    """
+    Details in id order after `after`, for walking the whole shelf.
+    """
+    cursor.execute(f"{DETAIL_SQL} WHERE b.id > ? ORDER BY b.id LIMIT ?", (after, limit))
+    return [detail_to_dict(row) for row in cursor.fetchall()]
@@ -0,0 +1,387 @@
+"""
+Bulk ingest of books, authors and reading history from CSV or JSONL.
+
+Rows are read lazily from the input stream, validated, and written with
+executemany() in chunked transactions. Every rejected row is reported with
+its 1-based row number and the reason, the rest of the chunk is still written.
+
+Chunks are committed as they go, so input that cannot be decoded stops the
+import with InputError after the earlier chunks are already in the database;
+the error carries the row it failed on and the report up to that point.
+
+Usage from the backend directory:
+
+    python3 bulk_import.py books books.csv
+    python3 bulk_import.py history history.jsonl --format jsonl
+"""
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from datetime import datetime
+from itertools import islice
+from config import BULK_CHUNK_SIZE
+from pool import get_connection
+from titles import TitleAllocator
+
+# SQLite allows at most 32766 host parameters per statement
+_PARAM_BATCH = 500
+# SQLite INTEGER is a signed 64-bit value
+_INT_MIN, _INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class RowError(ValueError):
+    pass
+
+
+class InputError(ValueError):
+    """
+    The input stream itself is unreadable at `row`; `report` covers the
+    chunks committed before it.
+    """
+    def __init__(self, message, row, report):
+        super().__init__(message)
+        self.row = row
+        self.report = report
+
+
+def decode_lines(raw):
+    """
+    Yield the lines of a binary stream decoded as UTF-8 (BOM dropped), one
+    line at a time so a decoding error surfaces at the row that holds it.
+    """
+    for i, line in enumerate(raw):
+        if i == 0 and line.startswith(b'\xef\xbb\xbf'):
+            line = line[3:]
+        yield line.decode('utf-8')
+
+
+def read_rows(stream, fmt):
+    """
+    Yield dicts from an iterable of text lines in `fmt` ('csv' or 'jsonl').
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+    elif fmt == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = RowError("invalid JSON")
+            if not isinstance(row, (dict, RowError)):
+                row = RowError("each line must be a JSON object")
+            yield row
+    else:
+        raise ValueError(f"unsupported format: {fmt}")
+
+
+def detect_format(filename=None, content_type=None):
+    if filename:
+        if filename.endswith('.csv'):
+            return 'csv'
+        if filename.endswith(('.jsonl', '.ndjson')):
+            return 'jsonl'
+    if content_type:
+        if 'csv' in content_type:
+            return 'csv'
+        if 'ndjson' in content_type or 'jsonl' in content_type:
+            return 'jsonl'
+    return None
+
+
+def _required(row, key):
+    value = row.get(key)
+    if value is None or str(value).strip() == '':
+        raise RowError(f"{key} is required")
+    return value
+
+
+def _integer(row, key, minimum=None, required=False):
+    value = row.get(key)
+    if value is None or value == '':
+        if required:
+            raise RowError(f"{key} is required")
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RowError(f"{key} must be an integer")
+    if not _INT_MIN <= value <= _INT_MAX:
+        raise RowError(f"{key} is out of range")
+    if minimum is not None and value < minimum:
+        raise RowError(f"{key} must be >= {minimum}")
+    return value
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _batched(values, size=_PARAM_BATCH):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class BulkImporter:
+    """
+    Shared chunk/transaction handling; subclasses prepare rows and statements.
+    """
+    table = None
+    insert_sql = None
+
+    def __init__(self, conn, chunk_size=BULK_CHUNK_SIZE):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.chunk_size = chunk_size
+        self.inserted = 0
+        self.errors = []
+        self.rows_read = 0
+
+    def prepare_chunk(self, rows):
+        """
+        Return a list of (row_number, params) for rows that passed validation.
+        """
+        raise NotImplementedError
+
+    def _numbered(self, rows):
+        for row in rows:
+            self.rows_read += 1
+            yield self.rows_read, row
+
+    def run(self, rows):
+        chunks = _chunks(self._numbered(rows), self.chunk_size)
+        while True:
+            try:
+                chunk = next(chunks, None)
+            except UnicodeDecodeError as e:
+                raise InputError(f"input is not valid UTF-8: {e.reason}",
+                                 self.rows_read + 1, self.report()) from e
+            if chunk is None:
+                break
+            valid = []
+            for row_number, row in chunk:
+                if isinstance(row, RowError):
+                    self.errors.append({"row": row_number, "error": str(row)})
+                else:
+                    valid.append((row_number, row))
+            # Each chunk is prepared and written under one write lock, so what
+            # prepare_chunk() read (e.g. free title suffixes) cannot be taken
+            # by another writer before the rows are in
+            self.conn.begin_immediate()
+            try:
+                self._write(self.prepare_chunk(valid))
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        return self.report()
+
+    def _write(self, prepared):
+        if not prepared:
+            return
+        self.cursor.execute("SAVEPOINT bulk_chunk")
+        try:
+            self.cursor.executemany(self.insert_sql, [params for _, params in prepared])
+            self.inserted += len(prepared)
+        except (sqlite3.IntegrityError, OverflowError):
+            # Retry row by row, still holding the lock, to find out which rows
+            # the database rejects
+            self.cursor.execute("ROLLBACK TO bulk_chunk")
+            for row_number, params in prepared:
+                try:
+                    self.cursor.execute(self.insert_sql, params)
+                    self.inserted += 1
+                except (sqlite3.IntegrityError, OverflowError) as e:
+                    self.errors.append({"row": row_number, "error": str(e)})
+        self.cursor.execute("RELEASE bulk_chunk")
+
+    def _validate(self, valid, convert):
+        prepared = []
+        for row_number, row in valid:
+            try:
+                prepared.append((row_number, convert(row)))
+            except RowError as e:
+                self.errors.append({"row": row_number, "error": str(e)})
+        return prepared
+
+    def report(self):
+        self.errors.sort(key=lambda e: e['row'])
+        return {"inserted": self.inserted, "rejected": len(self.errors), "errors": self.errors}
+
+
+class BookImporter(BulkImporter):
+    table = 'Book'
+    insert_sql = '''
+        INSERT INTO Book (ISBN, book_title, author, price, category, edition, current_page, author_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+    def __init__(self, conn, chunk_size=BULK_CHUNK_SIZE):
+        super().__init__(conn, chunk_size)
+        self.author_ids = {}
+
+    def _resolve_authors(self, names):
+        missing = [n for n in set(names) if n not in self.author_ids]
+        for batch in _batched(missing):
+            for name in batch:
+                self.author_ids[name] = None
+            self.cursor.execute(
+                f"SELECT author_name, author_id FROM Author WHERE author_name IN ({', '.join('?' for _ in batch)})",
+                batch)
+            self.author_ids.update(self.cursor.fetchall())
+
+    def _convert(self, row):
+        return [
+            _integer(row, 'ISBN'),
+            str(_required(row, 'book_title')).strip(),
+            str(_required(row, 'author')).strip(),
+            _integer(row, 'price', minimum=0),
+            row.get('category') or None,
+            _integer(row, 'edition', minimum=1),
+            _integer(row, 'current_page', minimum=0) or 0
+        ]
+
+    def prepare_chunk(self, valid):
+        prepared = self._validate(valid, self._convert)
+        # Read afresh inside this chunk's transaction; books added since the
+        # last chunk by other writers are seen
+        titles = TitleAllocator(self.cursor)
+        titles.load(params[1] for _, params in prepared)
+        self._resolve_authors(params[2] for _, params in prepared)
+        for _, params in prepared:
+            params[1] = titles.assign(params[1])
+            params.append(self.author_ids.get(params[2]))
+        return prepared
+
+
+class AuthorImporter(BulkImporter):
+    table = 'Author'
+    insert_sql = '''
+        INSERT INTO Author (author_name, introduction, nationality, birth_year)
+        VALUES (?, ?, ?, ?)
+    '''
+
+    def __init__(self, conn, chunk_size=BULK_CHUNK_SIZE):
+        super().__init__(conn, chunk_size)
+        self.seen = set()
+
+    def _convert(self, row):
+        birth_year = row.get('birth_year', row.get('Birth_year'))
+        return [
+            str(_required(row, 'author_name')).strip(),
+            row.get('introduction') or None,
+            row.get('nationality') or None,
+            _integer({'birth_year': birth_year}, 'birth_year', minimum=1)
+        ]
+
+    def prepare_chunk(self, valid):
+        prepared = self._validate(valid, self._convert)
+        names = [params[0] for _, params in prepared]
+        existing = set()
+        for batch in _batched(set(names)):
+            self.cursor.execute(
+                f"SELECT author_name FROM Author WHERE author_name IN ({', '.join('?' for _ in batch)})", batch)
+            existing.update(name for (name,) in self.cursor.fetchall())
+        accepted = []
+        for row_number, params in prepared:
+            if params[0] in existing or params[0] in self.seen:
+                self.errors.append({"row": row_number, "error": f"author {params[0]} already exists"})
+                continue
+            self.seen.add(params[0])
+            accepted.append((row_number, params))
+        return accepted
+
+
+class HistoryImporter(BulkImporter):
+    table = 'ReadingHistory'
+    insert_sql = '''
+        INSERT INTO ReadingHistory (time_stamp, book_id, bookpage, note)
+        VALUES (?, ?, ?, ?)
+    '''
+
+    def __init__(self, conn, chunk_size=BULK_CHUNK_SIZE):
+        super().__init__(conn, chunk_size)
+        self.today = datetime.now().strftime('%Y-%m-%d')
+
+    def _convert(self, row):
+        return [
+            row.get('time_stamp') or self.today,
+            _integer(row, 'book_id', required=True),
+            _integer(row, 'bookpage', minimum=0, required=True),
+            row.get('note') or ''
+        ]
+
+    def prepare_chunk(self, valid):
+        prepared = self._validate(valid, self._convert)
+        known = set()
+        for batch in _batched({params[1] for _, params in prepared}):
+            self.cursor.execute(f"SELECT id FROM Book WHERE id IN ({', '.join('?' for _ in batch)})", batch)
+            known.update(book_id for (book_id,) in self.cursor.fetchall())
+        accepted = []
+        for row_number, params in prepared:
+            if params[1] not in known:
+                self.errors.append({"row": row_number, "error": f"book_id {params[1]} does not exist"})
+                continue
+            accepted.append((row_number, params))
+        return accepted
+
+
+IMPORTERS = {
+    'books': BookImporter,
+    'authors': AuthorImporter,
+    'history': HistoryImporter
+}
+
+
+def bulk_import(kind, stream, fmt, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Import rows of `kind` from an iterable of text lines and return the report dict.
+    """
+    conn = get_connection()
+    try:
+        importer = IMPORTERS[kind](conn, chunk_size)
+        return importer.run(read_rows(stream, fmt))
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import CSV/JSONL data into the library database.")
+    parser.add_argument('kind', choices=sorted(IMPORTERS))
+    parser.add_argument('path', help="input file, or - for stdin")
+    parser.add_argument('--format', choices=['csv', 'jsonl'])
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    fmt = args.format or detect_format(filename=args.path)
+    if fmt is None:
+        parser.error("cannot tell the input format, pass --format")
+    if args.path == '-':
+        stream = sys.stdin.buffer
+    else:
+        stream = open(args.path, 'rb')
+    with stream:
+        try:
+            report = bulk_import(args.kind, decode_lines(stream), fmt, args.chunk_size)
+        except InputError as e:
+            report = e.report
+            report['errors'].append({"row": e.row, "error": str(e)})
+            report['rejected'] += 1
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    return 0 if report['rejected'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
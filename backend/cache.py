@@ -0,0 +1,259 @@
+"""
+In-process read-through cache for GET endpoints.
+
+Entries are keyed on path plus sorted query arguments and record which
+tables (and, where known, which rows) they were built from. Write endpoints
+call invalidate(table, row_id) after committing:
+
+- invalidate(table) drops every entry that read from `table`
+- invalidate(table, row_id) drops entries tied to that row plus every
+  table-wide entry for `table`, since those include the row as well
+
+Streamed responses are captured while they are sent and stored only if they
+fit within CACHE_MAX_ENTRY_BYTES, so large dumps never get buffered.
+
+With one database per library (see tenants.py), keys and table names are
+prefixed with the current library's name, so libraries never see or
+invalidate each other's entries.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import Response, make_response, request
+from config import CACHE_MAX_ENTRIES, CACHE_MAX_ENTRY_BYTES, CACHE_TTL
+from pool import current_tenant
+
+
+class _Entry:
+    __slots__ = ('body', 'status', 'mimetype', 'etag', 'expires', 'deps')
+
+    def __init__(self, body, status, mimetype, etag, expires, deps):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.etag = etag
+        self.expires = expires
+        self.deps = deps
+
+
+class ResponseCache:
+    """
+    LRU cache with a TTL and dependency tracking by (table, row_id).
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, max_entry_bytes=CACHE_MAX_ENTRY_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()
+        self._by_dep = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def generations(self, deps):
+        with self._lock:
+            return {table: self._generations.get(table, 0) for table, _ in deps}
+
+    def put(self, key, body, status, mimetype, deps, generations):
+        """
+        Store a response unless one of its tables was written to since
+        `generations` was taken (the response may already be stale).
+        """
+        if len(body) > self.max_entry_bytes:
+            return None
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        with self._lock:
+            if any(self._generations.get(t, 0) != g for t, g in generations.items()):
+                return None
+            if key in self._entries:
+                self._remove(key)
+            entry = _Entry(body, status, mimetype, etag, time.monotonic() + self.ttl, deps)
+            self._entries[key] = entry
+            for dep in deps:
+                self._by_dep.setdefault(dep, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            return entry
+
+    def invalidate(self, table, row_id=None):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            self.invalidations += 1
+            if row_id is None:
+                deps = [dep for dep in self._by_dep if dep[0] == table]
+            else:
+                deps = [(table, None), (table, row_id)]
+            for dep in deps:
+                for key in list(self._by_dep.get(dep, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_dep.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for dep in entry.deps:
+            keys = self._by_dep.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_dep[dep]
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(len(e.body) for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+response_cache = ResponseCache()
+
+
+def _row_key(row_id):
+    # Ids arrive as ints from URL converters but often as strings in JSON bodies
+    try:
+        return int(row_id)
+    except (TypeError, ValueError):
+        return row_id
+
+
+def _scoped(table):
+    tenant = current_tenant()
+    return table if tenant is None else f"{tenant}/{table}"
+
+
+_deferred = threading.local()
+
+
+def invalidate(table, row_id=None):
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        pending.append((table, row_id))
+        return
+    response_cache.invalidate(_scoped(table), None if row_id is None else _row_key(row_id))
+
+
+@contextmanager
+def deferred_invalidation():
+    """
+    Hold this thread's invalidate() calls until the block exits, for handlers
+    that run inside a transaction committed later (see routes/batch.py), so
+    no reader can cache the old rows between invalidation and commit.
+    """
+    if getattr(_deferred, 'pending', None) is not None:
+        yield
+        return
+    _deferred.pending = []
+    try:
+        yield
+    finally:
+        pending, _deferred.pending = _deferred.pending, None
+        for table, row_id in pending:
+            invalidate(table, row_id)
+
+
+def _cache_key():
+    args = '&'.join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    return _scoped(f"{request.path}?{args}")
+
+
+def _conditional(response, etag):
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def _capture(iterable, on_complete, limit):
+    chunks = []
+    size = 0
+    try:
+        for chunk in iterable:
+            if chunks is not None:
+                data = chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+                size += len(data)
+                if size > limit:
+                    chunks = None
+                else:
+                    chunks.append(data)
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+    if chunks is not None:
+        on_complete(b''.join(chunks))
+
+
+def cached(*tables, rows=None):
+    """
+    Cache a GET view's 200 responses.
+
+    `tables` are tables the response reads as a whole; `rows` is an optional
+    function called with the view arguments that returns (table, row_id)
+    pairs, with row_id None meaning the whole table.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            deps = [(_scoped(table), None) for table in tables]
+            if rows is not None:
+                deps.extend((_scoped(table), None if row_id is None else _row_key(row_id))
+                            for table, row_id in rows(**kwargs))
+            key = _cache_key()
+
+            entry = response_cache.get(key)
+            if entry is not None:
+                response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+                response.headers['X-Cache'] = 'HIT'
+                return _conditional(response, entry.etag)
+
+            generations = response_cache.generations(deps)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response.headers['X-Cache'] = 'MISS'
+
+            if response.is_streamed:
+                mimetype = response.mimetype
+                response.response = _capture(
+                    response.response,
+                    lambda body: response_cache.put(key, body, 200, mimetype, deps, generations),
+                    response_cache.max_entry_bytes)
+                return response
+
+            entry = response_cache.put(key, response.get_data(), 200, response.mimetype, deps, generations)
+            if entry is None:
+                return response
+            return _conditional(response, entry.etag)
+        return wrapper
+    return decorator
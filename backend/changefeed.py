@@ -0,0 +1,259 @@
+"""
+Change feed for live client updates.
+
+Triggers on the tables the frontend shows append (table, op, row id) to
+ChangeLog, whose AUTOINCREMENT seq is the resumable position: every write
+path, including bulk imports, batches and the write-behind flusher, is
+captured in the writing transaction. Clients read changes after a seq,
+either as a JSON page (/changes) or as server-sent events
+(/changes/stream, resumed with Last-Event-ID), and apply them as deltas:
+each change carries the row's current values, or null once it is gone.
+
+Within one read, several changes to the same row are collapsed into the
+last one. A client whose position has been pruned (the log keeps the last
+CHANGE_LOG_RETENTION entries), is too far behind, or is ahead of the log
+(e.g. after a restore) gets a reset instead and should reload its tables.
+Every library has its own log (see tenants.py), polled while it has
+subscribers.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from config import (CHANGE_LOG_RETENTION, CHANGE_FEED_POLL_INTERVAL, CHANGE_FEED_BATCH,
+                    CHANGE_FEED_MAX_BACKLOG)
+from models import MODELS, PlanEvent, dumps, fetch_all
+from pool import current_tenant, get_connection
+from tenants import use_tenant
+
+logger = logging.getLogger(__name__)
+
+# table -> model whose columns are sent to clients (see models.py); the
+# PlanEvent trigger is created with its table (see plans.py)
+FEED_TABLES = {**MODELS, PlanEvent.TABLE: PlanEvent}
+
+
+def _triggers():
+    events = [('ai', 'INSERT', 'insert', 'new'), ('au', 'UPDATE', 'update', 'new'), ('ad', 'DELETE', 'delete', 'old')]
+    for table, model in MODELS.items():
+        for suffix, event, op, ref in events:
+            yield f'''
+            CREATE TRIGGER IF NOT EXISTS changelog_{table.lower()}_{suffix} AFTER {event} ON {table} BEGIN
+                INSERT INTO ChangeLog (tbl, op, row_id) VALUES ('{table}', '{op}', {ref}.{model.KEY});
+            END
+            '''
+
+
+CHANGE_LOG_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS ChangeLog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        op TEXT NOT NULL CHECK(op IN ('insert', 'update', 'delete', 'reset')),
+        row_id INTEGER
+    )
+    ''',
+    # Every 1000 entries, drop what is older than the retention window
+    f'''
+    CREATE TRIGGER IF NOT EXISTS changelog_prune AFTER INSERT ON ChangeLog
+    WHEN new.seq % 1000 = 0 BEGIN
+        DELETE FROM ChangeLog WHERE seq <= new.seq - {int(CHANGE_LOG_RETENTION)};
+    END
+    ''',
+    *_triggers()
+]
+
+
+def create_change_log(cursor):
+    for statement in CHANGE_LOG_DDL:
+        cursor.execute(statement)
+
+
+def latest_seq(cursor):
+    cursor.execute("SELECT max(seq) FROM ChangeLog")
+    return cursor.fetchone()[0] or 0
+
+
+def record_reset(conn, at_least=0):
+    """
+    Log a reset that every client receives, numbered after `at_least`, e.g.
+    after a restore replaced the tables and the log itself.
+    """
+    conn.execute("INSERT INTO ChangeLog (seq, tbl, op) SELECT max(?, coalesce(max(seq), 0)) + 1, '*', 'reset' FROM ChangeLog",
+                 (at_least,))
+    conn.commit()
+
+
+def read_changes(cursor, since, tables=None, limit=CHANGE_FEED_BATCH):
+    """
+    Changes after `since`. Returns (changes, last_seq, reset): with reset set
+    the client must reload and continue from last_seq.
+    """
+    cursor.execute("SELECT min(seq), max(seq) FROM ChangeLog")
+    oldest, latest = cursor.fetchone()
+    latest = latest or 0
+    if since > latest or (oldest is not None and since < oldest - 1) or latest - since > CHANGE_FEED_MAX_BACKLOG:
+        return [], latest, True
+    cursor.execute("SELECT seq, tbl, op, row_id FROM ChangeLog WHERE seq > ? ORDER BY seq LIMIT ?", (since, limit))
+    entries = cursor.fetchall()
+    if not entries:
+        return [], since, False
+    last_seq = entries[-1][0]
+    if any(op == 'reset' for _, _, op, _ in entries):
+        return [], last_seq, True
+
+    # Keep the last change per row; its row data is the current state anyway
+    last = {}
+    for seq, table, op, row_id in entries:
+        if tables is None or table in tables:
+            last[(table, row_id)] = (seq, op)
+    rows = {}
+    by_table = {}
+    for table, row_id in last:
+        by_table.setdefault(table, []).append(row_id)
+    for table, ids in by_table.items():
+        model = FEED_TABLES[table]
+        placeholders = ','.join('?' * len(ids))
+        for row in fetch_all(cursor, model, f"WHERE {model.KEY} IN ({placeholders})", ids):
+            rows[(table, getattr(row, model.KEY))] = row
+    changes = [{"seq": seq, "table": table, "op": op, "id": row_id, "row": rows.get((table, row_id))}
+               for (table, row_id), (seq, op) in last.items()]
+    changes.sort(key=lambda change: change["seq"])
+    return changes, last_seq, False
+
+
+def parse_feed_args(since, last_event_id=None, tables=None):
+    """
+    Validate the position and the `tables` filter. Last-Event-ID wins over
+    `since`: a reconnecting EventSource repeats its original URL but sends
+    the last id it received. Returns (since or None, set of tables or None);
+    raises ValueError.
+    """
+    position = last_event_id if last_event_id not in (None, '') else since
+    position = int(position) if position not in (None, '') else None
+    if position is not None and position < 0:
+        raise ValueError("since must not be negative")
+    selected = None
+    if tables:
+        selected = set(tables.split(','))
+        if not selected <= FEED_TABLES.keys():
+            raise ValueError("unknown table")
+    return position, selected
+
+
+def next_events(since, tables=None):
+    """
+    Server-sent event text for the changes after `since`, and the new
+    position; the text is empty when nothing changed.
+    """
+    conn = get_connection()
+    try:
+        changes, last_seq, reset = read_changes(conn.cursor(), since, tables)
+    finally:
+        conn.close()
+    if reset:
+        return f"id: {last_seq}\nevent: reset\ndata: {dumps({'seq': last_seq}).decode()}\n\n", last_seq
+    text = ''.join(f"id: {change['seq']}\nevent: change\ndata: {dumps(change).decode()}\n\n"
+                   for change in changes)
+    if last_seq > since and not changes:
+        # Only changes to other tables: move the client's position on
+        text = f"id: {last_seq}\n\n"
+    return text, last_seq
+
+
+class ChangeFeed:
+    """
+    One thread polls the newest seq of every library with subscribers and
+    wakes them when it moves, so idle streams cost nothing but a wait.
+    """
+
+    def __init__(self, interval=CHANGE_FEED_POLL_INTERVAL):
+        self.interval = interval
+        # library (see tenants.py) -> newest seq seen / open subscriptions
+        self._latest = {}
+        self._subscribers = {}
+        self._changed = threading.Condition()
+        self._thread = None
+
+    @property
+    def latest(self):
+        """
+        Newest seq seen in the current library's log.
+        """
+        return self._latest.get(current_tenant(), 0)
+
+    @property
+    def subscribers(self):
+        return self._subscribers.get(current_tenant(), 0)
+
+    def start(self):
+        tenant = current_tenant()
+        with self._changed:
+            if tenant not in self._latest:
+                self._latest[tenant] = self._poll()
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='change-feed', daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _poll():
+        conn = get_connection()
+        try:
+            return latest_seq(conn.cursor())
+        finally:
+            conn.close()
+
+    def position(self):
+        """
+        Newest seq in the log, read now.
+        """
+        self.start()
+        return self._poll()
+
+    @contextmanager
+    def subscription(self):
+        tenant = current_tenant()
+        with self._changed:
+            self._subscribers[tenant] = self._subscribers.get(tenant, 0) + 1
+        try:
+            yield self
+        finally:
+            with self._changed:
+                self._subscribers[tenant] -= 1
+                if not self._subscribers[tenant]:
+                    del self._subscribers[tenant]
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._changed:
+                tenants = list(self._subscribers)
+            for tenant in tenants:
+                try:
+                    with use_tenant(tenant):
+                        latest = self._poll()
+                except Exception:
+                    logger.exception("change feed poll failed")
+                    continue
+                if latest != self._latest.get(tenant):
+                    with self._changed:
+                        self._latest[tenant] = latest
+                        self._changed.notify_all()
+
+    def wait(self, since, timeout):
+        """
+        Block until the log has moved past `since` or `timeout` passes;
+        returns the newest seq seen.
+        """
+        self.start()
+        tenant = current_tenant()
+        with self._changed:
+            self._changed.wait_for(lambda: self._latest.get(tenant, 0) > since, timeout)
+            return self._latest.get(tenant, 0)
+
+    def metrics(self):
+        return {"latest_seq": self.latest, "subscribers": self.subscribers}
+
+
+change_feed = ChangeFeed()
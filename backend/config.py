@@ -1,2 +1,120 @@
+import os
+
 UPLOAD_FOLDER = 'uploads/'
-DATABASE = 'library.db'
\ No newline at end of file
+DATABASE = os.environ.get('LIBRARY_DATABASE', 'library.db')
+
+# Connection pool settings (see pool.py)
+POOL_SIZE = 8
+POOL_TIMEOUT = 30
+POOL_HEALTH_CHECK_INTERVAL = 60
+SQLITE_BUSY_TIMEOUT = 5
+SQLITE_CACHE_SIZE = -16000  # negative value means KiB, i.e. ~16 MB page cache
+SQLITE_MMAP_SIZE = 268435456  # 256 MB
+
+# Keyset pagination / streaming for the /view_data endpoints (see pagination.py)
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+# Rows per transaction for bulk imports (see bulk_import.py)
+BULK_CHUNK_SIZE = 5000
+
+# Read-through response cache (see cache.py)
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL = 300
+CACHE_MAX_ENTRY_BYTES = 1048576  # 1 MB
+
+# PDF storage (see pdf_store.py)
+UPLOAD_CHUNK_SIZE = 1048576  # 1 MB
+PDF_STORE_FOLDER = 'uploads/blobs/'
+PDF_SHARD_DEPTH = 2  # directory levels of two hex digits each
+PDF_SPOOL_BYTES = 16777216  # uploads up to 16 MB are hashed in memory before touching disk
+PDF_GC_INTERVAL = 60  # seconds between garbage collection passes
+PDF_GC_GRACE = 3600  # seconds a blob stays unreferenced before it is deleted
+PDF_GC_BATCH = 100  # blobs deleted or legacy files adopted per pass
+# Let a fronting nginx/Apache send PDFs via X-Sendfile instead of Python
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '') == '1'
+
+# Background PDF processing (see pdf_jobs.py)
+PDF_JOB_THREADS = 2
+PDF_WORKER_PROCESSES = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 25
+PDF_JOB_POLL_INTERVAL = 5
+PDF_JOB_STALE_SECONDS = 600  # a running job not updated for this long is assumed dead and requeued
+THUMBNAIL_FOLDER = 'uploads/thumbnails/'
+THUMBNAIL_WIDTH = 240
+
+# Columnar snapshots and online backups (see snapshot.py)
+SNAPSHOT_GROUP_ROWS = 65536
+SNAPSHOT_COMPRESSION_LEVEL = 3
+BACKUP_FOLDER = 'backups/'
+
+# Schema migrations (see migrations.py)
+MIGRATION_SORT_THREADS = 4
+MIGRATION_CACHE_SIZE = -262144  # 256 MB while building an index
+# Seconds a worker waits for another process that is running the bootstrap
+BOOTSTRAP_LOCK_TIMEOUT = 600
+
+# Register blueprints on the first request to one of their paths instead of
+# at startup (see routes/__init__.py)
+LAZY_BLUEPRINTS = os.environ.get('LIBRARY_LAZY_ROUTES', '') == '1'
+
+# Write-behind buffering of page turns and reading history (see write_behind.py)
+WRITE_BEHIND = os.environ.get('LIBRARY_WRITE_BEHIND', '1') != '0'
+WRITE_BEHIND_INTERVAL = 0.2  # seconds between flushes
+WRITE_BEHIND_MAX_EVENTS = 500  # flush early once this many events are waiting
+
+# Change feed for live clients (see changefeed.py)
+CHANGE_LOG_RETENTION = 100000  # entries kept for clients to resume from
+CHANGE_FEED_POLL_INTERVAL = 0.25
+CHANGE_FEED_BATCH = 500  # log entries read per page or event burst
+CHANGE_FEED_MAX_BACKLOG = 10000  # further behind than this, the client reloads instead
+CHANGE_FEED_KEEPALIVE = 15  # seconds between keep-alive comments on idle streams
+
+# Compressed note bodies and the paged note list (see note_bodies.py)
+NOTE_COMPRESS_MIN_BYTES = 256  # shorter bodies are stored as plain text
+NOTE_COMPRESSION_LEVEL = 6
+NOTE_SNIPPET_CHARS = 120
+NOTE_PAGE_SIZE = 50  # notes per page of the list and of the notes page
+
+# One database per library (see tenants.py)
+TENANTS = os.environ.get('LIBRARY_TENANTS', '') == '1'
+TENANT_FOLDER = os.environ.get('LIBRARY_TENANT_FOLDER', 'libraries/')
+TENANT_HEADER = 'X-Library'
+# With e.g. library.example.com, acme.library.example.com serves library "acme"
+TENANT_DOMAIN = os.environ.get('LIBRARY_TENANT_DOMAIN', '')
+# Create a library on its first request; otherwise `python3 migrations.py create --library <name>` does
+TENANT_CREATE = os.environ.get('LIBRARY_TENANT_CREATE', '') == '1'
+TENANT_MAX_OPEN = 64  # libraries whose connections are kept open
+TENANT_IDLE_TIMEOUT = 300  # seconds before an unused library's connections are closed
+TENANT_POOL_SIZE = 4  # connections per library
+
+# Precomputed similar books (see similar.py)
+SIMILAR_TOP_K = 10
+SIMILAR_WEIGHTS = {'category': 1.0, 'author': 2.0, 'reading': 3.0, 'favorite': 0.5, 'notes': 0.5}
+SIMILAR_READING_DAYS = 365  # reading history that counts towards co-reading
+SIMILAR_NOTES_CAP = 20  # note count at which the notes feature is at its full weight
+SIMILAR_BATCH_ROWS = 64  # books scored against the whole library per matrix
+SIMILAR_REFRESH_BATCH = 5000  # changed books refreshed per pass
+SIMILAR_REFRESH_INTERVAL = 30
+
+# Reading plan deadlines (see plans.py)
+PLAN_DUE_NOTICE = 86400  # seconds before a deadline that its 'due' event fires
+PLAN_HEAP_WINDOW = 7 * 86400  # seconds of upcoming deadlines held in memory
+PLAN_POLL_INTERVAL = 5  # seconds between checks for edited plans
+PLAN_DUE_WITHIN_DAYS = 7  # default window of /plans/due
+
+# Maximum operations in one /batch request (see routes/batch.py)
+BATCH_MAX_OPS = 1000
+
+# ASGI serving (see asgi.py)
+ASGI_WSGI_THREADS = POOL_SIZE
+ASGI_FILE_THREADS = 4
+
+# Query profiling and request metrics (see profiling.py)
+PROFILE_QUERIES = os.environ.get('LIBRARY_PROFILE', '1') != '0'
+SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG_SIZE = 100
+PROFILE_MAX_STATEMENTS = 500
+PROFILE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Add a Server-Timing header (db / serialize / app time) to every response
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '') == '1'
@@ -1,10 +1,19 @@
-import sqlite3
-from config import DATABASE
+from pool import get_connection
+from search_index import create_search_index
+from titles import create_title_index
+from pdf_jobs import create_pdf_tables
+from stats import create_stats_tables
+from book_detail import create_book_detail
 
-def create_tables():
-    conn = sqlite3.connect(DATABASE)
+def create_tables(conn=None):
+    """
+    Create every table, index and trigger that is missing. Uses a pooled
+    connection unless `conn` is given (e.g. a database being restored).
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON")
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS Author (
@@ -81,17 +90,33 @@ def create_tables():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_reading_plan_book_id ON ReadingPlan (book_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_favorite_list_book_id ON FavoriteList (book_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_category ON Book (category)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_title ON Book (book_title)')
+
+    # base_title/title_suffix columns used to pick duplicate-title suffixes
+    create_title_index(cursor)
+
+    # PDF processing jobs, page counts and extracted page text
+    create_pdf_tables(cursor)
+
+    # Full-text search index over Book, Author and Note, kept in sync by triggers
+    create_search_index(cursor)
+
+    # Reading statistics rollups, kept in sync by triggers
+    create_stats_tables(cursor)
+
+    # Per-book counts, plan and favorite flag for the detail endpoints
+    create_book_detail(cursor)
     conn.commit()
-    conn.close()
+    if own_connection:
+        conn.close()
 
 def insert_initial_data():
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT COUNT(*) FROM Author")
-    author_count = cursor.fetchone()[0]
     # check if Author table has data
-    if author_count == 0:
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM Author)")
+    if not cursor.fetchone()[0]:
         cursor.executescript('''
         INSERT INTO Author (author_name, introduction, nationality, birth_year) VALUES
         ("J.D. Salinger", "J.D. Salinger was an American writer known for his widely-read novel The Catcher in the Rye.", "USA", 1919),
@@ -115,10 +140,8 @@ def insert_initial_data():
         ''')
 
     # check if Book table has data
-    cursor.execute("SELECT COUNT(*) FROM Book")
-    book_count = cursor.fetchone()[0]
-
-    if book_count == 0:
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM Book)")
+    if not cursor.fetchone()[0]:
         cursor.executescript('''
         INSERT INTO Book (ISBN, book_title, author, price, category, edition, current_page, pdf_path, author_id) VALUES
         (9789867412, "麥田捕手", "J.D. Salinger", 450, "文學", 1, 100, NULL, (SELECT author_id FROM Author WHERE author_name = "J.D. Salinger")),
@@ -0,0 +1,325 @@
+"""
+Versioned schema migrations.
+
+The schema version lives in PRAGMA user_version, so checking it is one
+cheap read of the database header, and every applied migration is also
+recorded in SchemaMigration with its duration. Version 1 is the baseline
+schema from database.create_tables(), which is idempotent and so also
+adopts databases created before versioning existed. Later migrations are
+applied in order, each in its own transaction together with its version
+bump, so a failed migration leaves the database at the previous version.
+
+Index builds go through build_index(): SQLite holds the write lock for the
+whole CREATE INDEX, so the table is first read outside any transaction to
+pull its pages into the cache, the sort runs on SQLite's worker threads,
+and each index gets its own short IMMEDIATE transaction instead of sharing
+one with the rest of the migration. Concurrent writers wait on their busy
+timeout rather than failing. ANALYZE and PRAGMA optimize run afterwards so
+the planner uses the new indexes.
+
+bootstrap() is what the app runs at startup: when user_version is current
+it returns after that single read. Otherwise it takes an exclusive lock on
+a small side database, so when several workers start together only the
+first runs the migrations and seeds an empty library; the rest wait, see
+the new version and skip.
+
+Usage from the backend directory:
+
+    python3 migrations.py status
+    python3 migrations.py migrate
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from config import MIGRATION_SORT_THREADS, MIGRATION_CACHE_SIZE, BOOTSTRAP_LOCK_TIMEOUT
+from pool import current_pool, get_connection
+from tenants import use_tenant
+from note_bodies import compress_notes, register_functions
+
+SCHEMA_MIGRATION_DDL = '''
+    CREATE TABLE IF NOT EXISTS SchemaMigration (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL,
+        duration REAL NOT NULL
+    )
+'''
+
+
+def build_index(conn, name, table, columns, unique=False, where=None):
+    """
+    Create an index while keeping the write lock as short as SQLite allows.
+    Does nothing if an index called `name` already exists on `table`.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT tbl_name FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+    row = cursor.fetchone()
+    if row is not None and row[0] == table:
+        return False
+    conn.commit()
+    # Warm the page cache with the indexed columns before taking the lock
+    cursor.execute(f"SELECT {columns} FROM {table}")
+    while cursor.fetchmany(10000):
+        pass
+    cursor.execute(f"PRAGMA threads = {int(MIGRATION_SORT_THREADS)}")
+    cursor.execute("PRAGMA cache_size")
+    cache_size = cursor.fetchone()[0]
+    cursor.execute(f"PRAGMA cache_size = {int(MIGRATION_CACHE_SIZE)}")
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        if row is not None:
+            # Same name on another table, e.g. the old Author(author_id) index
+            cursor.execute(f"DROP INDEX {name}")
+        statement = f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({columns})"
+        if where:
+            statement += f" WHERE {where}"
+        cursor.execute(statement)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    return True
+
+
+def _baseline(conn):
+    from database import create_tables
+    create_tables(conn)
+
+
+def _book_author_id_index(conn):
+    # Older databases have idx_book_author_id on Author(author_id), which
+    # only duplicates the rowid; build_index replaces it
+    build_index(conn, 'idx_book_author_id', 'Book', 'author_id')
+
+
+def _unique_favorites(conn):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute('''
+        DELETE FROM FavoriteList
+        WHERE id NOT IN (SELECT MIN(id) FROM FavoriteList GROUP BY book_id)
+    ''')
+    conn.commit()
+    build_index(conn, 'idx_favorite_list_book_id_unique', 'FavoriteList', 'book_id', unique=True)
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("DROP INDEX IF EXISTS idx_favorite_list_book_id")
+
+
+def _change_log(conn):
+    from changefeed import create_change_log
+    conn.execute("BEGIN IMMEDIATE")
+    create_change_log(conn.cursor())
+
+
+def _note_bodies(conn):
+    from changefeed import create_change_log
+    from search_index import NOTE_BODY_TRIGGERS
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    compress_notes(conn)
+    for statement in NOTE_BODY_TRIGGERS:
+        cursor.execute(statement)
+    # Puts back the change log trigger compress_notes() dropped
+    create_change_log(cursor)
+    conn.commit()
+    # Serves the note list's keyset and every lookup idx_note_book_id did
+    build_index(conn, 'idx_note_book_updated', 'Note', 'book_id, updated_at, id')
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("DROP INDEX IF EXISTS idx_note_book_id")
+
+
+def _pdf_blobs(conn):
+    from pdf_store import create_pdf_blobs
+    conn.execute("BEGIN IMMEDIATE")
+    create_pdf_blobs(conn.cursor())
+    conn.commit()
+    # Books whose PDF is still in the old per-book layout, for the collector to adopt
+    build_index(conn, 'idx_book_legacy_pdf', 'Book', 'id', where='pdf_sha256 IS NULL AND pdf_path IS NOT NULL')
+
+
+def _similar_books(conn):
+    from similar import create_similar_tables
+    conn.execute("BEGIN IMMEDIATE")
+    create_similar_tables(conn.cursor())
+
+
+def _plan_deadlines(conn):
+    from plans import create_plan_schedule
+    conn.execute("BEGIN IMMEDIATE")
+    create_plan_schedule(conn.cursor())
+    conn.commit()
+    # Only incomplete plans can come due, so only they are indexed
+    build_index(conn, 'idx_reading_plan_due', 'ReadingPlan', 'due_at', where='is_complete = 0')
+
+
+def _search_grams(conn):
+    from search_index import create_search_grams
+    conn.execute("BEGIN IMMEDIATE")
+    create_search_grams(conn.cursor())
+
+
+def _title_gaps(conn):
+    from titles import rebuild_title_gaps
+    conn.execute("BEGIN IMMEDIATE")
+    rebuild_title_gaps(conn.cursor())
+
+
+def _stats_current_keys(conn):
+    from stats import create_stats_tables, rebuild_key_rollups
+    conn.execute("BEGIN IMMEDIATE")
+    cursor = conn.cursor()
+    create_stats_tables(cursor)
+    # Rows of renamed authors and recategorised books were left under the old keys
+    rebuild_key_rollups(cursor)
+
+
+def _similar_window(conn):
+    from similar import create_similar_tables
+    conn.execute("BEGIN IMMEDIATE")
+    # Also marks every book, as the notes feature is scaled differently now
+    create_similar_tables(conn.cursor())
+
+
+# (version, name, function); functions may commit internally when building
+# indexes but must leave their final statements for the version bump to commit
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'index Book(author_id)', _book_author_id_index),
+    (3, 'unique FavoriteList(book_id)', _unique_favorites),
+    (4, 'change log for the live feed', _change_log),
+    (5, 'compressed note bodies', _note_bodies),
+    (6, 'content-addressed PDF store', _pdf_blobs),
+    (7, 'similar books index', _similar_books),
+    (8, 'reading plan deadlines', _plan_deadlines),
+    (9, 'search index for short terms', _search_grams),
+    (10, 'title gaps as ranges', _title_gaps),
+    (11, 'stats follow category and author changes', _stats_current_keys),
+    (12, 'similar books reading window', _similar_window),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn=None, target=LATEST_VERSION):
+    """
+    Apply every migration above the database's version up to `target`.
+    Returns the list of applied (version, name, seconds).
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = get_connection()
+    applied = []
+    try:
+        # Triggers created or fired here may call it (see note_bodies.py)
+        register_functions(conn)
+        version = current_version(conn)
+        if version >= target:
+            return applied
+        conn.execute(SCHEMA_MIGRATION_DDL)
+        conn.commit()
+        for number, name, function in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            start = time.perf_counter()
+            try:
+                function(conn)
+                duration = time.perf_counter() - start
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                conn.execute("INSERT OR REPLACE INTO SchemaMigration (version, name, applied_at, duration) VALUES (?, ?, ?, ?)",
+                             (number, name, datetime.utcnow().isoformat(), duration))
+                conn.execute(f"PRAGMA user_version = {int(number)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append((number, name, duration))
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        conn.commit()
+        return applied
+    finally:
+        if own_connection:
+            conn.close()
+
+
+def bootstrap(seed=True):
+    """
+    Migrate the current library's database, and seed it when `seed` is set
+    and the database is new, unless it is already current; safe to call
+    from every worker process. Returns None when nothing had to be done,
+    otherwise the migrations this process applied.
+    """
+    conn = get_connection()
+    try:
+        if current_version(conn) >= LATEST_VERSION:
+            return None
+    finally:
+        conn.close()
+
+    # The lock is held by an open write transaction, so it is released even
+    # if the process dies halfway
+    lock = sqlite3.connect(f"{current_pool().database}.bootstrap-lock", timeout=BOOTSTRAP_LOCK_TIMEOUT, isolation_level=None)
+    try:
+        lock.execute("BEGIN EXCLUSIVE")
+        conn = get_connection()
+        try:
+            fresh = current_version(conn) == 0
+            applied = migrate(conn)
+            if fresh and seed:
+                from database import insert_initial_data
+                insert_initial_data()
+            return applied
+        finally:
+            conn.close()
+    finally:
+        lock.close()
+
+
+def status(conn=None):
+    own_connection = conn is None
+    if own_connection:
+        conn = get_connection()
+    try:
+        version = current_version(conn)
+        history = []
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'SchemaMigration'").fetchone():
+            history = [{"version": v, "name": n, "applied_at": a, "duration": d} for v, n, a, d in
+                       conn.execute("SELECT version, name, applied_at, duration FROM SchemaMigration ORDER BY version")]
+        return {
+            "version": version,
+            "latest": LATEST_VERSION,
+            "pending": [{"version": v, "name": n} for v, n, _ in MIGRATIONS if v > version],
+            "applied": history
+        }
+    finally:
+        if own_connection:
+            conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show or apply schema migrations, or create a library.")
+    parser.add_argument('command', choices=['status', 'migrate', 'create'])
+    parser.add_argument('--library', help="a library from TENANT_FOLDER instead of the default one")
+    args = parser.parse_args(argv)
+    if args.command == 'create' and not args.library:
+        parser.error("create needs --library")
+    with use_tenant(args.library, create=args.command == 'create'):
+        if args.command == 'migrate':
+            for number, name, duration in migrate():
+                print(f"applied {number}: {name} ({duration:.2f}s)", file=sys.stderr)
+        json.dump(status(), sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Typed rows and JSON serialization.
+
+Each table has a slotted dataclass whose fields are the columns the API
+returns, in order, and a SELECT naming exactly those columns, so results
+never depend on `SELECT *` column order and each row is one small object
+instead of a dict. fetch_all()/fetch_one()/fetch_batches() build rows
+straight from the cursor.
+
+dumps() turns rows, lists of rows and plain dicts into UTF-8 JSON bytes. It
+uses orjson when it is installed (`pip install orjson`), which serializes
+the dataclasses natively without building dicts, and falls back to the json
+module otherwise. JSONProvider makes Flask's jsonify() go through it.
+"""
+import json
+from dataclasses import dataclass, fields
+from itertools import starmap
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _model(table, key='id', expressions=None):
+    """
+    `expressions` maps fields that are computed rather than stored to the
+    SQL that reads them.
+    """
+    expressions = expressions or {}
+
+    def wrap(cls):
+        cls = dataclass(slots=True)(cls)
+        cls.TABLE = table
+        cls.KEY = key
+        cls.COLUMNS = tuple(f.name for f in fields(cls))
+        selected = (f"{expressions[name]} AS {name}" if name in expressions else name for name in cls.COLUMNS)
+        cls.SELECT = f"SELECT {', '.join(selected)} FROM {table}"
+        return cls
+    return wrap
+
+
+# pdf_path and author_id are internal: clients use /view_pdf and /books/<id>/detail
+@_model('Book')
+class Book:
+    id: int
+    ISBN: int
+    book_title: str
+    author: str
+    price: int
+    category: str
+    edition: int
+    current_page: int
+
+
+@_model('Author', key='author_id')
+class Author:
+    author_id: int
+    author_name: str
+    introduction: str
+    nationality: str
+    birth_year: int
+
+
+@_model('ReadingHistory')
+class ReadingHistory:
+    id: int
+    time_stamp: str
+    book_id: int
+    bookpage: int
+    note: str
+
+
+@_model('ReadingPlan')
+class ReadingPlan:
+    id: int
+    book_id: int
+    expired_date: str
+    is_complete: int
+
+
+# Note lists carry a snippet; NoteDetail decompresses the body (see note_bodies.py)
+@_model('Note')
+class Note:
+    id: int
+    book_id: int
+    title: str
+    snippet: str
+    created_at: str
+    updated_at: str
+
+
+@_model('Note', expressions={'content': 'note_text(body)'})
+class NoteDetail:
+    id: int
+    book_id: int
+    title: str
+    content: str
+    created_at: str
+    updated_at: str
+
+
+@_model('FavoriteList')
+class FavoriteList:
+    id: int
+    book_id: int
+    book_title: str
+
+
+# Fired by the plan scheduler (see plans.py). The change feed carries it, but
+# it is not in MODELS: its table and feed trigger come with a later migration
+@_model('PlanEvent')
+class PlanEvent:
+    id: int
+    plan_id: int
+    book_id: int
+    kind: str
+    due_at: int
+    fired_at: int
+
+
+MODELS = {model.TABLE: model for model in (Book, Author, ReadingHistory, ReadingPlan, Note, FavoriteList)}
+
+
+def fetch_all(cursor, model, where='', params=()):
+    cursor.execute(f"{model.SELECT} {where}", params)
+    return list(starmap(model, cursor.fetchall()))
+
+
+def fetch_one(cursor, model, where='', params=()):
+    cursor.execute(f"{model.SELECT} {where}", params)
+    row = cursor.fetchone()
+    return None if row is None else model(*row)
+
+
+def fetch_batches(cursor, model, size):
+    """
+    Yield lists of rows from an executed cursor, `size` rows at a time.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield list(starmap(model, rows))
+
+
+def to_dict(row):
+    return {name: getattr(row, name) for name in row.COLUMNS}
+
+
+def _fallback(obj):
+    if hasattr(obj, 'COLUMNS'):
+        return to_dict(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=_OPTIONS)
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, default=_fallback).encode('utf-8')
+
+    loads = json.loads
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that serializes with dumps(). Calls asking for
+    formatting options (indent etc.) still use the json module.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            kwargs.setdefault('default', _fallback)
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
+
+    def dumps_bytes(self, obj):
+        return dumps(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
@@ -0,0 +1,116 @@
+"""
+Compressed note bodies.
+
+Note.body holds the note text as a BLOB: compressed with zstd when the
+`zstandard` package is installed and zlib if not, or, when the text is
+shorter than NOTE_COMPRESS_MIN_BYTES or does not shrink, as a zero byte
+followed by the UTF-8 text. The first byte tells the three apart (zlib
+streams start with 0x78, zstd frames with their magic), so notes written
+with either codec stay readable. Note.snippet keeps the start of the text
+in plain form, so the note list never reads a body.
+
+Triggers index the plain text in SearchIndex through the note_text() SQL
+function, and SearchGrams through search_grams() (see search_index.py).
+register_functions() adds both to a connection; the pool does so
+for every connection it opens and migrate() for the connection it is
+given. Other tools that write to Note, Book, Author or PdfPage need to
+register them as well.
+"""
+import zlib
+from search_index import search_grams
+from config import NOTE_COMPRESS_MIN_BYTES, NOTE_COMPRESSION_LEVEL, NOTE_SNIPPET_CHARS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+PLAIN = b'\x00'
+
+
+def compress_body(text):
+    """
+    The stored body for a note's text.
+    """
+    if text is None:
+        return None
+    data = text.encode('utf-8')
+    if len(data) < NOTE_COMPRESS_MIN_BYTES:
+        return PLAIN + data
+    if zstandard is not None:
+        compressed = zstandard.ZstdCompressor(level=NOTE_COMPRESSION_LEVEL).compress(data)
+    else:
+        compressed = zlib.compress(data, min(NOTE_COMPRESSION_LEVEL, 9))
+    return compressed if len(compressed) < len(data) else PLAIN + data
+
+
+def note_text(body):
+    """
+    The text of a stored body; the inverse of compress_body().
+    """
+    if body is None or isinstance(body, str):
+        return body
+    if body[:1] == PLAIN:
+        return body[1:].decode('utf-8')
+    if body[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("note is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(body).decode('utf-8')
+    return zlib.decompress(body).decode('utf-8')
+
+
+def make_snippet(text):
+    if not text:
+        return ''
+    text = ' '.join(text[:NOTE_SNIPPET_CHARS * 4].split())
+    if len(text) > NOTE_SNIPPET_CHARS:
+        return text[:NOTE_SNIPPET_CHARS].rstrip() + '…'
+    return text
+
+
+def note_values(content):
+    """
+    (body, snippet) to store for a note's content.
+    """
+    return compress_body(content), make_snippet(content)
+
+
+def register_functions(conn):
+    conn.create_function('note_text', 1, note_text, deterministic=True)
+    conn.create_function('search_grams', 1, search_grams, deterministic=True)
+
+
+def compress_notes(conn, batch=1000):
+    """
+    Move Note.content into the compressed body column and fill in the
+    snippets, `batch` rows at a time, then drop content. Runs inside the
+    caller's transaction; does nothing once content is gone.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM pragma_table_info('Note')")
+    columns = {row[0] for row in cursor.fetchall()}
+    if 'body' not in columns:
+        cursor.execute("ALTER TABLE Note ADD COLUMN body BLOB")
+        cursor.execute("ALTER TABLE Note ADD COLUMN snippet TEXT")
+    if 'content' not in columns:
+        return 0
+    # The rows do not change for clients or the search index, only their storage
+    cursor.execute("DROP TRIGGER IF EXISTS changelog_note_au")
+    converted = 0
+    last_id = 0
+    while True:
+        cursor.execute("SELECT id, content FROM Note WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany('''
+            UPDATE Note SET body = ?, snippet = ?, updated_at = coalesce(updated_at, created_at, '')
+            WHERE id = ?
+        ''', [(*note_values(content), note_id) for note_id, content in rows])
+        converted += len(rows)
+        last_id = rows[-1][0]
+    cursor.execute("DROP TRIGGER IF EXISTS search_note_ai")
+    cursor.execute("DROP TRIGGER IF EXISTS search_note_au")
+    cursor.execute("ALTER TABLE Note DROP COLUMN content")
+    return converted
@@ -0,0 +1,102 @@
+from flask import Response, jsonify, request
+from config import MAX_PAGE_SIZE, STREAM_BATCH_SIZE
+from pool import get_connection
+from models import dumps, fetch_batches
+
+
+def parse_page_args(args):
+    """
+    Read the `limit` and `after` query parameters.
+
+    Returns (limit, after); either may be None. Raises ValueError on bad input.
+    """
+    limit = args.get('limit')
+    after = args.get('after')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        limit = min(limit, MAX_PAGE_SIZE)
+    if after is not None:
+        after = int(after)
+    return limit, after
+
+
+def keyset_query(model, after=None, limit=None):
+    """
+    Build a SELECT that walks the model's table in id order starting after `after`.
+    """
+    sql = model.SELECT
+    params = []
+    if after is not None:
+        sql += " WHERE id > ?"
+        params.append(after)
+    sql += " ORDER BY id LIMIT ?"
+    params.append(-1 if limit is None else limit)
+    return sql, params
+
+
+def iter_batches(sql, params, model):
+    """
+    Yield lists of typed rows straight off the cursor, STREAM_BATCH_SIZE at
+    a time.
+
+    The generator checks out its own connection because it keeps running
+    after the view function (and its app context) has returned.
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        yield from fetch_batches(cursor, model, STREAM_BATCH_SIZE)
+    finally:
+        conn.close()
+
+
+def _ndjson(batches):
+    for batch in batches:
+        yield b"".join(dumps(row) + b"\n" for row in batch)
+
+
+def _json_array(batches):
+    # Each batch is serialized as one array and spliced into the outer one
+    yield b"["
+    first = True
+    for batch in batches:
+        yield (b"" if first else b",") + dumps(batch)[1:-1]
+        first = False
+    yield b"]"
+
+
+def paged_response(model):
+    """
+    Serve the model's table for a /view_data style endpoint.
+
+    - `?limit=N[&after=ID]` returns one page: {"items": [...], "next_after": ID|null}
+    - `?format=ndjson` streams one JSON object per line
+    - otherwise the whole table is streamed as a JSON array, the same shape
+      the endpoint has always returned
+    """
+    try:
+        limit, after = parse_page_args(request.args)
+    except ValueError:
+        return jsonify({"message": "無效的分頁參數！"}), 400
+
+    if request.args.get('format') == 'ndjson':
+        sql, params = keyset_query(model, after, limit)
+        return Response(_ndjson(iter_batches(sql, params, model)),
+                        mimetype='application/x-ndjson')
+
+    if limit is not None:
+        # Fetch one extra row to know whether another page exists
+        sql, params = keyset_query(model, after, limit + 1)
+        items = [row for batch in iter_batches(sql, params, model) for row in batch]
+        next_after = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_after = items[-1].id
+        return jsonify({"items": items, "next_after": next_after})
+
+    sql, params = keyset_query(model, after)
+    return Response(_json_array(iter_batches(sql, params, model)),
+                    mimetype='application/json')
@@ -0,0 +1,364 @@
+"""
+Background processing of uploaded PDFs.
+
+upload_pdf only stores the file and queues a row in PdfJob. Job threads
+claim queued jobs and fan the work out to a process pool: the page count
+first, then page ranges of PDF_PAGES_PER_TASK pages whose text is extracted
+in parallel, plus a first-page thumbnail. Extracted pages are stored in
+PdfPage, which the search index picks up through triggers, and job progress
+is written back to PdfJob as each range finishes.
+
+Jobs are persisted, so anything still queued when the server stops is
+picked up again the next time the pipeline starts. A running job updates
+its row as each page range finishes; one left running without an update
+for PDF_JOB_STALE_SECONDS, because the process running it died, is
+queued again. Jobs another live worker process is running are left alone.
+Only one job per book runs at a time: claiming a book's job supersedes its
+older queued ones, and a job whose PDF was replaced while it ran discards
+its results instead of recording them. Each library
+(see tenants.py) has its own jobs; the threads take turns between the
+default library and every library that has queued a job since it last ran
+out of them.
+
+PDF parsing uses PyMuPDF when it is installed (text and thumbnails), falls
+back to pypdf (text only), and without either still records the page count.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from config import (PDF_JOB_THREADS, PDF_WORKER_PROCESSES, PDF_PAGES_PER_TASK,
+                    PDF_JOB_POLL_INTERVAL, PDF_JOB_STALE_SECONDS, THUMBNAIL_FOLDER, THUMBNAIL_WIDTH)
+from pool import current_tenant, get_connection
+from cache import invalidate
+from tenants import storage_path, use_tenant
+
+logger = logging.getLogger(__name__)
+
+_pdf_libraries = None
+
+
+def _pdf_libs():
+    """
+    Import (pymupdf, PdfReader) on first use, either being None when not
+    installed. Only worker processes parse PDFs, so the web process never
+    pays for loading them at startup.
+    """
+    global _pdf_libraries
+    if _pdf_libraries is None:
+        try:
+            import pymupdf
+        except ImportError:
+            try:
+                import fitz as pymupdf
+            except ImportError:
+                pymupdf = None
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            PdfReader = None
+        _pdf_libraries = (pymupdf, PdfReader)
+    return _pdf_libraries
+
+
+PDF_JOB_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS PdfJob (
+        id INTEGER PRIMARY KEY,
+        book_id INTEGER NOT NULL,
+        pdf_path TEXT NOT NULL,
+        status TEXT NOT NULL CHECK(status IN ('queued', 'running', 'done', 'failed')),
+        progress REAL NOT NULL DEFAULT 0,
+        page_count INTEGER,
+        error TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY(book_id) REFERENCES Book(id) ON DELETE CASCADE
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_pdf_job_status ON PdfJob (status, id)',
+    'CREATE INDEX IF NOT EXISTS idx_pdf_job_book_id ON PdfJob (book_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS PdfInfo (
+        book_id INTEGER PRIMARY KEY,
+        page_count INTEGER NOT NULL CHECK(page_count >= 0),
+        thumbnail_path TEXT,
+        processed_at TEXT,
+        FOREIGN KEY(book_id) REFERENCES Book(id) ON DELETE CASCADE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS PdfPage (
+        id INTEGER PRIMARY KEY,
+        book_id INTEGER NOT NULL,
+        page_no INTEGER NOT NULL CHECK(page_no > 0),
+        text TEXT,
+        UNIQUE(book_id, page_no),
+        FOREIGN KEY(book_id) REFERENCES Book(id) ON DELETE CASCADE
+    )
+    '''
+]
+
+
+def create_pdf_tables(cursor):
+    for statement in PDF_JOB_DDL:
+        cursor.execute(statement)
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+def enqueue(cursor, book_id, pdf_path):
+    """
+    Queue a processing job in the caller's transaction. Returns the job id.
+    """
+    now = _now()
+    cursor.execute(
+        "INSERT INTO PdfJob (book_id, pdf_path, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+        (book_id, pdf_path, now, now))
+    return cursor.lastrowid
+
+
+# The functions below run in worker processes
+
+def count_pages(path):
+    pymupdf, PdfReader = _pdf_libs()
+    if pymupdf is not None:
+        with pymupdf.open(path) as doc:
+            return doc.page_count
+    if PdfReader is not None:
+        return len(PdfReader(path).pages)
+    # No PDF library: count page objects in the raw file
+    with open(path, 'rb') as f:
+        return len(re.findall(rb'/Type\s*/Page(?![A-Za-z])', f.read()))
+
+
+def extract_text(path, start, stop):
+    """
+    Return the text of pages [start, stop) (0-based), or None if no PDF
+    library is available.
+    """
+    pymupdf, PdfReader = _pdf_libs()
+    if pymupdf is not None:
+        with pymupdf.open(path) as doc:
+            return [doc.load_page(i).get_text() for i in range(start, stop)]
+    if PdfReader is not None:
+        reader = PdfReader(path)
+        return [reader.pages[i].extract_text() or '' for i in range(start, stop)]
+    return None
+
+
+def render_thumbnail(path, out_path, width=THUMBNAIL_WIDTH):
+    """
+    Render the first page to a PNG at `out_path`; returns the path, or None
+    when PyMuPDF is not installed or the PDF has no pages.
+    """
+    pymupdf = _pdf_libs()[0]
+    if pymupdf is None:
+        return None
+    with pymupdf.open(path) as doc:
+        if doc.page_count == 0:
+            return None
+        page = doc.load_page(0)
+        zoom = width / page.rect.width
+        pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom))
+        tmp_path = out_path + '.part'
+        pixmap.save(tmp_path, output='png')
+        os.replace(tmp_path, out_path)
+    return out_path
+
+
+class PdfPipeline:
+    """
+    Job threads that claim PdfJob rows and process them on a shared process pool.
+    """
+
+    def __init__(self, threads=PDF_JOB_THREADS, processes=PDF_WORKER_PROCESSES):
+        self.threads = threads
+        self.processes = processes
+        self._executor = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._workers = []
+        # Libraries this process has started, and libraries that may have
+        # queued (or stale) jobs -> times they were notified
+        self._recovered = set()
+        self._pending = {None: 0}
+
+    def start(self):
+        tenant = current_tenant()
+        with self._lock:
+            if tenant not in self._recovered:
+                # Polled at least once, so stale jobs are found (see _claim_job)
+                os.makedirs(storage_path(THUMBNAIL_FOLDER), exist_ok=True)
+                self._recovered.add(tenant)
+                self._pending.setdefault(tenant, 0)
+            if self._executor is not None:
+                return
+            # Not fork: this process has live threads, locks and sqlite handles
+            self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context('forkserver'))
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._loop, name=f'pdf-job-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            atexit.register(self.stop)
+
+    def notify(self):
+        self.start()
+        tenant = current_tenant()
+        with self._lock:
+            self._pending[tenant] = self._pending.get(tenant, 0) + 1
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is None:
+                self._wakeup.wait(PDF_JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            tenant, job = job
+            with use_tenant(tenant):
+                self._run(*job)
+
+    def _claim(self):
+        """
+        (library, job) for the next queued job, None when no library has one.
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+        for tenant, notified in pending:
+            with use_tenant(tenant):
+                job = self._claim_job()
+            with self._lock:
+                if job is not None:
+                    # Move to the back so libraries take turns
+                    self._pending[tenant] = self._pending.pop(tenant, notified)
+                    return tenant, job
+                if tenant is not None and self._pending.get(tenant) == notified:
+                    del self._pending[tenant]
+        return None
+
+    @staticmethod
+    def _claim_job():
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            # Jobs whose process died mid-run are started over
+            stale = (datetime.utcnow() - timedelta(seconds=PDF_JOB_STALE_SECONDS)).isoformat()
+            cursor.execute("UPDATE PdfJob SET status = 'queued', progress = 0 WHERE status = 'running' AND updated_at < ?",
+                           (stale,))
+            # Books with a job already running wait for it; two jobs for one
+            # book would interleave their pages
+            cursor.execute('''
+                SELECT book_id FROM PdfJob j
+                WHERE status = 'queued'
+                  AND NOT EXISTS (SELECT 1 FROM PdfJob r WHERE r.book_id = j.book_id AND r.status = 'running')
+                ORDER BY id LIMIT 1
+            ''')
+            row = cursor.fetchone()
+            job = None
+            if row:
+                # Only the book's newest upload is worth processing
+                cursor.execute("SELECT id, book_id, pdf_path FROM PdfJob WHERE book_id = ? AND status = 'queued' "
+                               "ORDER BY id DESC LIMIT 1", row)
+                job = cursor.fetchone()
+                now = _now()
+                cursor.execute("UPDATE PdfJob SET status = 'failed', error = ?, updated_at = ? "
+                               "WHERE book_id = ? AND status = 'queued' AND id < ?",
+                               (f"superseded by job {job[0]}", now, job[1], job[0]))
+                cursor.execute("UPDATE PdfJob SET status = 'running', updated_at = ? WHERE id = ?", (now, job[0]))
+            conn.commit()
+            return job
+        finally:
+            conn.close()
+
+    def _run(self, job_id, book_id, pdf_path):
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            total = self._executor.submit(count_pages, pdf_path).result()
+            thumbnail_path = os.path.join(storage_path(THUMBNAIL_FOLDER), f"book_{book_id}.png")
+            thumbnail = self._executor.submit(render_thumbnail, pdf_path, thumbnail_path)
+            ranges = {
+                self._executor.submit(extract_text, pdf_path, start, min(start + PDF_PAGES_PER_TASK, total)): start
+                for start in range(0, total, PDF_PAGES_PER_TASK)
+            }
+
+            cursor.execute("DELETE FROM PdfPage WHERE book_id = ?", (book_id,))
+            cursor.execute("UPDATE PdfJob SET page_count = ?, updated_at = ? WHERE id = ?", (total, _now(), job_id))
+            conn.commit()
+
+            done = 0
+            for future in as_completed(ranges):
+                start = ranges[future]
+                texts = future.result()
+                if texts is not None:
+                    cursor.executemany(
+                        "INSERT OR REPLACE INTO PdfPage (book_id, page_no, text) VALUES (?, ?, ?)",
+                        [(book_id, start + i + 1, text) for i, text in enumerate(texts)])
+                done += min(PDF_PAGES_PER_TASK, total - start)
+                cursor.execute("UPDATE PdfJob SET progress = ?, updated_at = ? WHERE id = ?",
+                               (done / total, _now(), job_id))
+                conn.commit()
+
+            thumbnail = thumbnail.result()
+            conn.begin_immediate()
+            # The book may have a new PDF by now; that upload's job redoes the pages
+            cursor.execute("SELECT 1 FROM Book b JOIN PdfJob j ON j.id = ? WHERE b.id = ? AND b.pdf_path = j.pdf_path",
+                           (job_id, book_id))
+            if cursor.fetchone() is None:
+                cursor.execute("UPDATE PdfJob SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                               ("superseded: the book's PDF changed", _now(), job_id))
+            else:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO PdfInfo (book_id, page_count, thumbnail_path, processed_at) VALUES (?, ?, ?, ?)",
+                    (book_id, total, thumbnail, _now()))
+                cursor.execute("UPDATE PdfJob SET status = 'done', progress = 1, updated_at = ? WHERE id = ?",
+                               (_now(), job_id))
+            conn.commit()
+        except Exception as e:
+            logger.exception("PDF job %s for book %s failed", job_id, book_id)
+            self._mark_failed(conn, job_id, f"{type(e).__name__}: {e}")
+        finally:
+            conn.close()
+            invalidate('PdfPage')
+
+    @staticmethod
+    def _mark_failed(conn, job_id, error):
+        """
+        Record a job as failed, on a fresh connection if the job's own one
+        cannot be used. A job still left running is requeued by the next
+        start().
+        """
+        for attempt in range(2):
+            if attempt:
+                conn = get_connection()
+            try:
+                conn.rollback()
+                conn.execute("UPDATE PdfJob SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                             (error, _now(), job_id))
+                conn.commit()
+                return
+            except Exception:
+                logger.exception("could not mark PDF job %s failed", job_id)
+            finally:
+                if attempt:
+                    conn.close()
+
+
+pdf_pipeline = PdfPipeline()
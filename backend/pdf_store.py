@@ -0,0 +1,498 @@
+"""
+Reading and writing the uploaded PDF files.
+
+PDFs are stored once per content: a file is named by its SHA-256 and kept
+under PDF_STORE_FOLDER in PDF_SHARD_DEPTH levels of directories named by
+the leading hex digits (uploads/blobs/ab/cd/abcd....pdf), so no directory
+grows past a few files even with hundreds of thousands of PDFs. Book rows
+point at their blob with pdf_sha256 (and pdf_path, which readers use), and
+triggers keep PdfBlob.refcount equal to the number of books using a blob.
+
+An upload is hashed while it streams in. Up to PDF_SPOOL_BYTES it is held
+in memory, beyond that in a temporary file inside the store, so when the
+same PDF is already stored (a duplicate title's copy, a re-upload) nothing
+is written; otherwise the fsynced temporary file is renamed into place and
+readers never see a half-written file.
+
+Deleting or replacing a book's PDF only drops a reference. BlobStore's
+collector thread deletes blobs that have been unreferenced for PDF_GC_GRACE
+seconds, holding the write lock while it does so that an upload cannot
+reuse a blob that is being removed; it also removes orphaned files left by
+interrupted uploads and moves PDFs uploaded before the store existed
+(uploads/book_<id>.pdf) into it. Every library (see tenants.py) has its own
+store inside its folder; the collector visits the libraries that are open.
+
+Downloads go through send_file with conditional=True: Werkzeug answers
+Range requests with 206 and If-None-Match/If-Modified-Since with 304, and
+full responses use the server's wsgi.file_wrapper (sendfile under gunicorn)
+or X-Sendfile when USE_X_SENDFILE is enabled.
+
+Usage from the backend directory:
+
+    python3 pdf_store.py gc
+"""
+import argparse
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from flask import send_file
+from config import (UPLOAD_CHUNK_SIZE, UPLOAD_FOLDER, PDF_STORE_FOLDER, PDF_SHARD_DEPTH, PDF_SPOOL_BYTES,
+                    PDF_GC_INTERVAL, PDF_GC_GRACE, PDF_GC_BATCH)
+from pool import current_tenant, get_connection
+from cache import invalidate
+from tenants import storage_path, tenant_router, use_tenant
+
+logger = logging.getLogger(__name__)
+
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+PDF_BLOB_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS PdfBlob (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        unreferenced_at TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_pdf_blob_unreferenced ON PdfBlob (unreferenced_at) WHERE refcount = 0',
+    '''
+    CREATE TRIGGER IF NOT EXISTS pdf_blob_ref_ai AFTER INSERT ON Book
+    WHEN new.pdf_sha256 IS NOT NULL BEGIN
+        UPDATE PdfBlob SET refcount = refcount + 1, unreferenced_at = NULL WHERE sha256 = new.pdf_sha256;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS pdf_blob_ref_ad AFTER DELETE ON Book
+    WHEN old.pdf_sha256 IS NOT NULL BEGIN
+        UPDATE PdfBlob SET refcount = refcount - 1,
+            unreferenced_at = CASE WHEN refcount = 1 THEN datetime('now') END
+        WHERE sha256 = old.pdf_sha256;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS pdf_blob_ref_au AFTER UPDATE OF pdf_sha256 ON Book
+    WHEN old.pdf_sha256 IS NOT new.pdf_sha256 BEGIN
+        UPDATE PdfBlob SET refcount = refcount - 1,
+            unreferenced_at = CASE WHEN refcount = 1 THEN datetime('now') END
+        WHERE sha256 = old.pdf_sha256;
+        UPDATE PdfBlob SET refcount = refcount + 1, unreferenced_at = NULL WHERE sha256 = new.pdf_sha256;
+    END
+    '''
+]
+
+
+def create_pdf_blobs(cursor):
+    """
+    Add Book.pdf_sha256 and the PdfBlob table with its triggers, and count
+    the references of books that already have a blob (e.g. after a restore).
+    """
+    cursor.execute("SELECT 1 FROM pragma_table_info('Book') WHERE name = 'pdf_sha256'")
+    if cursor.fetchone() is None:
+        cursor.execute("ALTER TABLE Book ADD COLUMN pdf_sha256 TEXT")
+    for statement in PDF_BLOB_DDL:
+        cursor.execute(statement)
+    cursor.execute('''
+        SELECT pdf_sha256, COUNT(*) FROM Book WHERE pdf_sha256 IS NOT NULL
+        GROUP BY pdf_sha256
+    ''')
+    counts = cursor.fetchall()
+    cursor.executemany('''
+        INSERT INTO PdfBlob (sha256, size, refcount, created_at) VALUES (?, ?, ?, datetime('now'))
+        ON CONFLICT(sha256) DO UPDATE SET refcount = excluded.refcount, unreferenced_at = NULL
+    ''', [(digest, _file_size(blob_path(digest)), count) for digest, count in counts])
+
+
+def blob_path(digest):
+    shards = [digest[2 * i:2 * i + 2] for i in range(PDF_SHARD_DEPTH)]
+    return os.path.join(storage_path(PDF_STORE_FOLDER), *shards, f"{digest}.pdf")
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Spool:
+    """
+    An upload being received: hashed as it arrives and held in memory until
+    it passes `limit` bytes, then in a temporary file inside the store.
+    """
+
+    def __init__(self, limit=PDF_SPOOL_BYTES):
+        self.limit = limit
+        self.size = 0
+        self.digest = None
+        self._hash = hashlib.sha256()
+        self._chunks = []
+        self._file = None
+        self.tmp_path = None
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self._file is None and self.size > self.limit:
+            self._spill()
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def _spill(self):
+        folder = storage_path(PDF_STORE_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=folder, prefix='.upload-', suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        self._chunks = []
+
+    def finish(self):
+        self.digest = self._hash.hexdigest()
+        return self.digest
+
+    def materialize(self):
+        """
+        Write out the content, fsynced, and return the temporary file's path.
+        """
+        if self._file is None:
+            self._spill()
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        return self.tmp_path
+
+    def discard(self):
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+            _remove(self.tmp_path)
+
+
+def receive(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Read and hash an upload. Content that is not stored yet is written to a
+    temporary file here, before the caller takes the write lock; call
+    discard() on the result when done.
+    """
+    spool = Spool()
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            spool.write(chunk)
+        if not os.path.exists(blob_path(spool.finish())):
+            spool.materialize()
+    except BaseException:
+        spool.discard()
+        raise
+    return spool
+
+
+def attach(cursor, book_id, spool):
+    """
+    Point a book at the blob for a received upload, storing the blob if it
+    is new. Must run inside a write transaction. Returns (path,
+    deduplicated), or None if the book does not exist.
+    """
+    cursor.execute("SELECT 1 FROM Book WHERE id = ?", (book_id,))
+    if cursor.fetchone() is None:
+        return None
+    path = blob_path(spool.digest)
+    # Checked under the write lock, so the collector cannot be deleting it
+    deduplicated = os.path.exists(path)
+    if not deduplicated:
+        tmp_path = spool.materialize()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    cursor.execute('''
+        INSERT INTO PdfBlob (sha256, size, created_at, unreferenced_at) VALUES (?, ?, datetime('now'), datetime('now'))
+        ON CONFLICT(sha256) DO NOTHING
+    ''', (spool.digest, spool.size))
+    cursor.execute("UPDATE Book SET pdf_path = ?, pdf_sha256 = ? WHERE id = ?", (path, spool.digest, book_id))
+    blob_store.record_upload(spool.size, deduplicated)
+    return path, deduplicated
+
+
+class BlobStore:
+    """
+    Upload counters and the background collector for unreferenced blobs.
+    """
+
+    def __init__(self, interval=PDF_GC_INTERVAL, grace=PDF_GC_GRACE, batch=PDF_GC_BATCH):
+        self.interval = interval
+        self.grace = grace
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._unadoptable = set()
+        self.uploads = 0
+        self.deduplicated = 0
+        self.deduplicated_bytes = 0
+        self.collected = 0
+        self.collected_bytes = 0
+        self.orphans_removed = 0
+        self.adopted = 0
+
+    def record_upload(self, size, deduplicated):
+        with self._lock:
+            self.uploads += 1
+            if deduplicated:
+                self.deduplicated += 1
+                self.deduplicated_bytes += size
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name='pdf-gc', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _loop(self):
+        swept = set()
+        while not self._stopping.is_set():
+            for tenant in tenant_router.active():
+                if self._stopping.is_set():
+                    return
+                try:
+                    with use_tenant(tenant):
+                        if tenant not in swept:
+                            swept.add(tenant)
+                            self.sweep()
+                        while self.collect() == self.batch:
+                            pass
+                        self.adopt_legacy()
+                except Exception:
+                    logger.exception("PDF garbage collection failed, retrying")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def collect(self):
+        """
+        Delete up to `batch` blobs unreferenced for longer than the grace
+        period. Returns how many were deleted.
+        """
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute('''
+                SELECT sha256, size FROM PdfBlob
+                WHERE refcount = 0 AND unreferenced_at <= datetime('now', ?)
+                LIMIT ?
+            ''', (f"-{int(self.grace)} seconds", self.batch))
+            blobs = cursor.fetchall()
+            for digest, _ in blobs:
+                _remove(blob_path(digest))
+            cursor.executemany("DELETE FROM PdfBlob WHERE sha256 = ?", [(digest,) for digest, _ in blobs])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        with self._lock:
+            self.collected += len(blobs)
+            self.collected_bytes += sum(size for _, size in blobs)
+        return len(blobs)
+
+    def sweep(self):
+        """
+        Remove files in the store that no PdfBlob row knows and that are
+        older than the grace period: temporary files of interrupted uploads
+        and blobs whose upload was rolled back. Walks every shard, so it
+        runs once when the collector starts. Returns how many were removed.
+        """
+        folder = storage_path(PDF_STORE_FOLDER)
+        if not os.path.isdir(folder):
+            return 0
+        cutoff = time.time() - self.grace
+        candidates = []
+        removed = 0
+        for directory, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                digest = name[:-4] if name.endswith('.pdf') else None
+                if digest and _DIGEST.match(digest):
+                    candidates.append(digest)
+                elif name.endswith('.part'):
+                    _remove(path)
+                    removed += 1
+        for start in range(0, len(candidates), 500):
+            chunk = candidates[start:start + 500]
+            conn = get_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute(f"SELECT sha256 FROM PdfBlob WHERE sha256 IN ({','.join('?' * len(chunk))})", chunk)
+                known = {row[0] for row in cursor.fetchall()}
+                for digest in chunk:
+                    if digest not in known:
+                        _remove(blob_path(digest))
+                        removed += 1
+                conn.commit()
+            finally:
+                conn.close()
+        with self._lock:
+            self.orphans_removed += removed
+        return removed
+
+    def adopt_legacy(self):
+        """
+        Move up to `batch` PDFs from the old uploads/book_<id>.pdf layout into
+        the store. Returns how many books were moved.
+        """
+        tenant = current_tenant()
+        unadoptable = {book_id for library, book_id in self._unadoptable if library == tenant}
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, pdf_path FROM Book WHERE pdf_sha256 IS NULL AND pdf_path IS NOT NULL
+                ORDER BY id LIMIT ?
+            ''', (self.batch + len(unadoptable),))
+            rows = [row for row in cursor.fetchall() if row[0] not in unadoptable][:self.batch]
+            adopted = 0
+            for book_id, old_path in rows:
+                moved = self._adopt(conn, book_id, old_path)
+                if moved is False:
+                    self._unadoptable.add((tenant, book_id))
+                elif moved:
+                    adopted += 1
+        finally:
+            conn.close()
+        with self._lock:
+            self.adopted += adopted
+        return adopted
+
+    def _adopt(self, conn, book_id, old_path):
+        """
+        True once moved, False if the file cannot be adopted, None if the
+        book changed meanwhile.
+        """
+        # Only files this app wrote into the upload folder are moved
+        if os.path.dirname(os.path.abspath(old_path)) != os.path.abspath(storage_path(UPLOAD_FOLDER)):
+            return False
+        try:
+            with open(old_path, 'rb') as f:
+                spool = receive(f)
+        except FileNotFoundError:
+            return False
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT 1 FROM Book WHERE id = ? AND pdf_path = ? AND pdf_sha256 IS NULL", (book_id, old_path))
+            if cursor.fetchone() is None:
+                conn.rollback()
+                return None
+            path, _ = attach(cursor, book_id, spool)
+            cursor.execute("UPDATE PdfJob SET pdf_path = ? WHERE pdf_path = ? AND status IN ('queued', 'running')",
+                           (path, old_path))
+            cursor.execute("SELECT 1 FROM Book WHERE pdf_path = ?", (old_path,))
+            still_used = cursor.fetchone() is not None
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            spool.discard()
+        invalidate('Book', book_id)
+        if not still_used:
+            _remove(old_path)
+        return True
+
+    def metrics(self):
+        conn = get_connection()
+        try:
+            blobs, stored_bytes, unreferenced = conn.execute(
+                "SELECT COUNT(*), coalesce(sum(size), 0), coalesce(sum(refcount = 0), 0) FROM PdfBlob").fetchone()
+        finally:
+            conn.close()
+        return {
+            "blobs": blobs,
+            "stored_bytes": stored_bytes,
+            "unreferenced": unreferenced,
+            "uploads": self.uploads,
+            "deduplicated": self.deduplicated,
+            "deduplicated_bytes": self.deduplicated_bytes,
+            "collected": self.collected,
+            "collected_bytes": self.collected_bytes,
+            "orphans_removed": self.orphans_removed,
+            "adopted": self.adopted
+        }
+
+
+blob_store = BlobStore()
+
+
+def file_etag(stat):
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+def send_file_conditional(path, mimetype):
+    """
+    Serve a file with Range and conditional GET support.
+    Raises FileNotFoundError if the file is missing.
+    """
+    stat = os.stat(path)
+    return send_file(os.path.abspath(path), mimetype=mimetype, conditional=True,
+                     etag=file_etag(stat), last_modified=stat.st_mtime, max_age=0)
+
+
+def send_pdf(path):
+    return send_file_conditional(path, 'application/pdf')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the content-addressed PDF store.")
+    parser.add_argument('command', choices=['gc'])
+    parser.add_argument('--grace', type=int, default=PDF_GC_GRACE,
+                        help="seconds a blob must have been unreferenced (default: %(default)s)")
+    parser.add_argument('--library', help="a library from TENANT_FOLDER instead of the default one")
+    args = parser.parse_args(argv)
+    store = BlobStore(grace=args.grace)
+    with use_tenant(args.library):
+        while store.collect() == store.batch:
+            pass
+        store.sweep()
+        while store.adopt_legacy():
+            pass
+        print(json.dumps(store.metrics(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Reading plan deadlines.
+
+ReadingPlan.expired_date is free-form text. due_at, a generated column,
+reads it as a UTC epoch: a date ('2026-12-01', or with '/') is due at the
+end of that day, a date with a time at that moment, anything else never
+(NULL). idx_reading_plan_due covers due_at for incomplete plans only, so
+/plans/due?within= is one index range scan over the plans it returns.
+
+PlanScheduler fires two events per incomplete plan into PlanEvent, which
+the change feed carries to clients: 'due' PLAN_DUE_NOTICE seconds before
+the deadline and 'overdue' once it has passed. Each library's deadlines up
+to PLAN_HEAP_WINDOW seconds ahead wait in an in-memory min-heap, so the
+thread sleeps until the next one. Plan edits are followed through the
+ChangeLog rather than by rescanning the table, and an entry whose plan has
+since moved, been completed or been deleted is dropped when it comes up.
+PlanEvent is unique per (plan, kind, deadline), so restarts and several
+worker processes never fire an event twice.
+"""
+import heapq
+import logging
+import threading
+import time
+from config import PLAN_DUE_NOTICE, PLAN_HEAP_WINDOW, PLAN_POLL_INTERVAL
+from changefeed import latest_seq
+from pool import current_tenant, get_connection
+from tenants import tenant_router, use_tenant
+
+logger = logging.getLogger(__name__)
+
+_EXPIRED = "replace(trim(expired_date), '/', '-')"
+DUE_AT_SQL = (f"CAST(strftime('%s', {_EXPIRED}) AS INTEGER) "
+              f"+ CASE WHEN length({_EXPIRED}) = 10 THEN 86400 ELSE 0 END")
+# due_at of a plan ending on 9999-12-31, the last date strftime() reads
+LATEST_DUE_AT = 253402300800
+
+PLAN_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS PlanEvent (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        plan_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        kind TEXT NOT NULL CHECK(kind IN ('due', 'overdue')),
+        due_at INTEGER NOT NULL,
+        fired_at INTEGER NOT NULL,
+        UNIQUE (plan_id, kind, due_at)
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS changelog_planevent_ai AFTER INSERT ON PlanEvent BEGIN
+        INSERT INTO ChangeLog (tbl, op, row_id) VALUES ('PlanEvent', 'insert', new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS plan_event_ad AFTER DELETE ON ReadingPlan BEGIN
+        DELETE FROM PlanEvent WHERE plan_id = old.id;
+    END
+    '''
+]
+
+
+def create_plan_schedule(cursor):
+    """
+    Add the due_at column to ReadingPlan if needed, then the event table.
+    """
+    cursor.execute("PRAGMA table_xinfo(ReadingPlan)")
+    if 'due_at' not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE ReadingPlan ADD COLUMN due_at INTEGER GENERATED ALWAYS AS ({DUE_AT_SQL}) VIRTUAL")
+    for statement in PLAN_DDL:
+        cursor.execute(statement)
+
+
+def due_plans(cursor, now, within, overdue=True, limit=None):
+    """
+    Incomplete plans due by `now + within`, soonest first; with `overdue`
+    false only those not yet past their deadline. The plan is pinned to
+    walk idx_reading_plan_due and look each book up by id, since without
+    fresh statistics SQLite may scan Book instead. Windows reaching past
+    LATEST_DUE_AT are cut there, so the bound always fits in an INTEGER.
+    """
+    cursor.execute(f'''
+        SELECT p.id, p.book_id, b.book_title, p.expired_date, p.due_at
+        FROM ReadingPlan p INDEXED BY idx_reading_plan_due CROSS JOIN Book b ON b.id = p.book_id
+        WHERE p.is_complete = 0 AND p.due_at <= ? {'' if overdue else 'AND p.due_at > ?'}
+        ORDER BY p.due_at, p.id LIMIT ?
+    ''', (min(now + within, LATEST_DUE_AT), *(() if overdue else (now,)), -1 if limit is None else limit))
+    return [{"plan_id": plan_id, "book_id": book_id, "book_title": title, "expired_date": expired_date,
+             "due_at": due_at, "seconds_left": due_at - now, "overdue": due_at <= now}
+            for plan_id, book_id, title, expired_date, due_at in cursor.fetchall()]
+
+
+class _Deadlines:
+    """
+    One library's heap of (fire_at, plan_id, kind, due_at) entries.
+    """
+    __slots__ = ('heap', 'seq', 'loaded_until')
+
+    def __init__(self):
+        self.heap = []
+        # ChangeLog position followed, None until the first load
+        self.seq = None
+        # Every plan with an event firing by then is in the heap
+        self.loaded_until = 0
+
+
+class PlanScheduler:
+    """
+    Fires due and overdue PlanEvents from a background thread.
+    """
+
+    def __init__(self, notice=PLAN_DUE_NOTICE, window=PLAN_HEAP_WINDOW, interval=PLAN_POLL_INTERVAL):
+        self.notice = notice
+        self.window = window
+        self.interval = interval
+        self._libraries = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.fired = 0
+        self.dropped = 0
+        self.reloads = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name='plan-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            for tenant in tenant_router.active():
+                try:
+                    with use_tenant(tenant):
+                        self.tick()
+                except Exception:
+                    logger.exception("plan scheduler tick failed")
+            self._wakeup.wait(self._sleep())
+            self._wakeup.clear()
+
+    def _sleep(self):
+        with self._lock:
+            tops = [state.heap[0][0] for state in self._libraries.values() if state.heap]
+        if not tops:
+            return self.interval
+        return min(max(min(tops) - time.time(), 0), self.interval)
+
+    def tick(self, now=None):
+        """
+        Catch up with plan edits, load deadlines entering the window and fire
+        what is due in the current library. Returns how many events fired.
+        """
+        now = int(time.time()) if now is None else now
+        with self._lock:
+            state = self._libraries.setdefault(current_tenant(), _Deadlines())
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            if state.seq is None or not self._follow(cursor, state, now):
+                self._reload(cursor, state, now)
+            if now + self.window / 2 > state.loaded_until:
+                upper = now + self.window
+                self._load(cursor, state, now, "due_at > ? AND due_at <= ?",
+                           (state.loaded_until + self.notice, upper + self.notice))
+                state.loaded_until = upper
+            return self._fire(conn, state, now)
+        finally:
+            conn.close()
+
+    def _push(self, state, plan_id, due_at, now):
+        if due_at > now:
+            heapq.heappush(state.heap, (due_at - self.notice, plan_id, 'due', due_at))
+        heapq.heappush(state.heap, (due_at, plan_id, 'overdue', due_at))
+
+    def _load(self, cursor, state, now, where, params, by_due=True):
+        index = "INDEXED BY idx_reading_plan_due" if by_due else ""
+        cursor.execute(f"SELECT id, due_at FROM ReadingPlan {index} WHERE is_complete = 0 AND {where}", params)
+        for plan_id, due_at in cursor.fetchall():
+            self._push(state, plan_id, due_at, now)
+
+    def _reload(self, cursor, state, now):
+        state.heap = []
+        state.seq = latest_seq(cursor)
+        state.loaded_until = now + self.window
+        # Plans already reported overdue stay out of the heap
+        self._load(cursor, state, now, '''
+            due_at <= ? AND NOT EXISTS (
+                SELECT 1 FROM PlanEvent e WHERE e.plan_id = ReadingPlan.id AND e.kind = 'overdue'
+                AND e.due_at = ReadingPlan.due_at)
+        ''', (state.loaded_until + self.notice,))
+        with self._lock:
+            self.reloads += 1
+
+    def _follow(self, cursor, state, now):
+        """
+        Push the plans changed since the last tick. Returns False when the
+        log cannot be followed (pruned past us, reset or replaced) and the
+        heap must be reloaded.
+        """
+        cursor.execute("SELECT min(seq), max(seq) FROM ChangeLog")
+        oldest, latest = cursor.fetchone()
+        latest = latest or 0
+        if latest < state.seq or (oldest is not None and oldest > state.seq + 1):
+            return False
+        cursor.execute('''
+            SELECT op, row_id FROM ChangeLog
+            WHERE seq > ? AND seq <= ? AND (tbl = 'ReadingPlan' OR op = 'reset')
+        ''', (state.seq, latest))
+        changes = cursor.fetchall()
+        if any(op == 'reset' for op, _ in changes):
+            return False
+        changed = list({row_id for op, row_id in changes if op != 'delete'})
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i + 500]
+            self._load(cursor, state, now, f"due_at <= ? AND id IN ({','.join('?' * len(chunk))})",
+                       (state.loaded_until + self.notice, *chunk), by_due=False)
+        state.seq = latest
+        return True
+
+    def _fire(self, conn, state, now):
+        due = []
+        while state.heap and state.heap[0][0] <= now:
+            due.append(heapq.heappop(state.heap))
+        if not due:
+            return 0
+        cursor = conn.cursor()
+        ids = list({plan_id for _, plan_id, _, _ in due})
+        plans = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor.execute(f"SELECT id, book_id, due_at FROM ReadingPlan WHERE is_complete = 0 AND id IN ({','.join('?' * len(chunk))})",
+                           chunk)
+            plans.update((plan_id, (book_id, due_at)) for plan_id, book_id, due_at in cursor.fetchall())
+        # Entries for plans moved, completed or deleted since they were pushed
+        events = [(plan_id, plans[plan_id][0], kind, due_at, now) for _, plan_id, kind, due_at in due
+                  if plans.get(plan_id, (None, None))[1] == due_at]
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany("INSERT OR IGNORE INTO PlanEvent (plan_id, book_id, kind, due_at, fired_at) VALUES (?, ?, ?, ?, ?)",
+                           events)
+        fired = max(cursor.rowcount, 0)
+        conn.commit()
+        with self._lock:
+            self.fired += fired
+            self.dropped += len(due) - len(events)
+        return fired
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "libraries": len(self._libraries),
+                "scheduled": sum(len(state.heap) for state in self._libraries.values()),
+                "fired": self.fired,
+                "dropped": self.dropped,
+                "reloads": self.reloads
+            }
+
+
+plan_scheduler = PlanScheduler()
@@ -0,0 +1,313 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import (DATABASE, POOL_SIZE, POOL_TIMEOUT, POOL_HEALTH_CHECK_INTERVAL,
+                    SQLITE_BUSY_TIMEOUT, SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE)
+from profiling import profiler, ProfiledCursor, timed_commit
+from note_bodies import register_functions
+
+
+class PooledConnection:
+    """
+    Proxy around a pooled sqlite3 connection.
+
+    Behaves like the underlying connection, except that close() hands the
+    connection back to the pool instead of closing it, and cursors report
+    to the query profiler (see profiling.py).
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._depth = 0
+        self._hold_commit = False
+        # Side effects waiting for the transaction() block to commit
+        self.after_commit_callbacks = []
+        self.last_used = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def cursor(self):
+        if not profiler.enabled:
+            return self._raw.cursor()
+        return ProfiledCursor(self._raw, self._raw.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        if self._hold_commit:
+            return
+        if not profiler.enabled:
+            return self._raw.commit()
+        timed_commit(self._raw)
+
+    @property
+    def in_held_transaction(self):
+        """
+        True inside transaction(), where writes must join the open transaction.
+        """
+        return self._hold_commit
+
+    def begin_immediate(self):
+        """
+        Start a write transaction, unless one is already open (e.g. a batch).
+        """
+        if not self._raw.in_transaction:
+            self.execute("BEGIN IMMEDIATE")
+
+    def after_commit(self, callback):
+        """
+        Run `callback`, a side effect outside the database such as removing a
+        file, once the caller's writes are committed: at once outside
+        transaction(), when the block commits inside it, never if it rolls
+        back.
+        """
+        if self._hold_commit:
+            self.after_commit_callbacks.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block in one write transaction. commit() calls made by code in
+        the block are ignored; everything commits when the block exits, or
+        rolls back if it raises.
+        """
+        self.execute("BEGIN IMMEDIATE")
+        self._hold_commit = True
+        self.after_commit_callbacks = []
+        try:
+            yield self
+        except BaseException:
+            self._hold_commit = False
+            self.after_commit_callbacks = []
+            self._raw.rollback()
+            raise
+        self._hold_commit = False
+        self.commit()
+        callbacks, self.after_commit_callbacks = self.after_commit_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        self._pool.release(self)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of SQLite connections.
+
+    A thread that already holds a connection gets the same one back from
+    connect(), so nested helpers share the caller's connection. Pragmas are
+    applied once when a connection is opened, not on every checkout.
+    `tenant` names the library the database belongs to (see tenants.py);
+    None for the default library.
+    """
+
+    def __init__(self, database, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL, tenant=None):
+        self.database = database
+        self.tenant = tenant
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._open = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._health_check_failures = 0
+        self._retired = False
+        self.last_used = time.monotonic()
+
+    def _open_connection(self):
+        raw = sqlite3.connect(self.database, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        raw.execute("PRAGMA journal_mode = WAL")
+        raw.execute("PRAGMA synchronous = NORMAL")
+        raw.execute("PRAGMA foreign_keys = ON")
+        raw.execute(f"PRAGMA cache_size = {int(SQLITE_CACHE_SIZE)}")
+        raw.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+        register_functions(raw)
+        return PooledConnection(self, raw)
+
+    def _check_health(self, conn):
+        if time.monotonic() - conn.last_used < self.health_check_interval:
+            return conn
+        try:
+            conn._raw.execute("SELECT 1").fetchone()
+            return conn
+        except sqlite3.Error:
+            with self._cond:
+                self._health_check_failures += 1
+            try:
+                conn._raw.close()
+            except sqlite3.Error:
+                pass
+            return self._open_connection()
+
+    def connect(self):
+        """
+        Check out a connection for the current thread.
+        """
+        lease = getattr(self._local, 'conn', None)
+        if lease is not None:
+            lease._depth += 1
+            return lease
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError("connection pool exhausted")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_time += time.monotonic() - start
+
+        try:
+            conn = self._open_connection() if conn is None else self._check_health(conn)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        conn._depth = 1
+        self._local.conn = conn
+        return conn
+
+    def release(self, conn):
+        """
+        Return a connection to the pool once every nested user has closed it.
+        Uncommitted work is rolled back.
+        """
+        conn._depth -= 1
+        if conn._depth > 0:
+            return
+        if getattr(self._local, 'conn', None) is conn:
+            self._local.conn = None
+        conn._hold_commit = False
+        conn.after_commit_callbacks = []
+        try:
+            if conn._raw.in_transaction:
+                conn._raw.rollback()
+            usable = True
+        except sqlite3.Error:
+            usable = False
+        conn.last_used = self.last_used = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if usable and not self._retired:
+                self._idle.append(conn)
+            else:
+                self._open -= 1
+                if usable:
+                    conn._raw.close()
+            self._cond.notify()
+
+    def release_thread(self):
+        """
+        Release whatever connection the current thread still holds, e.g. when
+        a handler returned early without closing it.
+        """
+        lease = getattr(self._local, 'conn', None)
+        if lease is not None:
+            lease._depth = 1
+            self.release(lease)
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                conn = self._idle.pop()
+                conn._raw.close()
+                self._open -= 1
+
+    def retire(self):
+        """
+        Close the idle connections, and every connection still checked out as
+        soon as it is released, once the pool is dropped from use.
+        """
+        with self._cond:
+            self._retired = True
+        self.close_all()
+
+    def idle_seconds(self):
+        """
+        Seconds since a connection was last released, or None while one is
+        checked out.
+        """
+        with self._cond:
+            if self._in_use:
+                return None
+            return time.monotonic() - self.last_used
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "wait_time_total": self._wait_time,
+                "wait_time_avg": self._wait_time / self._checkouts if self._checkouts else 0.0,
+                "health_check_failures": self._health_check_failures
+            }
+
+
+pool = ConnectionPool(DATABASE)
+
+# Pool of the library the current request or job works on (see tenants.py)
+_current_pool = ContextVar('current_pool', default=None)
+
+
+def current_pool():
+    return _current_pool.get() or pool
+
+
+def current_tenant():
+    """
+    Name of the library being worked on, None for the default library.
+    """
+    return current_pool().tenant
+
+
+@contextmanager
+def use_pool(conn_pool):
+    """
+    Make get_connection() check out from `conn_pool` within the block.
+    """
+    token = _current_pool.set(conn_pool)
+    try:
+        yield conn_pool
+    finally:
+        _current_pool.reset(token)
+
+
+def get_connection():
+    return current_pool().connect()
+
+
+def release_connection(exc=None):
+    current_pool().release_thread()
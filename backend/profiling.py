@@ -0,0 +1,358 @@
+"""
+Query profiling and request timing.
+
+Every cursor handed out by the pool is a ProfiledCursor, so each statement
+the blueprints run is timed (including the fetches that read its rows) and
+aggregated per statement text with its call count, total time and rows
+returned. Statements slower than SLOW_QUERY_MS also get their EXPLAIN QUERY
+PLAN captured and kept in a short log.
+
+init_app() adds per-route request and DB-time histograms, served in
+Prometheus text format at /metrics, and, when SERVER_TIMING is on, a
+Server-Timing header splitting each response into db, serialize and app
+time. Work done by streamed responses after the handler returns is counted
+in the statement stats but not in the request's timings.
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+from config import (PROFILE_QUERIES, SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE,
+                    PROFILE_MAX_STATEMENTS, PROFILE_BUCKETS, SERVER_TIMING)
+
+logger = logging.getLogger(__name__)
+
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+class _StatementStats:
+    __slots__ = ('calls', 'total', 'max', 'rows')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+
+class Histogram:
+    """
+    Cumulative Prometheus-style histogram per label tuple.
+    """
+
+    def __init__(self, buckets=PROFILE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0, 0.0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += 1
+        series[2] += value
+
+    def items(self):
+        return self._series.items()
+
+
+class _RequestTimings:
+    __slots__ = ('start', 'db', 'queries', 'serialize')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.queries = 0
+        self.serialize = 0.0
+
+
+class Profiler:
+    """
+    Collects statement stats, slow queries and per-route request histograms.
+    """
+
+    def __init__(self, enabled=PROFILE_QUERIES, slow_ms=SLOW_QUERY_MS,
+                 slow_log_size=SLOW_QUERY_LOG_SIZE, max_statements=PROFILE_MAX_STATEMENTS):
+        self.enabled = enabled
+        self.slow_seconds = slow_ms / 1000
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._statements = {}
+        self._slow = deque(maxlen=slow_log_size)
+        self.request_seconds = Histogram()
+        self.request_db_seconds = Histogram()
+        self.request_queries = Histogram(buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+    # Per-request state
+
+    def begin_request(self):
+        self._local.request = _RequestTimings()
+
+    def current(self):
+        return getattr(self._local, 'request', None)
+
+    def end_request(self, route, method, status):
+        timings = self.current()
+        self._local.request = None
+        if timings is None:
+            return None
+        elapsed = time.perf_counter() - timings.start
+        labels = (route, method, str(status))
+        with self._lock:
+            self.request_seconds.observe(labels, elapsed)
+            self.request_db_seconds.observe(labels, timings.db)
+            self.request_queries.observe(labels, timings.queries)
+        return timings, elapsed
+
+    def add_serialize_time(self, seconds):
+        timings = self.current()
+        if timings is not None:
+            timings.serialize += seconds
+
+    # Statement recording
+
+    def record(self, sql, seconds, rows=0, new_call=True):
+        """
+        Add `seconds` and `rows` to the stats for `sql`; new_call=False adds a
+        fetch to the statement's last call instead of counting another call.
+        """
+        timings = self.current()
+        if timings is not None:
+            timings.db += seconds
+            if new_call:
+                timings.queries += 1
+        key = _WHITESPACE.sub(' ', sql).strip()
+        with self._lock:
+            stats = self._statements.get(key)
+            if stats is None:
+                if len(self._statements) >= self.max_statements:
+                    key = '(other statements)'
+                    stats = self._statements.get(key)
+                if stats is None:
+                    stats = self._statements[key] = _StatementStats()
+            if new_call:
+                stats.calls += 1
+            stats.total += seconds
+            stats.rows += rows
+            if seconds > stats.max:
+                stats.max = seconds
+
+    def check_slow(self, raw, sql, params, seconds):
+        """
+        Log a statement slower than the threshold with its query plan.
+        """
+        if seconds < self.slow_seconds:
+            return
+        plan = None
+        if _EXPLAINABLE.match(sql):
+            try:
+                plan = [row[3] for row in raw.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+            except Exception as e:
+                plan = [f"EXPLAIN failed: {e}"]
+        entry = {
+            "sql": _WHITESPACE.sub(' ', sql).strip(),
+            "duration_ms": seconds * 1000,
+            "plan": plan,
+            "at": time.time()
+        }
+        with self._lock:
+            self._slow.append(entry)
+        logger.warning("slow query (%.1f ms): %s plan=%s", entry["duration_ms"], entry["sql"], plan)
+
+    def statements(self, limit=50):
+        with self._lock:
+            items = sorted(self._statements.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+            return [{
+                "sql": sql,
+                "calls": stats.calls,
+                "total_ms": stats.total * 1000,
+                "avg_ms": stats.total * 1000 / stats.calls if stats.calls else 0.0,
+                "max_ms": stats.max * 1000,
+                "rows": stats.rows
+            } for sql, stats in items]
+
+    def slow_queries(self):
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow.clear()
+            self.request_seconds = Histogram()
+            self.request_db_seconds = Histogram()
+            self.request_queries = Histogram(buckets=self.request_queries.buckets)
+
+
+profiler = Profiler()
+
+
+class ProfiledCursor:
+    """
+    sqlite3 cursor wrapper that reports statement and fetch times to the profiler.
+    """
+
+    def __init__(self, raw_conn, cursor):
+        self._conn = raw_conn
+        self._cursor = cursor
+        self._sql = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(256)
+            if not rows:
+                return
+            yield from rows
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        elapsed = time.perf_counter() - start
+        self._sql = sql
+        profiler.record(sql, elapsed)
+        profiler.check_slow(self._conn, sql, params, elapsed)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        self._cursor.executemany(sql, seq_of_params)
+        self._sql = None
+        profiler.record(sql, time.perf_counter() - start)
+        return self
+
+    def executescript(self, script):
+        start = time.perf_counter()
+        self._cursor.executescript(script)
+        self._sql = None
+        profiler.record(script, time.perf_counter() - start)
+        return self
+
+    def _fetched(self, start, rows):
+        if self._sql is not None:
+            profiler.record(self._sql, time.perf_counter() - start, rows, new_call=False)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(self._cursor.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+
+def timed_commit(raw_conn):
+    start = time.perf_counter()
+    raw_conn.commit()
+    profiler.record("COMMIT", time.perf_counter() - start)
+
+
+def _route_label():
+    from flask import request
+    return request.url_rule.rule if request.url_rule is not None else '(unmatched)'
+
+
+def init_app(app):
+    """
+    Time every request and time JSON serialization through app.json.
+    """
+    class TimedJSONProvider(type(app.json)):
+        def dumps(self, obj, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().dumps(obj, **kwargs)
+            finally:
+                profiler.add_serialize_time(time.perf_counter() - start)
+
+        def dumps_bytes(self, obj):
+            start = time.perf_counter()
+            try:
+                return super().dumps_bytes(obj)
+            finally:
+                profiler.add_serialize_time(time.perf_counter() - start)
+
+    app.json_provider_class = TimedJSONProvider
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def _begin():
+        profiler.begin_request()
+
+    @app.after_request
+    def _end(response):
+        from flask import request
+        result = profiler.end_request(_route_label(), request.method, response.status_code)
+        if result is not None and SERVER_TIMING:
+            timings, elapsed = result
+            response.headers['Server-Timing'] = (
+                f'db;dur={timings.db * 1000:.2f};desc="{timings.queries} queries", '
+                f'serialize;dur={timings.serialize * 1000:.2f}, '
+                f'app;dur={max(elapsed - timings.db - timings.serialize, 0) * 1000:.2f}, '
+                f'total;dur={elapsed * 1000:.2f}')
+        return response
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, help_text, histogram, label_names):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, (counts, count, total) in sorted(histogram.items()):
+        base = ','.join(f'{key}="{_escape(value)}"' for key, value in zip(label_names, labels))
+        for bound, bucket_count in zip(histogram.buckets, counts):
+            lines.append(f'{name}_bucket{{{base},le="{bound}"}} {bucket_count}')
+        lines.append(f'{name}_bucket{{{base},le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{{base}}} {total}')
+        lines.append(f'{name}_count{{{base}}} {count}')
+    return lines
+
+
+def prometheus_text(gauges=()):
+    """
+    Render the request histograms and statement counters in Prometheus text
+    format. `gauges` is an iterable of (name, help, value) added as-is.
+    """
+    labels = ('route', 'method', 'status')
+    with profiler._lock:
+        lines = []
+        lines += _histogram_lines('library_request_duration_seconds', 'Request handling time by route.',
+                                  profiler.request_seconds, labels)
+        lines += _histogram_lines('library_request_db_seconds', 'Time spent in SQLite per request by route.',
+                                  profiler.request_db_seconds, labels)
+        lines += _histogram_lines('library_request_queries', 'SQL statements per request by route.',
+                                  profiler.request_queries, labels)
+        statements = sorted(profiler._statements.items())
+        lines += ['# HELP library_sql_calls_total Calls per SQL statement.',
+                  '# TYPE library_sql_calls_total counter']
+        lines += [f'library_sql_calls_total{{statement="{_escape(sql)}"}} {stats.calls}' for sql, stats in statements]
+        lines += ['# HELP library_sql_seconds_total Time per SQL statement, including fetches.',
+                  '# TYPE library_sql_seconds_total counter']
+        lines += [f'library_sql_seconds_total{{statement="{_escape(sql)}"}} {stats.total}' for sql, stats in statements]
+        lines += ['# HELP library_sql_rows_total Rows returned per SQL statement.',
+                  '# TYPE library_sql_rows_total counter']
+        lines += [f'library_sql_rows_total{{statement="{_escape(sql)}"}} {stats.rows}' for sql, stats in statements]
+        lines += ['# HELP library_slow_queries Slow queries currently in the log.',
+                  '# TYPE library_slow_queries gauge',
+                  f'library_slow_queries {len(profiler._slow)}']
+    for name, help_text, value in gauges:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
@@ -1,18 +1,90 @@
-from .books import books_bp
-from .reading_history import history_bp
-from .reading_plan import plan_bp
-from .favorites import favorites_bp
-from .search import search_bp
-from .author import author_bp
-from .notes import notes_bp
-
-
-def register_routes(app):
-    app.register_blueprint(books_bp)
-    app.register_blueprint(history_bp)
-    app.register_blueprint(plan_bp)
-    app.register_blueprint(notes_bp)
-    app.register_blueprint(favorites_bp)
-    app.register_blueprint(search_bp)
-    app.register_blueprint(author_bp)
-    
\ No newline at end of file
+import importlib
+import threading
+from config import LAZY_BLUEPRINTS
+
+# (module, blueprint, first path segments of its routes) in registration
+# order. With lazy registration a route whose segment is missing here is
+# never reached, so keep this in step with the @route decorators.
+BLUEPRINTS = [
+    ('books', 'books_bp', ('add_book', 'books', 'check_book', 'delete_book', 'update_page', 'upload_pdf', 'view_pdf')),
+    ('reading_history', 'history_bp', ('add_history', 'delete_history')),
+    ('reading_plan', 'plan_bp', ('add_plan', 'delete_plan', 'plans')),
+    ('notes', 'notes_bp', ('add_note', 'delete_note', 'note', 'notes', 'update_note')),
+    ('favorites', 'favorites_bp', ('add_favorite', 'delete_favorite', 'view_data')),
+    ('search', 'search_bp', ('search', 'search_book', 'search_by_category', 'search_by_name',
+                             'search_id_by_book_title', 'view_data')),
+    ('author', 'author_bp', ('add_author', 'get_author', 'update_author')),
+    ('bulk', 'bulk_bp', ('bulk',)),
+    ('pdf_jobs', 'pdf_jobs_bp', ('pdf_jobs', 'thumbnail')),
+    ('stats', 'stats_bp', ('stats',)),
+    ('batch', 'batch_bp', ('batch',)),
+    ('snapshot', 'snapshot_bp', ('backup', 'export')),
+    ('changes', 'changes_bp', ('changes',)),
+    ('system', 'system_bp', ('metrics',)),
+]
+
+
+def _blueprint(module, name):
+    return getattr(importlib.import_module(f'.{module}', __name__), name)
+
+
+class LazyBlueprints:
+    """
+    WSGI middleware that imports and registers a blueprint just before the
+    first request to one of its path segments reaches Flask.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.lock = threading.Lock()
+        # segment -> modules not registered yet; a segment is removed only
+        # once all of them are, so concurrent requests wait on the lock
+        self.pending = {}
+        for module, name, segments in BLUEPRINTS:
+            for segment in segments:
+                self.pending.setdefault(segment, []).append((module, name))
+        self.loaded = set()
+
+    def load(self, path):
+        segment = path.lstrip('/').split('/', 1)[0]
+        if segment not in self.pending:
+            return
+        with self.lock:
+            for module, name in self.pending.get(segment, ()):
+                if module not in self.loaded:
+                    self._register(_blueprint(module, name))
+                    self.loaded.add(module)
+            self.pending.pop(segment, None)
+
+    def _register(self, blueprint):
+        # Flask refuses setup calls once it has served any request; this one
+        # only adds routes nobody could have reached yet
+        got_first_request = self.app._got_first_request
+        self.app._got_first_request = False
+        try:
+            self.app.register_blueprint(blueprint)
+        finally:
+            self.app._got_first_request = got_first_request
+
+    def __call__(self, environ, start_response):
+        self.load(environ.get('PATH_INFO', ''))
+        return self.wsgi_app(environ, start_response)
+
+
+def register_routes(app, lazy=LAZY_BLUEPRINTS):
+    if not lazy:
+        for module, name, _ in BLUEPRINTS:
+            app.register_blueprint(_blueprint(module, name))
+        return
+    app.extensions['lazy_blueprints'] = app.wsgi_app = LazyBlueprints(app)
+
+
+def ensure_routes(app, path):
+    """
+    Make sure the blueprint serving `path` is registered, for code that
+    matches URLs itself (e.g. /batch) rather than going through WSGI.
+    """
+    lazy = app.extensions.get('lazy_blueprints')
+    if lazy is not None:
+        lazy.load(path)
@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
 import sqlite3
-from config import DATABASE
+from pool import get_connection
+from cache import cached, invalidate
+from models import Author, fetch_one
 
 author_bp = Blueprint('author', __name__)
 
@@ -8,7 +10,7 @@ author_bp = Blueprint('author', __name__)
 @author_bp.route('/add_author', methods=['POST'])
 def add_author():
     data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     # check if the author_name already exists
     cursor.execute("SELECT COUNT(*) FROM Author WHERE author_name = ?", (data['author_name'],))
@@ -21,24 +23,25 @@ def add_author():
                     (data['author_name'], data['introduction'], data['nationality'], data['Birth_year']))
     conn.commit()
     conn.close()
+    invalidate('Author', cursor.lastrowid)
     return jsonify({"message": f"作者 {data['author_name']} 新增成功!"}), 200
 
 
 @author_bp.route('/get_author/<author_name>', methods=['GET'])
+@cached('Author')
 def get_author(author_name):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Author WHERE author_name = ?", (author_name,))
-    author = cursor.fetchone()
+    conn = get_connection()
+    author = fetch_one(conn.cursor(), Author, "WHERE author_name = ?", (author_name,))
     conn.close()
 
     if author:
+        # The author form reads Birth_year
         author_info = {
-            "author_id": author[0],
-            "author_name": author[1],
-            "introduction": author[2],
-            "nationality": author[3],
-            "Birth_year": author[4]
+            "author_id": author.author_id,
+            "author_name": author.author_name,
+            "introduction": author.introduction,
+            "nationality": author.nationality,
+            "Birth_year": author.birth_year
         }
         return jsonify(author_info), 200
     else:
@@ -49,7 +52,7 @@ def get_author(author_name):
 def update_author():
     try:
         data = request.get_json()
-        conn = sqlite3.connect(DATABASE)
+        conn = get_connection()
         cursor = conn.cursor()
 
         # Get the original author name
@@ -73,6 +76,8 @@ def update_author():
 
         conn.commit()
         conn.close()
+        invalidate('Author', data['author_id'])
+        invalidate('Book')
 
         return jsonify({"message": "作者更新成功"}), 200
     except sqlite3.IntegrityError as e:
@@ -0,0 +1,97 @@
+from urllib.parse import urlsplit
+from flask import Blueprint, request, jsonify, current_app
+from werkzeug.exceptions import HTTPException
+from pool import get_connection
+from cache import deferred_invalidation
+from config import BATCH_MAX_OPS
+from . import ensure_routes
+
+batch_bp = Blueprint('batch', __name__)
+
+# Blueprints whose write endpoints may be used as batch operations
+BATCH_BLUEPRINTS = {'books', 'notes', 'favorites', 'plan', 'history'}
+BATCH_METHODS = {'POST', 'PUT', 'DELETE'}
+
+
+class _OpFailed(Exception):
+    pass
+
+
+def _run_op(adapter, op):
+    """
+    Dispatch one {method, path, body} operation to its existing view function
+    on the batch's connection. Returns (status, json body).
+    """
+    method = str(op.get('method', 'POST')).upper()
+    path = op.get('path')
+    if method not in BATCH_METHODS or not isinstance(path, str):
+        return 400, {"message": "無效的批次操作！"}
+    url = urlsplit(path)
+    ensure_routes(current_app, url.path)
+    try:
+        endpoint, args = adapter.match(url.path, method=method)
+    except HTTPException as e:
+        return e.code, {"message": e.description}
+    if endpoint.split('.')[0] not in BATCH_BLUEPRINTS:
+        return 400, {"message": "此操作不支援批次處理！"}
+
+    with current_app.test_request_context(url.path, method=method, query_string=url.query, json=op.get('body')):
+        response = current_app.make_response(current_app.view_functions[endpoint](**args))
+        return response.status_code, response.get_json(silent=True)
+
+
+@batch_bp.route('/batch', methods=['POST'])
+def batch():
+    """
+    Run a list of write operations in one transaction.
+
+    Body: {"ops": [{"method": "POST", "path": "/add_book", "body": {...}}, ...],
+           "atomic": true}
+
+    Each op is handled by the same endpoint as a standalone request and gets
+    its own result. With atomic (the default) the first failing op rolls the
+    whole batch back; otherwise only the failed op is rolled back and the
+    rest are committed.
+    """
+    data = request.get_json(silent=True) or {}
+    ops = data.get('ops')
+    atomic = bool(data.get('atomic', True))
+    if not isinstance(ops, list) or not ops or not all(isinstance(op, dict) for op in ops):
+        return jsonify({"message": "無效的批次操作！"}), 400
+    if len(ops) > BATCH_MAX_OPS:
+        return jsonify({"message": f"批次操作最多 {BATCH_MAX_OPS} 筆！"}), 400
+
+    adapter = current_app.url_map.bind('localhost')
+    results = []
+    failed = False
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        with deferred_invalidation(), conn.transaction():
+            for index, op in enumerate(ops):
+                cursor.execute("SAVEPOINT batch_op")
+                callbacks = len(conn.after_commit_callbacks)
+                try:
+                    status, body = _run_op(adapter, op)
+                except Exception as e:
+                    status, body = 500, {"message": f"{type(e).__name__}: {e}"}
+                results.append({"index": index, "status": status, "body": body})
+                if status < 400:
+                    cursor.execute("RELEASE batch_op")
+                    continue
+                failed = True
+                cursor.execute("ROLLBACK TO batch_op")
+                cursor.execute("RELEASE batch_op")
+                # The op's files and caches stay as they were, like its rows
+                del conn.after_commit_callbacks[callbacks:]
+                if atomic:
+                    raise _OpFailed()
+    except _OpFailed:
+        pass
+    finally:
+        conn.close()
+
+    if failed and atomic:
+        results += [{"index": index, "status": None, "body": None} for index in range(len(results), len(ops))]
+        return jsonify({"message": "批次操作失敗，已全部復原！", "committed": False, "results": results}), 400
+    return jsonify({"message": "批次操作完成！", "committed": True, "results": results}), 207 if failed else 200
@@ -1,16 +1,17 @@
-from flask import Blueprint, request, jsonify, send_from_directory, current_app
-import sqlite3
-from config import DATABASE
+from flask import Blueprint, request, jsonify
+from pool import get_connection
+from cache import cached, invalidate
+from config import MAX_PAGE_SIZE, WRITE_BEHIND, SIMILAR_TOP_K
+from book_detail import book_details, book_details_page
+from titles import next_book_title
+from pdf_store import attach, blob_store, receive, send_pdf
+from pdf_jobs import enqueue, pdf_pipeline
+from similar import similar_index
+from write_behind import book_ids, parse_book_id, parse_page, write_behind
 import os
 
 books_bp = Blueprint('books', __name__)
 
-def get_book_ids():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM Book")
-    return [id[0] for id in cursor.fetchall()]
-
 @books_bp.route('/check_book', methods=['POST'])
 def check_book():
     """
@@ -18,9 +19,9 @@ def check_book():
     """
     data = request.get_json()
     book_title = data['book_title']
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Book WHERE book_title = ?", (book_title,))
+    cursor.execute("SELECT 1 FROM Book WHERE book_title = ?", (book_title,))
     existing_book = cursor.fetchone()
     conn.close()
     if existing_book:
@@ -34,105 +35,239 @@ def add_book():
     """
     data = request.get_json()
     book_title = data['book_title']
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Book WHERE book_title = ?", (book_title,))
-    existing_book = cursor.fetchone()
-    original_title = book_title
-    count = 1
-    if existing_book:
-        while existing_book:
-            book_title = f"{original_title}({count})"
-            cursor.execute("SELECT * FROM Book WHERE book_title = ?", (book_title,))
-            existing_book = cursor.fetchone()
-            count += 1
-
-    new_book_title = book_title
-
+    # Pick the title(n) suffix and insert in one write transaction
+    conn.begin_immediate()
+    new_book_title = next_book_title(cursor, book_title)
 
-    cursor.execute("INSERT INTO Book (ISBN, book_title, author, price, category, edition, current_page) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                   (data['ISBN'], new_book_title, data['author'], data['price'], data['category'], data['edition'], data['current_page']))
+    cursor.execute("INSERT INTO Book (ISBN, book_title, author, price, category, edition, current_page, author_id) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT author_id FROM Author WHERE author_name = ?))",
+                   (data['ISBN'], new_book_title, data['author'], data['price'], data['category'], data['edition'],
+                    data['current_page'], data['author']))
     conn.commit()
+    invalidate('Book', cursor.lastrowid)
     conn.close()
-    print(f'資料庫有{len(get_book_ids())}本書')
     return jsonify({"message": f"書籍 {new_book_title} 新增成功！"}), 201
 
 @books_bp.route('/update_page', methods=['PUT'])
 def update_page():
     """
-    Update the current page of a book.
+    Update the current page of a book. Outside a batch the write is
+    buffered and committed by the write-behind flusher.
     """
-    data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
+    data = request.get_json(silent=True) or {}
+    try:
+        book_id = parse_book_id(data.get('book_id'))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    if book_id not in book_ids:
+        return jsonify({"message": "書籍ID不存在！"}), 404
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE Book SET current_page = ? WHERE id = ?", (data['current_page'], data['book_id']))
+    try:
+        page = parse_page(cursor, book_id, data.get('current_page'))
+    except ValueError as e:
+        conn.close()
+        return jsonify({"message": str(e)}), 400
+    if WRITE_BEHIND and not conn.in_held_transaction:
+        conn.close()
+        write_behind.update_page(book_id, page)
+        return jsonify({"message": "目前頁數更新成功！"}), 200
+    cursor.execute("UPDATE Book SET current_page = ? WHERE id = ?", (page, book_id))
     conn.commit()
     conn.close()
+    invalidate('Book', book_id)
     return jsonify({"message": "目前頁數更新成功！"}), 200
 
 @books_bp.route('/upload_pdf', methods=['POST'])
 def upload_pdf():
     """
     Upload a PDF file for a book.
+
+    Accepts either a multipart form (`book_id` and `file`) or the raw PDF
+    as the request body with Content-Type application/pdf and `?book_id=`.
+    The file is hashed as it streams in and stored once per content (see
+    pdf_store.py); an identical PDF that is already stored is not written
+    again.
     """
-    book_id = request.form['book_id']
-    if 'file' not in request.files:
-        return jsonify({"message": "No file part"}), 400
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"message": "No selected file"}), 400
-    if file:
-        filename = f"book_{book_id}.pdf"
-        file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-        pdf_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        
-        # 更新資料庫中的pdf_path欄位
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE Book SET pdf_path = ? WHERE id = ?", (pdf_path, book_id))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({"message": "File successfully uploaded"}), 201
+    if request.mimetype == 'application/pdf':
+        book_id = request.args.get('book_id', '')
+        stream = request.stream
+    else:
+        book_id = request.form['book_id']
+        if 'file' not in request.files:
+            return jsonify({"message": "No file part"}), 400
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({"message": "No selected file"}), 400
+        stream = file.stream
+    if not str(book_id).isdigit():
+        return jsonify({"message": "Invalid book_id"}), 400
+    if stream:
+        blob_store.start()
+        spool = receive(stream)
+        try:
+            # 更新資料庫中的pdf_path欄位
+            conn = get_connection()
+            cursor = conn.cursor()
+            conn.begin_immediate()
+            stored = attach(cursor, book_id, spool)
+            if stored is None:
+                conn.rollback()
+                conn.close()
+                return jsonify({"message": "書籍ID不存在！"}), 404
+            pdf_path, deduplicated = stored
+            # 頁數、文字擷取與縮圖在背景處理
+            job_id = enqueue(cursor, book_id, pdf_path)
+            conn.commit()
+            conn.close()
+        finally:
+            spool.discard()
+        invalidate('Book', book_id)
+        pdf_pipeline.notify()
+
+        return jsonify({"message": "File successfully uploaded", "job_id": job_id,
+                        "sha256": spool.digest, "deduplicated": deduplicated}), 201
 
 @books_bp.route('/view_pdf/<int:book_id>', methods=['GET'])
 def view_pdf(book_id):
     """
     View the PDF file for a book.
     """
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT pdf_path FROM Book WHERE id = ?", (book_id,))
-    pdf_path = cursor.fetchone()[0]
+    row = cursor.fetchone()
     conn.close()
-    if pdf_path:
-        return send_from_directory(directory=os.path.dirname(pdf_path), path=os.path.basename(pdf_path), as_attachment=False)
-    else:
-        return jsonify({"message": "PDF not found"}), 404
+    if row and row[0]:
+        try:
+            return send_pdf(row[0])
+        except FileNotFoundError:
+            pass
+    return jsonify({"message": "PDF not found"}), 404
     
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 @books_bp.route('/delete_book/<int:book_id>', methods=['DELETE'])
 def delete_book(book_id):
     """
     Delete a book from the database.
     """
-    conn = sqlite3.connect(DATABASE)
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = get_connection()
     cursor = conn.cursor()
     
-    # 查找書籍的PDF文件路徑
-    cursor.execute("SELECT pdf_path FROM Book WHERE id = ?", (book_id,))
-    pdf_path = cursor.fetchone()
+    # 查找書籍的縮圖路徑；PDF 由 pdf_store 的回收執行緒在無人引用後刪除
+    cursor.execute("SELECT thumbnail_path FROM PdfInfo WHERE book_id = ?", (book_id,))
+    thumbnail_path = cursor.fetchone()
     
     # 刪除書籍的記錄及其相關資料（閱讀歷史、閱讀計劃、筆記、我的最愛）
     cursor.execute("DELETE FROM Book WHERE id = ?", (book_id,))
     conn.commit()
-    conn.close()
+    conn.after_commit(lambda: book_ids.discard(book_id))
+    invalidate('Book', book_id)
+    for table in ('ReadingHistory', 'ReadingPlan', 'Note', 'FavoriteList'):
+        invalidate(table)
     
-    # 刪除PDF文件
-    if pdf_path:
-        try:
-            os.remove(pdf_path[0])
-        except FileNotFoundError:
-            pass
+    blob_store.start()
+
+    # 刪除縮圖（在批次中等到提交後才刪除）
+    if thumbnail_path and thumbnail_path[0]:
+        conn.after_commit(lambda: _remove_file(thumbnail_path[0]))
+    conn.close()
     
-    return jsonify({"message": "書籍刪除成功！"}), 200
\ No newline at end of file
+    return jsonify({"message": "書籍刪除成功！"}), 200
+
+# Every table that feeds BookDetail or the joined Author/PdfInfo columns
+DETAIL_TABLES = ('Book', 'Author', 'Note', 'ReadingHistory', 'ReadingPlan', 'FavoriteList', 'PdfPage')
+
+@books_bp.route('/books/<int:book_id>/detail', methods=['GET'])
+@cached(*DETAIL_TABLES)
+def book_detail(book_id):
+    """
+    A book with its author, reading plan, favorite flag, note and history
+    counts and last page read.
+    """
+    conn = get_connection()
+    details = book_details(conn.cursor(), [book_id])
+    conn.close()
+    if not details:
+        return jsonify({"message": "書籍未找到！"}), 404
+    return jsonify(details[0]), 200
+
+@books_bp.route('/books/detail', methods=['GET'])
+@cached(*DETAIL_TABLES)
+def book_detail_list():
+    """
+    Details for a shelf of books: `ids=1,2,3` in that order, or the whole
+    library in pages of `limit` after `after` (keyset on id).
+    """
+    ids = request.args.get('ids')
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if ids is not None:
+            book_ids = [int(book_id) for book_id in ids.split(',') if book_id.strip()]
+            if len(book_ids) > MAX_PAGE_SIZE:
+                raise ValueError
+            return jsonify({"items": book_details(cursor, book_ids)}), 200
+        after = request.args.get('after', 0, type=int)
+        limit = request.args.get('limit', 100, type=int)
+        if limit < 1:
+            raise ValueError
+        items = book_details_page(cursor, after, min(limit, MAX_PAGE_SIZE))
+        next_after = items[-1]["id"] if len(items) == min(limit, MAX_PAGE_SIZE) else None
+        return jsonify({"items": items, "next_after": next_after}), 200
+    except ValueError:
+        return jsonify({"message": "無效的分頁參數！"}), 400
+    finally:
+        conn.close()
+
+@books_bp.route('/books/<int:book_id>/similar', methods=['GET'])
+def similar_books(book_id):
+    """
+    The books most similar to a book, best first, from the precomputed
+    SimilarBook lists (see similar.py). `pending` is true while a change
+    to the book waits for the next refresh.
+
+    Only the list is cached: favorite, history and note writes mark a book
+    through triggers without invalidating it, so `pending` is read fresh.
+    """
+    response = _similar_list(book_id)
+    if response.status_code != 200:
+        return response
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM SimilarDirty WHERE book_id = ?)", (book_id,))
+    pending = cursor.fetchone()[0]
+    conn.close()
+    fresh = jsonify({**response.get_json(), "pending": bool(pending)})
+    fresh.headers['X-Cache'] = response.headers.get('X-Cache', 'MISS')
+    fresh.add_etag()
+    return fresh.make_conditional(request)
+
+@cached('SimilarBook', 'Book')
+def _similar_list(book_id):
+    limit = request.args.get('limit', SIMILAR_TOP_K, type=int)
+    if not 1 <= limit <= SIMILAR_TOP_K:
+        return jsonify({"message": "無效的分頁參數！"}), 400
+    similar_index.start()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM Book WHERE id = ?", (book_id,))
+    if cursor.fetchone() is None:
+        conn.close()
+        return jsonify({"message": "書籍未找到！"}), 404
+    cursor.execute('''
+        SELECT b.id, b.book_title, b.author, b.category, s.score
+        FROM SimilarBook s JOIN Book b ON b.id = s.similar_id
+        WHERE s.book_id = ? ORDER BY s.rank LIMIT ?
+    ''', (book_id, limit))
+    items = [{"id": row[0], "book_title": row[1], "author": row[2], "category": row[3], "score": round(row[4], 4)}
+             for row in cursor.fetchall()]
+    conn.close()
+    return jsonify({"book_id": book_id, "items": items}), 200
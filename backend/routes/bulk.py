@@ -0,0 +1,38 @@
+from flask import Blueprint, request, jsonify
+from bulk_import import IMPORTERS, InputError, bulk_import, decode_lines, detect_format
+from cache import invalidate
+
+bulk_bp = Blueprint('bulk', __name__)
+
+@bulk_bp.route('/bulk/<kind>', methods=['POST'])
+def bulk(kind):
+    """
+    Bulk import books, authors or history from a CSV or JSONL upload.
+
+    The data can be sent as a multipart `file` field or as the raw request
+    body; the format comes from `?format=`, the file name or the content type.
+    Chunks are committed as they are written: a body that turns out not to be
+    valid UTF-8 gets a 400 naming the row, and the chunks before that row stay
+    imported (their counts are in the response).
+    """
+    if kind not in IMPORTERS:
+        return jsonify({"message": "無效的匯入類型！"}), 400
+    if 'file' in request.files:
+        upload = request.files['file']
+        raw = upload.stream
+        fmt = request.args.get('format') or detect_format(upload.filename, upload.content_type)
+    else:
+        raw = request.stream
+        fmt = request.args.get('format') or detect_format(content_type=request.content_type)
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({"message": "無法判斷檔案格式，請指定 format=csv 或 format=jsonl"}), 400
+
+    try:
+        report = bulk_import(kind, decode_lines(raw), fmt)
+    except InputError as e:
+        if e.report['inserted']:
+            invalidate(IMPORTERS[kind].table)
+        return jsonify({"message": f"第 {e.row} 列無法解碼：{e}", "row": e.row, **e.report}), 400
+    if report['inserted']:
+        invalidate(IMPORTERS[kind].table)
+    return jsonify(report), 200 if report['rejected'] == 0 else 207
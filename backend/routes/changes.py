@@ -0,0 +1,59 @@
+from flask import Blueprint, Response, request, jsonify
+from pool import get_connection
+from config import CHANGE_FEED_BATCH, CHANGE_FEED_KEEPALIVE, MAX_PAGE_SIZE
+from changefeed import change_feed, next_events, parse_feed_args, read_changes
+
+changes_bp = Blueprint('changes', __name__)
+
+
+def _feed_args():
+    return parse_feed_args(request.args.get('since'), request.headers.get('Last-Event-ID'),
+                           request.args.get('tables'))
+
+
+@changes_bp.route('/changes', methods=['GET'])
+def changes():
+    """
+    Changes after `since` as JSON, optionally only for `tables`. Without
+    `since` only the current position is returned, to start from.
+    """
+    try:
+        since, tables = _feed_args()
+        limit = min(int(request.args.get('limit', CHANGE_FEED_BATCH)), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"message": "無效的變更參數！"}), 400
+    if since is None:
+        return jsonify({"changes": [], "last_seq": change_feed.position(), "reset": False}), 200
+    conn = get_connection()
+    items, last_seq, reset = read_changes(conn.cursor(), since, tables, max(limit, 1))
+    conn.close()
+    return jsonify({"changes": items, "last_seq": last_seq, "reset": reset}), 200
+
+
+@changes_bp.route('/changes/stream', methods=['GET'])
+def change_stream():
+    """
+    Server-sent events for every change after Last-Event-ID, which browsers
+    send when reconnecting, or else `since`. Without either the stream
+    starts at the current position.
+    """
+    try:
+        since, tables = _feed_args()
+    except ValueError:
+        return jsonify({"message": "無效的變更參數！"}), 400
+    if since is None:
+        since = change_feed.position()
+
+    def generate():
+        with change_feed.subscription():
+            position = since
+            yield f"retry: 2000\nid: {position}\n\n"
+            while True:
+                text, position = next_events(position, tables)
+                if text:
+                    yield text
+                elif change_feed.wait(position, CHANGE_FEED_KEEPALIVE) <= position:
+                    yield ": keep-alive\n\n"
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
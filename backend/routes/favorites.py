@@ -1,51 +1,46 @@
 from flask import Blueprint, request, jsonify
-import sqlite3
-from config import DATABASE
+from pool import get_connection
+from pagination import paged_response
+from models import FavoriteList
+from cache import cached, invalidate
 
 favorites_bp = Blueprint('favorites', __name__)
 
 @favorites_bp.route('/view_data/favorites', methods=['GET'])
+@cached('FavoriteList')
 def view_favorites():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, book_id, book_title FROM FavoriteList")
-    data = cursor.fetchall()
-    conn.close()
-    result = [{
-        "id": item[0],
-        "book_id": item[1],
-        "book_title": item[2]
-    } for item in data]
-    return jsonify(result)
+    return paged_response(FavoriteList)
 
 @favorites_bp.route('/add_favorite', methods=['POST'])
 def add_favorite():
     data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     
-    # Check if the book is already in the favorites list
-    cursor.execute("SELECT * FROM FavoriteList WHERE book_id = ?", (data['book_id'],))
-    existing_favorite = cursor.fetchone()
-    if existing_favorite:
+    # Insert with the book's title unless it is already a favorite
+    cursor.execute('''
+        INSERT INTO FavoriteList (book_id, book_title)
+        SELECT id, book_title FROM Book
+        WHERE id = ? AND NOT EXISTS (SELECT 1 FROM FavoriteList WHERE book_id = ?)
+    ''', (data['book_id'], data['book_id']))
+    if cursor.rowcount == 0:
+        cursor.execute("SELECT 1 FROM FavoriteList WHERE book_id = ?", (data['book_id'],))
+        existing_favorite = cursor.fetchone()
         conn.close()
-        return jsonify({"message": "該書籍已在我的最愛中！"}), 400
-
-    # Get the book title from the Book table
-    cursor.execute("SELECT book_title FROM Book WHERE id = ?", (data['book_id'],))
-    book_title = cursor.fetchone()[0]
-    
-    # Insert into favorites
-    cursor.execute("INSERT INTO FavoriteList (book_id, book_title) VALUES (?, ?)", (data['book_id'], book_title))
+        if existing_favorite:
+            return jsonify({"message": "該書籍已在我的最愛中！"}), 400
+        return jsonify({"message": "書籍ID不存在！"}), 404
     conn.commit()
     conn.close()
+    invalidate('FavoriteList', cursor.lastrowid)
     return jsonify({"message": "書籍已加入我的最愛！"}), 201
 
 @favorites_bp.route('/delete_favorite/<int:book_id>', methods=['DELETE'])
 def delete_favorite(book_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM FavoriteList WHERE book_id = ?", (book_id,))
     conn.commit()
     conn.close()
+    invalidate('FavoriteList')
     return jsonify({"message": "書籍已從我的最愛中移除！"}), 200
\ No newline at end of file
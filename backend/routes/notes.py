@@ -1,48 +1,120 @@
 from flask import Blueprint, request, jsonify, render_template
-import sqlite3
 from datetime import datetime
-from config import DATABASE
+from pool import get_connection
+from cache import cached, invalidate
+from config import MAX_PAGE_SIZE, NOTE_PAGE_SIZE
+from models import Note, NoteDetail, fetch_all, fetch_one
+from note_bodies import note_values
 
 notes_bp = Blueprint('notes', __name__)
 
+
+def parse_note_cursor(value):
+    """
+    Read a note list position, "<updated_at>,<id>". Raises ValueError.
+    """
+    updated_at, note_id = value.rsplit(',', 1)
+    return updated_at, int(note_id)
+
+
+def list_notes(cursor, book_id, limit, after=None):
+    """
+    One page of a book's notes, most recently updated first, walked on the
+    (book_id, updated_at, id) index. Returns (notes, next_after).
+    """
+    where = "WHERE book_id = ?"
+    params = [book_id]
+    if after is not None:
+        where += " AND (updated_at, id) < (?, ?)"
+        params.extend(after)
+    params.append(limit + 1)
+    notes = fetch_all(cursor, Note, f"{where} ORDER BY updated_at DESC, id DESC LIMIT ?", params)
+    next_after = None
+    if len(notes) > limit:
+        notes = notes[:limit]
+        next_after = f"{notes[-1].updated_at},{notes[-1].id}"
+    return notes, next_after
+
+
 @notes_bp.route('/notes/<int:book_id>', methods=['GET'])
 def view_notes(book_id):
-    conn = sqlite3.connect(DATABASE)
+    """
+    The notes page renders only the first page of snippets; the rest and
+    full bodies are fetched by the page as needed.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT book_title FROM Book WHERE id = ?", (book_id,))
-    book_title = cursor.fetchone()[0]
-    cursor.execute("SELECT * FROM Note WHERE book_id = ?", (book_id,))
-    notes = cursor.fetchall()
+    book = cursor.fetchone()
+    if book is None:
+        conn.close()
+        return jsonify({"message": "書籍未找到！"}), 404
+    notes, next_after = list_notes(cursor, book_id, NOTE_PAGE_SIZE)
+    conn.close()
+    return render_template('notes.html', book_id=book_id, book_title=book[0], notes=notes,
+                           next_after=next_after)
+
+@notes_bp.route('/notes/<int:book_id>/list', methods=['GET'])
+@cached('Note')
+def note_list(book_id):
+    """
+    ?limit=N&after=<next_after>: {"items": [...], "next_after": str|null},
+    items without their bodies.
+    """
+    try:
+        limit = min(int(request.args.get('limit', NOTE_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        after = request.args.get('after')
+        after = parse_note_cursor(after) if after else None
+    except ValueError:
+        return jsonify({"message": "無效的分頁參數！"}), 400
+    conn = get_connection()
+    notes, next_after = list_notes(conn.cursor(), book_id, limit, after)
+    conn.close()
+    return jsonify({"items": notes, "next_after": next_after})
+
+@notes_bp.route('/note/<int:note_id>', methods=['GET'])
+@cached(rows=lambda note_id: [('Note', note_id)])
+def get_note(note_id):
+    conn = get_connection()
+    note = fetch_one(conn.cursor(), NoteDetail, "WHERE id = ?", (note_id,))
     conn.close()
-    return render_template('notes.html', book_id=book_id, book_title=book_title, notes=notes)
+    if note:
+        return jsonify(note)
+    else:
+        return jsonify({"message": "筆記不存在！"}), 404
 
 @notes_bp.route('/delete_note/<int:note_id>', methods=['DELETE'])
 def delete_note(note_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM Note WHERE id = ?", (note_id,))
     conn.commit()
     conn.close()
+    invalidate('Note', note_id)
     return jsonify({"message": "筆記已刪除！"}), 200
 
 @notes_bp.route('/add_note', methods=['POST'])
 def add_note():
     data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO Note (book_id, title, content, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
-                   (data['book_id'], data['title'], data['content'], datetime.utcnow().isoformat(), datetime.utcnow().isoformat()))
+    cursor.execute("INSERT INTO Note (book_id, title, body, snippet, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                   (data['book_id'], data['title'], *note_values(data['content']), datetime.utcnow().isoformat(), datetime.utcnow().isoformat()))
     conn.commit()
     conn.close()
+    invalidate('Note', cursor.lastrowid)
     return jsonify({"message": "筆記已新增！"}), 201
 
 @notes_bp.route('/update_note', methods=['PUT'])
 def update_note():
     data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE Note SET title = ?, content = ?, updated_at = ? WHERE id = ?",
-                   (data['title'], data['content'], datetime.utcnow().isoformat(), data['id']))
+    cursor.execute("UPDATE Note SET title = ?, body = ?, snippet = ?, updated_at = ? WHERE id = ?",
+                   (data['title'], *note_values(data['content']), datetime.utcnow().isoformat(), data['id']))
     conn.commit()
     conn.close()
+    invalidate('Note', data['id'])
     return jsonify({"message": "筆記已更新！"}), 200
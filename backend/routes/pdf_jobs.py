@@ -0,0 +1,56 @@
+from flask import Blueprint, jsonify
+from pool import get_connection
+from pdf_jobs import pdf_pipeline
+from pdf_store import send_file_conditional
+
+pdf_jobs_bp = Blueprint('pdf_jobs', __name__)
+
+JOB_COLUMNS = ['id', 'book_id', 'status', 'progress', 'page_count', 'error', 'created_at', 'updated_at']
+
+def _job_response(job):
+    if job is None:
+        return jsonify({"message": "找不到處理工作！"}), 404
+    return jsonify(dict(zip(JOB_COLUMNS, job))), 200
+
+@pdf_jobs_bp.route('/pdf_jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Status and progress of a PDF processing job.
+    """
+    pdf_pipeline.start()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM PdfJob WHERE id = ?", (job_id,))
+    job = cursor.fetchone()
+    conn.close()
+    return _job_response(job)
+
+@pdf_jobs_bp.route('/pdf_jobs/book/<int:book_id>', methods=['GET'])
+def get_book_job(book_id):
+    """
+    Latest PDF processing job for a book.
+    """
+    pdf_pipeline.start()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM PdfJob WHERE book_id = ? ORDER BY id DESC LIMIT 1", (book_id,))
+    job = cursor.fetchone()
+    conn.close()
+    return _job_response(job)
+
+@pdf_jobs_bp.route('/thumbnail/<int:book_id>', methods=['GET'])
+def thumbnail(book_id):
+    """
+    First-page thumbnail of a book's PDF.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT thumbnail_path FROM PdfInfo WHERE book_id = ?", (book_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if row and row[0]:
+        try:
+            return send_file_conditional(row[0], 'image/png')
+        except FileNotFoundError:
+            pass
+    return jsonify({"message": "縮圖不存在"}), 404
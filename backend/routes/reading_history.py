@@ -1,12 +1,9 @@
 from flask import Blueprint, request, jsonify
-import sqlite3
 from datetime import datetime
-from config import DATABASE
-def get_book_ids():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM Book")
-    return [id[0] for id in cursor.fetchall()]
+from pool import get_connection
+from cache import invalidate
+from config import WRITE_BEHIND
+from write_behind import book_ids, parse_book_id, parse_page, write_behind
 
 
 history_bp = Blueprint('history', __name__)
@@ -14,27 +11,43 @@ history_bp = Blueprint('history', __name__)
 @history_bp.route('/add_history', methods=['POST'])
 def add_history():
     data = request.get_json()
-    if data['book_id'].strip() == '':
+    if str(data.get('book_id', '')).strip() == '':
         return jsonify({"message": "書籍ID不得空白！"}), 200
-    if not int(data['book_id']) in get_book_ids():
+    try:
+        book_id = parse_book_id(data['book_id'])
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    if not book_id in book_ids:
         return jsonify({"message": "書籍ID不存在！"}), 201
-    if data['bookpage'].strip() == '':
+    if str(data.get('bookpage', '')).strip() == '':
         return jsonify({"message": "書頁不得空白！"}), 200
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
-    timestamp = datetime.now().strftime('%Y-%m-%d') 
+    try:
+        bookpage = parse_page(cursor, book_id, data['bookpage'])
+    except ValueError as e:
+        conn.close()
+        return jsonify({"message": str(e)}), 400
+    timestamp = datetime.now().strftime('%Y-%m-%d')
+    note = data.get('note') or ''
+    if WRITE_BEHIND and not conn.in_held_transaction:
+        conn.close()
+        write_behind.add_history(timestamp, book_id, bookpage, note)
+        return jsonify({"message": "閱讀歷史新增成功！"}), 201
     cursor.execute("INSERT INTO ReadingHistory (time_stamp, book_id, bookpage, note) VALUES (?, ?, ?, ?)",
-                   (timestamp, data['book_id'], data['bookpage'], data['note']))
+                   (timestamp, book_id, bookpage, note))
     conn.commit()
     conn.close()
+    invalidate('ReadingHistory', cursor.lastrowid)
     return jsonify({"message": "閱讀歷史新增成功！"}), 201
 
 
 @history_bp.route('/delete_history/<int:history_id>', methods=['DELETE'])
 def delete_history(history_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM ReadingHistory WHERE id = ?", (history_id,))
     conn.commit()
     conn.close()
+    invalidate('ReadingHistory', history_id)
     return jsonify({"message": "閱讀歷史刪除成功！"}), 200
\ No newline at end of file
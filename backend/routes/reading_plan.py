@@ -1,13 +1,18 @@
+import math
+import time
 from flask import Blueprint, request, jsonify
-import sqlite3
-from config import DATABASE
+from pool import get_connection
+from cache import invalidate
+from config import MAX_PAGE_SIZE, PLAN_DUE_WITHIN_DAYS
+from plans import due_plans, plan_scheduler
 
 plan_bp = Blueprint('plan', __name__)
 
 @plan_bp.route('/add_plan', methods=['POST'])
 def add_plan():
     data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
+    plan_scheduler.start()
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("SELECT * FROM ReadingPlan WHERE book_id = ?", (data['book_id'],))
@@ -20,6 +25,7 @@ def add_plan():
         )
         conn.commit()
         conn.close()
+        invalidate('ReadingPlan', existing_plan[0])
         return jsonify({"message": "閱讀計劃已更新！"}), 200
     else:
         cursor.execute(
@@ -28,13 +34,37 @@ def add_plan():
         )
         conn.commit()
         conn.close()
+        invalidate('ReadingPlan', cursor.lastrowid)
         return jsonify({"message": "閱讀計劃新增成功！"}), 201
 
 @plan_bp.route('/delete_plan/<int:plan_id>', methods=['DELETE'])
 def delete_plan(plan_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM ReadingPlan WHERE id = ?", (plan_id,))
     conn.commit()
     conn.close()
-    return jsonify({"message": "閱讀計劃刪除成功！"}), 200
\ No newline at end of file
+    invalidate('ReadingPlan', plan_id)
+    return jsonify({"message": "閱讀計劃刪除成功！"}), 200
+
+@plan_bp.route('/plans/due', methods=['GET'])
+def plans_due():
+    """
+    Incomplete plans due within `within` days, soonest first, including
+    overdue ones unless `overdue=0`. Served from the partial due_at index,
+    so the cost follows the number of plans returned.
+    """
+    try:
+        within = float(request.args.get('within', PLAN_DUE_WITHIN_DAYS))
+        limit = int(request.args.get('limit', MAX_PAGE_SIZE))
+        if not math.isfinite(within) or within < 0 or limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({"message": "無效的期限參數！"}), 400
+    plan_scheduler.start()
+    now = int(time.time())
+    conn = get_connection()
+    items = due_plans(conn.cursor(), now, int(within * 86400), request.args.get('overdue', '1') != '0',
+                      min(limit, MAX_PAGE_SIZE))
+    conn.close()
+    return jsonify({"now": now, "items": items}), 200
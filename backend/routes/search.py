@@ -1,111 +1,103 @@
 from flask import Blueprint, request, jsonify
-import sqlite3
-from config import DATABASE
+from pool import get_connection
+from pagination import paged_response
+from cache import cached
+from config import MAX_PAGE_SIZE
+from models import Book, ReadingHistory, ReadingPlan, fetch_all, fetch_one
+import search_index
 
 search_bp = Blueprint('search', __name__)
 
 @search_bp.route('/search_by_category', methods=['GET'])
+@cached('Book')
 def search_by_category():
     category = request.args.get('category')
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Book WHERE category = ?", (category,))
-    books = cursor.fetchall()
+    conn = get_connection()
+    books = fetch_all(conn.cursor(), Book, "WHERE category = ?", (category,))
     conn.close()
-    return jsonify([{
-        "id": book[0],
-        "ISBN": book[1],
-        "book_title": book[2],
-        "author": book[3],
-        "price": book[4],
-        "category": book[5],
-        "edition": book[6],
-        "current_page": book[7]
-    } for book in books])
+    return jsonify(books)
 
 @search_bp.route('/search_book/<int:book_id>', methods=['GET'])
+@cached(rows=lambda book_id: [('Book', book_id)])
 def search_book(book_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Book WHERE id = ?", (book_id,))
-    book = cursor.fetchone()
+    conn = get_connection()
+    book = fetch_one(conn.cursor(), Book, "WHERE id = ?", (book_id,))
     conn.close()
     if book:
-        result = {
-            "id": book[0],
-            "ISBN": book[1],
-            "book_title": book[2],
-            "author": book[3],
-            "price": book[4],
-            "category": book[5],
-            "edition": book[6],
-            "current_page": book[7]
-        }
-        return jsonify(result)
+        return jsonify(book)
     else:
         return jsonify({"message": "書籍未找到！"}), 404
 
 @search_bp.route('/search_id_by_book_title/<string:book_title>', methods=['GET'])
+@cached('Book')
 def search_id_by_book_title(book_title):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Book WHERE book_title = ?", (book_title,))
-    book = cursor.fetchone()
+    conn = get_connection()
+    book = fetch_one(conn.cursor(), Book, "WHERE book_title = ?", (book_title,))
     conn.close()
     if book:
-        result = {
-            "id": book[0],
-            "ISBN": book[1],
-            "book_title": book[2],
-            "author": book[3],
-            "price": book[4],
-            "category": book[5],
-            "edition": book[6],
-            "current_page": book[7]
-        }
-        return jsonify(result)
+        return jsonify(book)
     else:
         return jsonify({"message": "書籍未找到！"}), 404
 
 
+@search_bp.route('/search', methods=['GET'])
+@cached('Book', 'Author', 'Note', 'PdfPage')
+def search():
+    """
+    Full-text search over book titles/authors/categories, author introductions,
+    notes and PDF page text, ranked by relevance.
+
+    Query parameters: q, type (comma-separated book/author/note/page), limit, offset.
+    """
+    query = request.args.get('q', '')
+    kinds = [k for k in request.args.get('type', '').split(',') if k]
+    if any(k not in search_index.KIND_CODES for k in kinds):
+        return jsonify({"message": "無效的搜尋類型！"}), 400
+    try:
+        limit = min(int(request.args.get('limit', 20)), MAX_PAGE_SIZE)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"message": "無效的分頁參數！"}), 400
+    if limit <= 0 or offset < 0:
+        return jsonify({"message": "無效的分頁參數！"}), 400
+    conn = get_connection()
+    cursor = conn.cursor()
+    items, next_offset = search_index.search(cursor, query, kinds, limit, offset)
+    conn.close()
+    return jsonify({"items": items, "next_offset": next_offset})
+
+@search_bp.route('/search_by_name', methods=['GET'])
+@cached('Book')
+def search_by_name():
+    """
+    Search books whose title, author or category matches `name`.
+    """
+    name = request.args.get('name', '')
+    conn = get_connection()
+    cursor = conn.cursor()
+    items, _ = search_index.search(cursor, name, ['book'], MAX_PAGE_SIZE)
+    ids = [item['id'] for item in items]
+    books = {}
+    if ids:
+        books = {book.id: book for book in
+                 fetch_all(cursor, Book, f"WHERE id IN ({', '.join('?' for _ in ids)})", ids)}
+    conn.close()
+    return jsonify([books[i] for i in ids if i in books])
+
+
+VIEW_TABLES = {
+    'books': Book,
+    'history': ReadingHistory,
+    'plan': ReadingPlan
+}
+
 @search_bp.route('/view_data/<table>', methods=['GET'])
+@cached(rows=lambda table: [(VIEW_TABLES[table].TABLE, None)] if table in VIEW_TABLES else [])
 def view_data(table):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    if table == 'books':
-        cursor.execute("SELECT * FROM Book")
-        data = cursor.fetchall()
-        result = [{
-            "id": item[0],
-            "ISBN": item[1],
-            "book_title": item[2],
-            "author": item[3],
-            "price": item[4],
-            "category": item[5],
-            "edition": item[6],
-            "current_page": item[7]
-        } for item in data]
-    elif table == 'history':
-        cursor.execute("SELECT * FROM ReadingHistory")
-        data = cursor.fetchall()
-        result = [{
-            "id": item[0],
-            "time_stamp": item[1],
-            "book_id": item[2],
-            "bookpage": item[3],
-            "note": item[4]
-        } for item in data]
-    elif table == 'plan':
-        cursor.execute("SELECT * FROM ReadingPlan")
-        data = cursor.fetchall()
-        result = [{
-            "id": item[0],
-            "book_id": item[1],
-            "expired_date": item[2],
-            "is_complete": item[3]
-        } for item in data]
-    else:
-        conn.close()
+    """
+    View data from the specified table, keyset-paginated on id.
+    See pagination.paged_response for the supported query parameters.
+    """
+    if table not in VIEW_TABLES:
         return jsonify({"message": "無效的表格名稱！"}), 400
-    conn.close()
-    return jsonify(result)
\ No newline at end of file
+    return paged_response(VIEW_TABLES[table])
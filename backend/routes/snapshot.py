@@ -0,0 +1,30 @@
+import os
+from datetime import datetime
+from flask import Blueprint, Response, jsonify
+from config import BACKUP_FOLDER
+from snapshot import export_stream, backup_database
+from tenants import storage_path
+
+snapshot_bp = Blueprint('snapshot', __name__)
+
+@snapshot_bp.route('/export', methods=['GET'])
+def export():
+    """
+    Stream a consistent columnar snapshot of the six user tables.
+    """
+    filename = f"library-{datetime.now().strftime('%Y%m%d-%H%M%S')}.lsnap"
+    return Response(export_stream(), mimetype='application/octet-stream',
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@snapshot_bp.route('/backup', methods=['POST'])
+def backup():
+    """
+    Write an online SQLite backup into the library's BACKUP_FOLDER without
+    blocking writers.
+    """
+    folder = storage_path(BACKUP_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    # Microseconds keep backups taken in the same second apart
+    filename = f"library-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.db"
+    size = backup_database(os.path.join(folder, filename))
+    return jsonify({"message": "備份完成！", "filename": filename, "bytes": size}), 201
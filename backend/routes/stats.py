@@ -0,0 +1,61 @@
+from flask import Blueprint, request, jsonify
+from pool import get_connection
+from config import MAX_PAGE_SIZE
+from stats import DIMS, rollup, totals, streaks, plan_progress
+
+stats_bp = Blueprint('stats', __name__)
+
+GRAIN_NAMES = {'daily': 'day', 'weekly': 'week'}
+
+@stats_bp.route('/stats/<grain>', methods=['GET'])
+def stats_rollup(grain):
+    """
+    Daily or weekly sessions and pages for one book, category, author or
+    everything (`dim`, `key`), newest first, optionally within `from`/`to`.
+    """
+    dim = request.args.get('dim', 'all')
+    key = request.args.get('key', '')
+    limit = request.args.get('limit', 366, type=int)
+    if grain not in GRAIN_NAMES or dim not in DIMS or not limit or limit < 1:
+        return jsonify({"message": "無效的統計參數！"}), 400
+    conn = get_connection()
+    rows = rollup(conn.cursor(), GRAIN_NAMES[grain], dim, key,
+                  request.args.get('from'), request.args.get('to'), min(limit, MAX_PAGE_SIZE))
+    conn.close()
+    return jsonify({"dim": dim, "key": key, "grain": grain, "items": rows}), 200
+
+@stats_bp.route('/stats/totals', methods=['GET'])
+def stats_totals():
+    """
+    All-time sessions and pages per book, category or author.
+    """
+    dim = request.args.get('dim', 'category')
+    limit = request.args.get('limit', 100, type=int)
+    if dim not in DIMS or not limit or limit < 1:
+        return jsonify({"message": "無效的統計參數！"}), 400
+    conn = get_connection()
+    rows = totals(conn.cursor(), dim, request.args.get('key'), min(limit, MAX_PAGE_SIZE))
+    conn.close()
+    return jsonify({"dim": dim, "items": rows}), 200
+
+@stats_bp.route('/stats/streak', methods=['GET'])
+def stats_streak():
+    """
+    Current and longest reading streak in days.
+    """
+    conn = get_connection()
+    result = streaks(conn.cursor())
+    conn.close()
+    return jsonify(result), 200
+
+@stats_bp.route('/stats/plan/<int:plan_id>', methods=['GET'])
+def stats_plan(plan_id):
+    """
+    Progress of a reading plan toward its expired date.
+    """
+    conn = get_connection()
+    result = plan_progress(conn.cursor(), plan_id)
+    conn.close()
+    if result is None:
+        return jsonify({"message": "閱讀計畫不存在！"}), 404
+    return jsonify(result), 200
@@ -0,0 +1,93 @@
+from flask import Blueprint, Response, current_app, jsonify, request
+from pool import current_pool
+from cache import response_cache
+from profiling import profiler, prometheus_text
+from write_behind import write_behind
+from pdf_store import blob_store
+from plans import plan_scheduler
+from similar import similar_index
+from tenants import tenant_router
+
+system_bp = Blueprint('system', __name__)
+
+@system_bp.route('/metrics/pool', methods=['GET'])
+def pool_metrics():
+    """
+    Report connection pool usage: checkouts, wait time and in-use count.
+    """
+    return jsonify(current_pool().metrics()), 200
+
+@system_bp.route('/metrics/tenants', methods=['GET'])
+def tenant_metrics():
+    """
+    Report open libraries, their connections and LRU evictions.
+    """
+    return jsonify(tenant_router.metrics()), 200
+
+@system_bp.route('/metrics/cache', methods=['GET'])
+def cache_metrics():
+    """
+    Report response cache hits, misses, evictions and size.
+    """
+    return jsonify(response_cache.metrics()), 200
+
+@system_bp.route('/metrics/write_behind', methods=['GET'])
+def write_behind_metrics():
+    """
+    Report buffered page turns, flushes and coalesced updates.
+    """
+    return jsonify(write_behind.metrics()), 200
+
+@system_bp.route('/metrics/pdf_store', methods=['GET'])
+def pdf_store_metrics():
+    """
+    Report stored PDF blobs, deduplicated uploads and garbage collection.
+    """
+    return jsonify(blob_store.metrics()), 200
+
+@system_bp.route('/metrics/similar', methods=['GET'])
+def similar_metrics():
+    """
+    Report books waiting for the similar books refresh and refresh timings.
+    """
+    return jsonify(similar_index.metrics()), 200
+
+@system_bp.route('/metrics/plans', methods=['GET'])
+def plan_metrics():
+    """
+    Report scheduled plan deadlines and fired or dropped events.
+    """
+    return jsonify(plan_scheduler.metrics()), 200
+
+@system_bp.route('/metrics/queries', methods=['GET'])
+def query_metrics():
+    """
+    Report the most expensive SQL statements and the slow query log with plans.
+    """
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({"statements": profiler.statements(limit), "slow_queries": profiler.slow_queries()}), 200
+
+@system_bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Expose per-route timing histograms, SQL statement counters, pool,
+    library, cache, write-behind, PDF store, similar books, plan scheduler
+    and startup gauges in Prometheus text format.
+    """
+    gauges = [(f"library_pool_{name}", f"Connection pool {name.replace('_', ' ')}.", value)
+              for name, value in current_pool().metrics().items()]
+    gauges += [(f"library_tenants_{name}", f"Libraries {name.replace('_', ' ')}.", value)
+               for name, value in tenant_router.metrics().items()]
+    gauges += [(f"library_cache_{name}", f"Response cache {name.replace('_', ' ')}.", value)
+               for name, value in response_cache.metrics().items() if isinstance(value, (int, float))]
+    gauges += [(f"library_write_behind_{name}", f"Write-behind {name.replace('_', ' ')}.", value)
+               for name, value in write_behind.metrics().items()]
+    gauges += [(f"library_pdf_store_{name}", f"PDF store {name.replace('_', ' ')}.", value)
+               for name, value in blob_store.metrics().items()]
+    gauges += [(f"library_similar_{name}", f"Similar books {name.replace('_', ' ')}.", int(value) if isinstance(value, bool) else value)
+               for name, value in similar_index.metrics().items()]
+    gauges += [(f"library_plans_{name}", f"Plan scheduler {name.replace('_', ' ')}.", value)
+               for name, value in plan_scheduler.metrics().items()]
+    gauges += [(f"library_startup_{name}_seconds", f"Seconds spent in {name.replace('_', ' ')} at startup.", value)
+               for name, value in current_app.config.get('STARTUP_TIMINGS', {}).items()]
+    return Response(prometheus_text(gauges), mimetype='text/plain; version=0.0.4'), 200
@@ -0,0 +1,326 @@
+"""
+Full-text search over books, authors and notes.
+
+All three sources are kept in one FTS5 table, SearchIndex, maintained by
+triggers. Each source row maps to a fixed rowid (ref_id * 4 + kind code) so
+the triggers can update or delete its index entry without scanning.
+
+Text extracted from uploaded PDFs (PdfPage, see pdf_jobs.py) is indexed
+too, with kind 'page', the page number as ref_id and code 0 in the rowid.
+
+The trigram tokenizer is used because it does not depend on whitespace:
+CJK titles such as 紅樓夢 match on any substring, and English terms match
+on prefixes as well. Terms shorter than three characters, which includes
+most CJK words (世界, 歷史), cannot be served by trigrams. They go to
+SearchGrams, a second FTS5 table over the same rowids whose text is
+rewritten by search_grams(): each run of CJK characters becomes its single
+characters and overlapping pairs, so the unicode61 tokenizer indexes one-
+and two-character words, while other words are kept as they are. It is
+contentless, so its triggers hand it the old text to remove an entry. Only
+a short term with no letters or digits falls back to a substring check.
+"""
+import re
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_CJK_RUN = re.compile(f'[{_CJK}]+')
+_GRAM_TERM = re.compile(f'([{_CJK}]+)|(\\w+)')
+
+KIND_CODES = {'page': 0, 'book': 1, 'author': 2, 'note': 3}
+
+SEARCH_INDEX_DDL = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS SearchIndex USING fts5(
+        kind UNINDEXED,
+        ref_id UNINDEXED,
+        book_id UNINDEXED,
+        title,
+        body,
+        tokenize = 'trigram'
+    )
+    ''',
+    # Book: title, author and category
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_book_ai AFTER INSERT ON Book BEGIN
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4 + 1, 'book', new.id, new.id, new.book_title,
+                coalesce(new.author, '') || ' ' || coalesce(new.category, ''));
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_book_ad AFTER DELETE ON Book BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id * 4 + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_book_au AFTER UPDATE OF id, book_title, author, category ON Book BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id * 4 + 1;
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4 + 1, 'book', new.id, new.id, new.book_title,
+                coalesce(new.author, '') || ' ' || coalesce(new.category, ''));
+    END
+    ''',
+    # Author: name and introduction
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_author_ai AFTER INSERT ON Author BEGIN
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.author_id * 4 + 2, 'author', new.author_id, NULL, new.author_name, new.introduction);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_author_ad AFTER DELETE ON Author BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.author_id * 4 + 2;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_author_au AFTER UPDATE OF author_id, author_name, introduction ON Author BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.author_id * 4 + 2;
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.author_id * 4 + 2, 'author', new.author_id, NULL, new.author_name, new.introduction);
+    END
+    ''',
+    # Note: title and content (replaced by NOTE_BODY_TRIGGERS from schema version 5)
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_note_ai AFTER INSERT ON Note BEGIN
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4 + 3, 'note', new.id, new.book_id, new.title, new.content);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_note_ad AFTER DELETE ON Note BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id * 4 + 3;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_note_au AFTER UPDATE OF id, book_id, title, content ON Note BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id * 4 + 3;
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4 + 3, 'note', new.id, new.book_id, new.title, new.content);
+    END
+    ''',
+    # PdfPage: extracted page text
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_page_ai AFTER INSERT ON PdfPage BEGIN
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4, 'page', new.page_no, new.book_id, NULL, new.text);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS search_page_ad AFTER DELETE ON PdfPage BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id * 4;
+    END
+    '''
+]
+
+
+# Note triggers once the text is stored compressed in Note.body (see note_bodies.py)
+NOTE_BODY_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS search_note_ai",
+    "DROP TRIGGER IF EXISTS search_note_au",
+    '''
+    CREATE TRIGGER search_note_ai AFTER INSERT ON Note BEGIN
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4 + 3, 'note', new.id, new.book_id, new.title, note_text(new.body));
+    END
+    ''',
+    '''
+    CREATE TRIGGER search_note_au AFTER UPDATE OF id, book_id, title, body ON Note BEGIN
+        DELETE FROM SearchIndex WHERE rowid = old.id * 4 + 3;
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        VALUES (new.id * 4 + 3, 'note', new.id, new.book_id, new.title, note_text(new.body));
+    END
+    '''
+]
+
+
+def _gram_triggers():
+    # (name, table, columns whose update re-indexes, rowid, title, body) as in SEARCH_INDEX_DDL
+    sources = [
+        ('book', 'Book', 'id, book_title, author, category', '{r}.id * 4 + 1', '{r}.book_title',
+         "coalesce({r}.author, '') || ' ' || coalesce({r}.category, '')"),
+        ('author', 'Author', 'author_id, author_name, introduction', '{r}.author_id * 4 + 2', '{r}.author_name',
+         '{r}.introduction'),
+        ('note', 'Note', 'id, book_id, title, body', '{r}.id * 4 + 3', '{r}.title', 'note_text({r}.body)'),
+        ('page', 'PdfPage', None, '{r}.id * 4', 'NULL', '{r}.text')
+    ]
+    for name, table, columns, rowid, title, body in sources:
+        def values(row):
+            return (f"{rowid.format(r=row)}, search_grams({title.format(r=row)}), "
+                    f"search_grams({body.format(r=row)})")
+        insert = f"INSERT INTO SearchGrams (rowid, title, body) VALUES ({values('new')});"
+        delete = f"INSERT INTO SearchGrams (SearchGrams, rowid, title, body) VALUES ('delete', {values('old')});"
+        yield f"CREATE TRIGGER IF NOT EXISTS grams_{name}_ai AFTER INSERT ON {table} BEGIN {insert} END"
+        yield f"CREATE TRIGGER IF NOT EXISTS grams_{name}_ad AFTER DELETE ON {table} BEGIN {delete} END"
+        if columns:
+            yield f"CREATE TRIGGER IF NOT EXISTS grams_{name}_au AFTER UPDATE OF {columns} ON {table} BEGIN {delete} {insert} END"
+
+
+# Short-term index (schema version 9); the note triggers need Note.body
+SEARCH_GRAMS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS SearchGrams USING fts5(title, body, content = '', tokenize = 'unicode61')",
+    *_gram_triggers()
+]
+
+
+def search_grams(text):
+    """
+    `text` with each run of CJK characters replaced by its characters and
+    overlapping pairs: 紅樓夢 becomes 紅 樓 夢 紅樓 樓夢.
+    """
+    if text is None:
+        return None
+
+    def grams(match):
+        run = match.group()
+        return ' ' + ' '.join([*run, *(run[i:i + 2] for i in range(len(run) - 1))]) + ' '
+    return _CJK_RUN.sub(grams, text)
+
+
+def create_search_grams(cursor):
+    """
+    Create SearchGrams and its triggers, filling it from SearchIndex, which
+    holds the same text, the first time it is created.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'SearchGrams'")
+    exists = cursor.fetchone() is not None
+    for statement in SEARCH_GRAMS_DDL:
+        cursor.execute(statement)
+    if not exists:
+        cursor.execute('''
+            INSERT INTO SearchGrams (rowid, title, body)
+            SELECT rowid, search_grams(title), search_grams(body) FROM SearchIndex
+        ''')
+
+
+def create_search_index(cursor):
+    """
+    Create the index and its triggers, populating it from existing rows the
+    first time it is created.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'SearchIndex'")
+    exists = cursor.fetchone() is not None
+    for statement in SEARCH_INDEX_DDL:
+        cursor.execute(statement)
+    if not exists:
+        rebuild_search_index(cursor)
+
+
+def rebuild_search_index(cursor):
+    """
+    Repopulate SearchIndex from the Book, Author, Note and PdfPage tables.
+    """
+    cursor.execute("DELETE FROM SearchIndex")
+    cursor.execute('''
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        SELECT id * 4 + 1, 'book', id, id, book_title, coalesce(author, '') || ' ' || coalesce(category, '')
+        FROM Book
+    ''')
+    cursor.execute('''
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        SELECT author_id * 4 + 2, 'author', author_id, NULL, author_name, introduction
+        FROM Author
+    ''')
+    cursor.execute("SELECT 1 FROM pragma_table_info('Note') WHERE name = 'body'")
+    note_body = 'note_text(body)' if cursor.fetchone() else 'content'
+    cursor.execute(f'''
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        SELECT id * 4 + 3, 'note', id, book_id, title, {note_body}
+        FROM Note
+    ''')
+    cursor.execute('''
+        INSERT INTO SearchIndex (rowid, kind, ref_id, book_id, title, body)
+        SELECT id * 4, 'page', page_no, book_id, NULL, text
+        FROM PdfPage
+    ''')
+
+
+def _phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _gram_query(term):
+    """
+    SearchGrams MATCH expression for a short term, or None if it has no
+    letters or digits: each CJK run is one token, other words are prefixes.
+    """
+    parts = [_phrase(cjk) if cjk else _phrase(word) + '*' for cjk, word in _GRAM_TERM.findall(term)]
+    return ' '.join(parts) or None
+
+
+def build_search_query(query, kinds=None):
+    """
+    Translate a user query into (sql, params) selecting kind, ref_id,
+    book_id, title, snippet and score, best first.
+
+    Every whitespace-separated term must match. Terms of three or more
+    characters go to the trigram MATCH expression and shorter ones to
+    SearchGrams; rows are ranked by bm25 of the trigram match if there is
+    one and of the SearchGrams match otherwise.
+    """
+    terms = query.split()
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = []
+    loose_terms = []
+    for term in terms:
+        if len(term) < 3:
+            expression = _gram_query(term)
+            if expression:
+                short_terms.append((term, expression))
+            else:
+                loose_terms.append(term)
+
+    clauses = []
+    params = []
+    if long_terms:
+        clauses.append("SearchIndex MATCH ?")
+        params.append(' '.join(_phrase(t) for t in long_terms))
+    if short_terms:
+        if long_terms:
+            clauses.append("SearchIndex.rowid IN (SELECT rowid FROM SearchGrams WHERE SearchGrams MATCH ?)")
+        else:
+            clauses.append("SearchGrams MATCH ?")
+        params.append(' '.join(expression for _, expression in short_terms))
+    for term in loose_terms:
+        clauses.append("(instr(lower(SearchIndex.title), lower(?)) > 0 OR instr(lower(SearchIndex.body), lower(?)) > 0)")
+        params.extend([term, term])
+    if kinds:
+        clauses.append(f"kind IN ({', '.join('?' for _ in kinds)})")
+        params.extend(kinds)
+    where = ' AND '.join(clauses)
+
+    columns = "kind, ref_id, book_id, SearchIndex.title"
+    if long_terms:
+        rank = "bm25(SearchIndex, 0, 0, 0, 10.0, 1.0)"
+        return (f"SELECT {columns}, snippet(SearchIndex, 4, '[', ']', '…', 10), {rank} "
+                f"FROM SearchIndex WHERE {where} ORDER BY {rank}", params)
+    if short_terms:
+        # SearchGrams holds no text, so the snippet is cut around the first
+        # term in the body; CROSS JOIN keeps the MATCH on the outer table
+        rank = "bm25(SearchGrams, 10.0, 1.0)"
+        snippet = "substr(SearchIndex.body, max(instr(lower(SearchIndex.body), lower(?)) - 20, 1), 64)"
+        return (f"SELECT {columns}, {snippet}, {rank} "
+                f"FROM SearchGrams CROSS JOIN SearchIndex ON SearchIndex.rowid = SearchGrams.rowid "
+                f"WHERE {where} ORDER BY {rank}", [short_terms[0][0]] + params)
+    return (f"SELECT {columns}, substr(SearchIndex.body, 1, 64), 0.0 "
+            f"FROM SearchIndex WHERE {where} ORDER BY SearchIndex.rowid", params)
+
+
+def search(cursor, query, kinds=None, limit=20, offset=0):
+    """
+    Run a search and return (items, next_offset). Items are ranked by bm25
+    with title matches weighted above body matches.
+    """
+    if not query.split():
+        return [], None
+    sql, params = build_search_query(query, kinds)
+    cursor.execute(f"{sql} LIMIT ? OFFSET ?", params + [limit + 1, offset])
+    rows = cursor.fetchall()
+    next_offset = offset + limit if len(rows) > limit else None
+    items = [{
+        "type": row[0],
+        "id": row[1],
+        "book_id": row[2],
+        "title": row[3],
+        "snippet": row[4],
+        "score": row[5]
+    } for row in rows[:limit]]
+    return items, next_offset
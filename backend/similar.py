@@ -0,0 +1,529 @@
+"""
+Precomputed "similar books".
+
+Every book has a feature vector made of five blocks: its category and its
+author (one-hot), the days it was read on over the last
+SIMILAR_READING_DAYS (ReadingHistory entries per day, log-scaled and
+normalized, so books read on the same days count as co-read), whether it
+is a favorite, and how many notes it has (log-scaled, full at
+SIMILAR_NOTES_CAP). Two books' similarity is the sum of the blocks' dot
+products weighted by SIMILAR_WEIGHTS. SimilarBook keeps each book's
+SIMILAR_TOP_K best matches by rank, so /books/<id>/similar is a
+primary-key range read.
+
+A vector only depends on the book's own rows. Triggers on Book,
+ReadingHistory, FavoriteList and Note mark books whose vector changed in
+SimilarDirty, and each refresh also marks the books read on the days that
+left the reading window since the last one (SimilarWindow). SimilarIndex's
+thread refreshes them every SIMILAR_REFRESH_INTERVAL seconds. It
+recomputes the lists of the changed books and of the books whose list
+names one of them, and adds a changed book to any other list it now beats
+the last entry of. No other list can have changed, so the result is that
+of a full rebuild, up to which of several equally scored books make the
+cut.
+
+Scores are computed for SIMILAR_BATCH_ROWS books at a time against the
+whole library as NumPy matrix operations when NumPy is installed
+(`pip install numpy`). Without it the same scores are summed in Python over
+each book's candidates (same category, author or reading days, favorites
+and annotated books), which is fine for a few thousand books.
+
+Usage from the backend directory:
+
+    python3 similar.py rebuild
+"""
+import argparse
+import atexit
+import heapq
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from config import (SIMILAR_TOP_K, SIMILAR_WEIGHTS, SIMILAR_READING_DAYS, SIMILAR_NOTES_CAP, SIMILAR_BATCH_ROWS,
+                    SIMILAR_REFRESH_BATCH, SIMILAR_REFRESH_INTERVAL)
+from pool import get_connection
+from cache import invalidate
+from tenants import tenant_router, use_tenant
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+
+def _mark(ref):
+    return f'''
+        INSERT INTO SimilarDirty (book_id) VALUES ({ref})
+        ON CONFLICT(book_id) DO UPDATE SET generation = generation + 1;
+    '''
+
+
+def _triggers():
+    for table, name in (('ReadingHistory', 'history'), ('FavoriteList', 'favorite'), ('Note', 'note')):
+        yield f'''
+        CREATE TRIGGER IF NOT EXISTS similar_{name}_ai AFTER INSERT ON {table} BEGIN
+            {_mark('new.book_id')}
+        END
+        '''
+        yield f'''
+        CREATE TRIGGER IF NOT EXISTS similar_{name}_ad AFTER DELETE ON {table} BEGIN
+            {_mark('old.book_id')}
+        END
+        '''
+
+
+SIMILAR_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS SimilarBook (
+        book_id INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        similar_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (book_id, rank)
+    ) WITHOUT ROWID
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_similar_book_similar_id ON SimilarBook(similar_id)",
+    # generation moves on with every change, so a refresh only clears the
+    # marks it has seen
+    '''
+    CREATE TABLE IF NOT EXISTS SimilarDirty (
+        book_id INTEGER PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 1
+    )
+    ''',
+    # The start of the reading window the lists were last refreshed with
+    '''
+    CREATE TABLE IF NOT EXISTS SimilarWindow (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        start TEXT NOT NULL
+    )
+    ''',
+    *_triggers(),
+    f'''
+    CREATE TRIGGER IF NOT EXISTS similar_book_ai AFTER INSERT ON Book BEGIN
+        {_mark('new.id')}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS similar_book_au AFTER UPDATE OF category, author, author_id ON Book BEGIN
+        {_mark('new.id')}
+    END
+    ''',
+    # Lists that named the book are one short and get recomputed
+    '''
+    CREATE TRIGGER IF NOT EXISTS similar_book_ad AFTER DELETE ON Book BEGIN
+        INSERT INTO SimilarDirty (book_id) SELECT book_id FROM SimilarBook WHERE similar_id = old.id
+        ON CONFLICT(book_id) DO UPDATE SET generation = generation + 1;
+        DELETE FROM SimilarBook WHERE book_id = old.id OR similar_id = old.id;
+        DELETE FROM SimilarDirty WHERE book_id = old.id;
+    END
+    '''
+]
+
+
+def create_similar_tables(cursor):
+    for statement in SIMILAR_DDL:
+        cursor.execute(statement)
+    # The first refresh indexes every book
+    cursor.execute("INSERT OR IGNORE INTO SimilarDirty (book_id) SELECT id FROM Book")
+
+
+def _codes(values):
+    """
+    A small integer per distinct value; -1, which matches nothing, for none.
+    """
+    codes = {}
+    return [-1 if value in (None, '') else codes.setdefault(value, len(codes)) for value in values]
+
+
+class Features:
+    """
+    The feature blocks of every book, read in one pass; row i describes
+    book ids[i].
+    """
+
+    def __init__(self, cursor, since):
+        cursor.execute("SELECT id, category, coalesce(author_id, author) FROM Book ORDER BY id")
+        books = cursor.fetchall()
+        self.ids = [row[0] for row in books]
+        self.index = {book_id: row for row, book_id in enumerate(self.ids)}
+        self.category = _codes(book[1] for book in books)
+        self.author = _codes(book[2] for book in books)
+
+        self.favorite = [0.0] * len(books)
+        cursor.execute("SELECT DISTINCT book_id FROM FavoriteList")
+        for (book_id,) in cursor.fetchall():
+            if book_id in self.index:
+                self.favorite[self.index[book_id]] = 1.0
+
+        self.notes = [0.0] * len(books)
+        cursor.execute("SELECT book_id, COUNT(*) FROM Note GROUP BY book_id")
+        for book_id, count in cursor.fetchall():
+            if book_id in self.index:
+                self.notes[self.index[book_id]] = min(math.log1p(count) / math.log1p(SIMILAR_NOTES_CAP), 1.0)
+
+        # row -> {day: weight}, each vector of unit length
+        self.reading = defaultdict(dict)
+        days = {}
+        cursor.execute('''
+            SELECT book_id, substr(time_stamp, 1, 10) AS day, COUNT(*) FROM ReadingHistory
+            WHERE time_stamp >= ? GROUP BY book_id, day
+        ''', (since,))
+        for book_id, day, count in cursor.fetchall():
+            if book_id in self.index:
+                self.reading[self.index[book_id]][days.setdefault(day, len(days))] = math.log1p(count)
+        for vector in self.reading.values():
+            norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+            for day in vector:
+                vector[day] /= norm
+        self.days = len(days)
+
+        if numpy is not None:
+            self._arrays()
+        else:
+            self._candidates()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _arrays(self):
+        self.category = numpy.array(self.category, dtype=numpy.int64)
+        self.author = numpy.array(self.author, dtype=numpy.int64)
+        self.favorite = numpy.array(self.favorite, dtype=numpy.float32)
+        self.notes = numpy.array(self.notes, dtype=numpy.float32)
+        # Only books with reading history get a row of the day matrix
+        self.readers = numpy.array(sorted(self.reading), dtype=numpy.int64)
+        self.reader_row = numpy.full(len(self.ids), -1, dtype=numpy.int64)
+        self.reader_row[self.readers] = numpy.arange(len(self.readers))
+        self.days_matrix = numpy.zeros((len(self.readers), self.days), dtype=numpy.float32)
+        for i, row in enumerate(self.readers.tolist()):
+            vector = self.reading[row]
+            self.days_matrix[i, list(vector)] = list(vector.values())
+
+    def _candidates(self):
+        self.by_category = defaultdict(list)
+        self.by_author = defaultdict(list)
+        for row, (category, author) in enumerate(zip(self.category, self.author)):
+            if category >= 0:
+                self.by_category[category].append(row)
+            if author >= 0:
+                self.by_author[author].append(row)
+        self.favorites = [row for row, flag in enumerate(self.favorite) if flag]
+        self.annotated = [(row, weight) for row, weight in enumerate(self.notes) if weight]
+        self.by_day = defaultdict(list)
+        for row, vector in self.reading.items():
+            for day, weight in vector.items():
+                self.by_day[day].append((row, weight))
+
+    def score_matrix(self, rows):
+        """
+        Scores of the books at `rows` (a NumPy array) against every book.
+        """
+        weights = SIMILAR_WEIGHTS
+        category = self.category[rows, None]
+        matrix = ((category == self.category) & (category >= 0)).astype(numpy.float32)
+        matrix *= weights['category']
+        author = self.author[rows, None]
+        matrix[(author == self.author) & (author >= 0)] += weights['author']
+        matrix += numpy.outer(self.favorite[rows] * weights['favorite'], self.favorite)
+        matrix += numpy.outer(self.notes[rows] * weights['notes'], self.notes)
+        local = self.reader_row[rows]
+        readers = numpy.flatnonzero(local >= 0)
+        if readers.size:
+            batch_days = self.days_matrix[local[readers]]
+            # Only the days this batch read on contribute
+            days = numpy.flatnonzero(batch_days.any(axis=0))
+            co_read = batch_days[:, days] @ self.days_matrix[:, days].T
+            matrix[numpy.ix_(readers, self.readers)] += weights['reading'] * co_read
+        matrix[numpy.arange(len(rows)), rows] = 0
+        return matrix
+
+    def candidate_scores(self, row):
+        """
+        {row: score} of the books scoring above zero against `row`.
+        """
+        weights = SIMILAR_WEIGHTS
+        scores = defaultdict(float)
+        if self.category[row] >= 0:
+            for other in self.by_category[self.category[row]]:
+                scores[other] += weights['category']
+        if self.author[row] >= 0:
+            for other in self.by_author[self.author[row]]:
+                scores[other] += weights['author']
+        if self.favorite[row]:
+            for other in self.favorites:
+                scores[other] += weights['favorite']
+        if self.notes[row]:
+            for other, weight in self.annotated:
+                scores[other] += weights['notes'] * self.notes[row] * weight
+        for day, weight in self.reading.get(row, {}).items():
+            for other, other_weight in self.by_day[day]:
+                scores[other] += weights['reading'] * weight * other_weight
+        scores.pop(row, None)
+        return scores
+
+
+def _scores(features, rows):
+    """
+    (row, candidate rows, scores) for each of `rows`, the candidates being
+    every other book that scores above zero.
+    """
+    if numpy is None:
+        for row in rows:
+            scores = features.candidate_scores(row)
+            yield row, list(scores), list(scores.values())
+        return
+    for start in range(0, len(rows), SIMILAR_BATCH_ROWS):
+        batch = numpy.array(rows[start:start + SIMILAR_BATCH_ROWS], dtype=numpy.int64)
+        matrix = features.score_matrix(batch)
+        for i, row in enumerate(batch.tolist()):
+            cols = numpy.flatnonzero(matrix[i] > 0)
+            yield row, cols, matrix[i, cols]
+
+
+def _top(cols, scores, k):
+    """
+    The k best (row, score) pairs, best first; ties go to the older book.
+    """
+    if numpy is None:
+        return heapq.nsmallest(k, zip(cols, scores), key=lambda pair: (-pair[1], pair[0]))
+    if len(scores) > k:
+        cutoff = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+        above = numpy.flatnonzero(scores > cutoff)
+        ties = numpy.flatnonzero(scores == cutoff)[:k - len(above)]
+        keep = numpy.concatenate((above, ties))
+        cols, scores = cols[keep], scores[keep]
+    order = numpy.lexsort((cols, -scores))
+    return list(zip(cols[order].tolist(), scores[order].tolist()))
+
+
+def _entering(cols, scores, cutoff, skip):
+    """
+    (row, score) pairs of `cols` that beat the last entry of that row's
+    list. With NumPy `cutoff` and `skip` are arrays over all rows, without
+    it a dict and a set.
+    """
+    if numpy is None:
+        return [(col, score) for col, score in zip(cols, scores)
+                if col not in skip and score > cutoff.get(col, 0.0)]
+    keep = (scores > cutoff[cols]) & ~skip[cols]
+    return list(zip(cols[keep].tolist(), scores[keep].tolist()))
+
+
+class SimilarIndex:
+    """
+    Refreshes SimilarBook from a background thread.
+    """
+
+    def __init__(self, k=SIMILAR_TOP_K, interval=SIMILAR_REFRESH_INTERVAL, batch=SIMILAR_REFRESH_BATCH):
+        self.k = k
+        self.interval = interval
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.refreshed_books = 0
+        self.rewritten_lists = 0
+        self.last_refresh_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name='similar-books', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            for tenant in tenant_router.active():
+                try:
+                    with use_tenant(tenant):
+                        while self.refresh() == self.batch and not self._stopping.is_set():
+                            pass
+                except Exception:
+                    logger.exception("similar books refresh failed, retrying")
+                if self._stopping.is_set():
+                    return
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def refresh(self, limit=None):
+        """
+        Bring up to `limit` (default `batch`) changed books, and every list
+        they affect, up to date. Returns how many changed books were taken.
+        """
+        limit = limit or self.batch
+        start = time.perf_counter()
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            since = self._slide_window(conn)
+            # Marks, features and lists are read from one snapshot
+            cursor.execute("BEGIN")
+            cursor.execute("SELECT book_id, generation FROM SimilarDirty ORDER BY book_id")
+            marks = cursor.fetchall()
+            if not marks:
+                conn.commit()
+                return 0
+            taken = marks[:limit]
+            features = Features(cursor, since)
+            index = features.index
+            changed = [index[book_id] for book_id, _ in taken if book_id in index]
+            # Books marked beyond this batch are recomputed by a later one
+            later = {index[book_id] for book_id, _ in marks[limit:] if book_id in index}
+            affected = set(changed)
+            changed_ids = [features.ids[row] for row in changed]
+            for i in range(0, len(changed_ids), 500):
+                chunk = changed_ids[i:i + 500]
+                cursor.execute(f"SELECT DISTINCT book_id FROM SimilarBook WHERE similar_id IN ({','.join('?' * len(chunk))})",
+                               chunk)
+                affected.update(index[book_id] for (book_id,) in cursor.fetchall() if book_id in index)
+            affected -= later
+            cursor.execute("SELECT book_id, COUNT(*), MIN(score) FROM SimilarBook GROUP BY book_id")
+            worst = {index[book_id]: score for book_id, count, score in cursor.fetchall()
+                     if book_id in index and count >= self.k}
+            conn.commit()
+
+            skip = affected | later
+            if numpy is not None:
+                cutoff = numpy.zeros(len(features), dtype=numpy.float32)
+                if worst:
+                    cutoff[list(worst)] = list(worst.values())
+                skip_rows = numpy.zeros(len(features), dtype=bool)
+                skip_rows[list(skip)] = True
+            else:
+                cutoff, skip_rows = worst, skip
+            changed = set(changed)
+            lists = {}
+            entering = defaultdict(list)
+            for row, cols, scores in _scores(features, sorted(affected)):
+                lists[row] = _top(cols, scores, self.k)
+                if row in changed:
+                    for col, score in _entering(cols, scores, cutoff, skip_rows):
+                        entering[col].append((row, score))
+
+            ids = features.ids
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT id FROM Book")
+            existing = {book_id for (book_id,) in cursor.fetchall()}
+            for row, extra in entering.items():
+                cursor.execute("SELECT similar_id, score FROM SimilarBook WHERE book_id = ?", (ids[row],))
+                current = [(index[similar_id], score) for similar_id, score in cursor.fetchall() if similar_id in index]
+                lists[row] = heapq.nsmallest(self.k, current + extra, key=lambda pair: (-pair[1], pair[0]))
+            for row, neighbours in lists.items():
+                book_id = ids[row]
+                cursor.execute("DELETE FROM SimilarBook WHERE book_id = ?", (book_id,))
+                if book_id not in existing:
+                    continue
+                # A neighbour deleted since the snapshot leaves the list for the next refresh
+                entries = [(book_id, rank, ids[col], score) for rank, (col, score) in enumerate(neighbours, 1)
+                           if ids[col] in existing]
+                cursor.executemany("INSERT INTO SimilarBook (book_id, rank, similar_id, score) VALUES (?, ?, ?, ?)",
+                                   entries)
+                if len(entries) < len(neighbours):
+                    cursor.execute("INSERT OR IGNORE INTO SimilarDirty (book_id) VALUES (?)", (book_id,))
+            cursor.executemany("DELETE FROM SimilarDirty WHERE book_id = ? AND generation = ?", taken)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        invalidate('SimilarBook')
+        with self._lock:
+            self.refreshes += 1
+            self.refreshed_books += len(taken)
+            self.rewritten_lists += len(lists)
+            self.last_refresh_seconds = time.perf_counter() - start
+        return len(taken)
+
+    @staticmethod
+    def _slide_window(conn):
+        """
+        Move SimilarWindow to today's reading window, marking the books read
+        on the days in between, and return its start.
+        """
+        since = conn.execute("SELECT date('now', ?)", (f"-{int(SIMILAR_READING_DAYS)} days",)).fetchone()[0]
+        row = conn.execute("SELECT start FROM SimilarWindow").fetchone()
+        if row is not None and row[0] == since:
+            return since
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT start FROM SimilarWindow").fetchone()
+        if row is not None and row[0] != since:
+            conn.execute('''
+                INSERT INTO SimilarDirty (book_id)
+                SELECT DISTINCT book_id FROM ReadingHistory WHERE time_stamp >= min(?1, ?2) AND time_stamp < max(?1, ?2)
+                ON CONFLICT(book_id) DO UPDATE SET generation = generation + 1
+            ''', (row[0], since))
+        conn.execute("INSERT OR REPLACE INTO SimilarWindow (id, start) VALUES (1, ?)", (since,))
+        conn.commit()
+        return since
+
+    def rebuild(self):
+        """
+        Recompute every list now. Returns how many books were indexed.
+        """
+        conn = get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute('''
+                INSERT INTO SimilarDirty (book_id) SELECT id FROM Book WHERE true
+                ON CONFLICT(book_id) DO UPDATE SET generation = generation + 1
+            ''')
+            conn.commit()
+            marked = conn.execute("SELECT COUNT(*) FROM SimilarDirty").fetchone()[0]
+        finally:
+            conn.close()
+        # In one pass, since a later batch would redo the lists naming its books
+        return self.refresh(limit=max(marked, 1))
+
+    def metrics(self):
+        conn = get_connection()
+        try:
+            pending = conn.execute("SELECT COUNT(*) FROM SimilarDirty").fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            "numpy": numpy is not None,
+            "pending": pending,
+            "refreshes": self.refreshes,
+            "refreshed_books": self.refreshed_books,
+            "rewritten_lists": self.rewritten_lists,
+            "last_refresh_seconds": self.last_refresh_seconds
+        }
+
+
+similar_index = SimilarIndex()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the similar books index.")
+    parser.add_argument('command', choices=['refresh', 'rebuild'])
+    parser.add_argument('--library', help="a library from TENANT_FOLDER instead of the default one")
+    args = parser.parse_args(argv)
+    with use_tenant(args.library):
+        if args.command == 'rebuild':
+            similar_index.rebuild()
+        else:
+            while similar_index.refresh() == similar_index.batch:
+                pass
+        print(json.dumps(similar_index.metrics(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
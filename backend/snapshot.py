@@ -0,0 +1,406 @@
+"""
+Export, backup and restore of the whole library.
+
+Two snapshot formats:
+
+- A columnar export (.lsnap) of the six user tables: Author, Book,
+  ReadingHistory, ReadingPlan, Note and FavoriteList. All tables are read in
+  one read transaction, so the export is consistent, and rows are streamed
+  from the cursor in groups of SNAPSHOT_GROUP_ROWS. Each column of a group
+  is stored as a typed array (int64, float64 or length-prefixed UTF-8) with
+  a null bitmap and compressed on its own, with zstd when the `zstandard`
+  package is installed and zlib otherwise.
+- An online backup (.db) made with sqlite3.Connection.backup. Under WAL the
+  backup's read transaction does not block writers.
+
+Restoring either format builds the new database in a temporary file and
+copies it over the live one with Connection.backup, which is atomic for
+other connections. A columnar restore loads the rows with executemany into
+tables without indexes or triggers and then runs the schema migrations,
+which build the indexes and backfill the search index, stats and book
+details in one pass each, instead of paying for every trigger on every row.
+A restored backup from an older version is migrated as well. Derived
+PDF tables (jobs, page text, thumbnails) and reusable title gaps are not
+part of the export and start empty.
+
+Usage from the backend directory:
+
+    python3 snapshot.py export library.lsnap
+    python3 snapshot.py backup library-backup.db
+    python3 snapshot.py restore library.lsnap
+"""
+import argparse
+import json
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from config import SNAPSHOT_GROUP_ROWS, SNAPSHOT_COMPRESSION_LEVEL
+from pool import current_pool, get_connection
+from tenants import use_tenant
+from migrations import migrate
+from changefeed import record_reset
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SNAPSHOT_TABLES = ['Author', 'Book', 'ReadingHistory', 'ReadingPlan', 'Note', 'FavoriteList']
+MAGIC = b'LIBSNAP1'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+_U32 = struct.Struct('<I')
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+# Compression
+
+def _compressor(codec):
+    if codec == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=SNAPSHOT_COMPRESSION_LEVEL)
+        return compressor.compress
+    return lambda data: zlib.compress(data, min(SNAPSHOT_COMPRESSION_LEVEL, 9))
+
+
+def _decompressor(codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise SnapshotError("snapshot is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress
+    if codec == 'zlib':
+        return zlib.decompress
+    raise SnapshotError(f"unknown codec: {codec}")
+
+
+# Column encoding
+
+def _little_endian(values):
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def encode_column(values):
+    """
+    Encode one column of a row group as tag + null bitmap + typed payload.
+    Columns mixing storage classes fall back to JSON.
+    """
+    present = [v for v in values if v is not None]
+    nulls = b''
+    if len(present) != len(values):
+        bitmap = bytearray((len(values) + 7) // 8)
+        for i, v in enumerate(values):
+            if v is None:
+                bitmap[i >> 3] |= 1 << (i & 7)
+        nulls = bytes(bitmap)
+
+    kinds = {type(v) for v in present}
+    if kinds <= {int} and all(-2**63 <= v < 2**63 for v in present):
+        tag, payload = b'i', _little_endian(array('q', [0 if v is None else v for v in values]))
+    elif kinds <= {float}:
+        tag, payload = b'd', _little_endian(array('d', [0.0 if v is None else v for v in values]))
+    elif kinds <= {str} or kinds <= {bytes}:
+        tag = b's' if kinds <= {str} else b'b'
+        encoded = [v.encode('utf-8') if isinstance(v, str) else v for v in present]
+        payload = (_U32.pack(len(encoded)) + _little_endian(array('I', [len(b) for b in encoded]))
+                   + b''.join(encoded))
+    else:
+        tag, payload = b'j', json.dumps(values, ensure_ascii=False).encode('utf-8')
+    return tag + _U32.pack(len(nulls)) + nulls + payload
+
+
+def decode_column(data, count):
+    tag = data[:1]
+    null_length = _U32.unpack_from(data, 1)[0]
+    nulls = data[5:5 + null_length]
+    payload = data[5 + null_length:]
+    if tag == b'j':
+        return json.loads(payload.decode('utf-8'))
+
+    def is_null(i):
+        return bool(nulls) and nulls[i >> 3] & (1 << (i & 7))
+
+    if tag in (b'i', b'd'):
+        values = _from_little_endian('q' if tag == b'i' else 'd', payload).tolist()
+        return [None if is_null(i) else v for i, v in enumerate(values)] if nulls else values
+    if tag in (b's', b'b'):
+        n = _U32.unpack_from(payload, 0)[0]
+        lengths = _from_little_endian('I', payload[4:4 + 4 * n])
+        offset = 4 + 4 * n
+        present = []
+        for length in lengths:
+            chunk = payload[offset:offset + length]
+            present.append(chunk.decode('utf-8') if tag == b's' else bytes(chunk))
+            offset += length
+        if not nulls:
+            return present
+        values = iter(present)
+        return [None if is_null(i) else next(values) for i in range(count)]
+    raise SnapshotError(f"unknown column tag: {tag!r}")
+
+
+# Framing: b'H'/b'T'/b'E' + u32 length + JSON, or b'G' + u32 length + row group
+
+def _frame(kind, payload):
+    return kind + _U32.pack(len(payload)) + payload
+
+
+def _json_frame(kind, obj):
+    return _frame(kind, json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+
+
+def _stored_columns(cursor, table):
+    """
+    Columns holding data, i.e. without generated columns such as Book.base_title.
+    """
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    return [row[1] for row in cursor.fetchall() if row[6] == 0]
+
+
+def export_stream(conn=None, group_rows=SNAPSHOT_GROUP_ROWS):
+    """
+    Yield the columnar snapshot as byte chunks, one frame at a time, from a
+    single read transaction.
+    """
+    own_connection = conn is None
+    if own_connection:
+        conn = get_connection()
+    codec = 'zstd' if zstandard is not None else 'zlib'
+    compress = _compressor(codec)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        yield MAGIC + _json_frame(b'H', {"codec": codec, "created_at": time.time(), "tables": SNAPSHOT_TABLES})
+        counts = {}
+        for table in SNAPSHOT_TABLES:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            ddl = cursor.fetchone()[0]
+            columns = _stored_columns(cursor, table)
+            yield _json_frame(b'T', {"table": table, "columns": columns, "ddl": ddl})
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+            counts[table] = 0
+            while True:
+                rows = cursor.fetchmany(group_rows)
+                if not rows:
+                    break
+                blobs = [compress(encode_column(list(column))) for column in zip(*rows)]
+                yield _frame(b'G', _U32.pack(len(rows)) + b''.join(_U32.pack(len(b)) + b for b in blobs))
+                counts[table] += len(rows)
+        yield _json_frame(b'E', {"rows": counts})
+    finally:
+        conn.rollback()
+        if own_connection:
+            conn.close()
+
+
+def export_snapshot(path):
+    """
+    Write a columnar snapshot to `path` atomically. Returns row counts.
+    """
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f:
+        for chunk in export_stream():
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return read_summary(path)
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise SnapshotError("truncated snapshot")
+    return data
+
+
+def read_snapshot(f):
+    """
+    Parse a snapshot stream, yielding ('table', info) and ('rows', rows)
+    items and finally ('end', summary).
+    """
+    if _read_exact(f, len(MAGIC)) != MAGIC:
+        raise SnapshotError("not a library snapshot")
+    decompress = None
+    columns = None
+    while True:
+        kind = f.read(1)
+        if not kind:
+            raise SnapshotError("truncated snapshot")
+        length = _U32.unpack(_read_exact(f, 4))[0]
+        payload = _read_exact(f, length)
+        if kind == b'H':
+            decompress = _decompressor(json.loads(payload)["codec"])
+        elif kind == b'T':
+            info = json.loads(payload)
+            columns = info["columns"]
+            yield 'table', info
+        elif kind == b'G':
+            count = _U32.unpack_from(payload, 0)[0]
+            offset = 4
+            decoded = []
+            for _ in columns:
+                size = _U32.unpack_from(payload, offset)[0]
+                decoded.append(decode_column(decompress(payload[offset + 4:offset + 4 + size]), count))
+                offset += 4 + size
+            yield 'rows', list(zip(*decoded))
+        elif kind == b'E':
+            yield 'end', json.loads(payload)
+            return
+        else:
+            raise SnapshotError(f"unknown frame: {kind!r}")
+
+
+def read_summary(path):
+    with open(path, 'rb') as f:
+        for kind, value in read_snapshot(f):
+            if kind == 'end':
+                return value["rows"]
+
+
+def backup_database(path):
+    """
+    Online backup of the live database to `path` with Connection.backup.
+    """
+    # A private temporary file, so concurrent backups never share one
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        conn = get_connection()
+        dest = sqlite3.connect(tmp_path)
+        try:
+            conn._raw.backup(dest)
+        finally:
+            dest.close()
+            conn.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+def _load_columnar(f, dest):
+    """
+    Create the exported tables in `dest` and bulk load their rows, then build
+    indexes, triggers and derived tables with the migrations.
+    """
+    dest.execute("PRAGMA foreign_keys = OFF")
+    counts = {}
+    insert_sql = None
+    for kind, value in read_snapshot(f):
+        if kind == 'table':
+            dest.execute(value["ddl"])
+            table, columns = value["table"], value["columns"]
+            insert_sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            counts[table] = 0
+        elif kind == 'rows':
+            dest.executemany(insert_sql, value)
+            counts[table] += len(value)
+    dest.commit()
+    migrate(dest)
+    return counts
+
+
+def restore(path, database=None):
+    """
+    Replace the contents of `database`, by default the current library's,
+    with a snapshot (.lsnap) or backup (.db). Returns row counts of the
+    restored user tables.
+    """
+    database = database or current_pool().database
+    with open(path, 'rb') as f:
+        header = f.read(len(SQLITE_MAGIC))
+    workdir = os.path.dirname(os.path.abspath(database))
+    fd, tmp_path = tempfile.mkstemp(suffix='.restore.db', dir=workdir)
+    os.close(fd)
+    try:
+        source = sqlite3.connect(tmp_path)
+        if header == SQLITE_MAGIC:
+            backup = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                backup.backup(source)
+            finally:
+                backup.close()
+        else:
+            source.execute("PRAGMA journal_mode = OFF")
+            source.execute("PRAGMA synchronous = OFF")
+            with open(path, 'rb') as f:
+                _load_columnar(f, source)
+        live = sqlite3.connect(database, timeout=30)
+        try:
+            # Under WAL the page sizes have to match for backup() to succeed
+            page_size = live.execute("PRAGMA page_size").fetchone()[0]
+            if source.execute("PRAGMA page_size").fetchone()[0] != page_size:
+                source.execute(f"PRAGMA page_size = {int(page_size)}")
+                source.execute("PRAGMA journal_mode = DELETE")
+                source.execute("VACUUM")
+            # Clients of the change feed must not see positions reused
+            old_seq = 0
+            if live.execute("SELECT 1 FROM sqlite_master WHERE name = 'ChangeLog'").fetchone():
+                old_seq = live.execute("SELECT max(seq) FROM ChangeLog").fetchone()[0] or 0
+            source.backup(live)
+            live.execute("PRAGMA foreign_keys = ON")
+            migrate(live)
+            record_reset(live, old_seq)
+            counts = {table: live.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                      for table in SNAPSHOT_TABLES}
+        finally:
+            live.close()
+            source.close()
+    finally:
+        os.remove(tmp_path)
+    _after_restore()
+    return counts
+
+
+def _after_restore():
+    from cache import invalidate
+    from write_behind import book_ids
+    book_ids.clear()
+    for table in SNAPSHOT_TABLES + ['PdfPage', 'SimilarBook']:
+        invalidate(table)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export, back up or restore the library database.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('export', help="write a columnar snapshot").add_argument('path')
+    sub.add_parser('backup', help="write an online SQLite backup").add_argument('path')
+    sub.add_parser('restore', help="restore from a snapshot or backup").add_argument('path')
+    parser.add_argument('--library', help="a library from TENANT_FOLDER instead of the default one")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    with use_tenant(args.library):
+        if args.command == 'export':
+            result = {"rows": export_snapshot(args.path), "bytes": os.path.getsize(args.path)}
+        elif args.command == 'backup':
+            result = {"bytes": backup_database(args.path)}
+        else:
+            result = {"rows": restore(args.path)}
+    result["seconds"] = time.perf_counter() - start
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
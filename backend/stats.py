@@ -0,0 +1,301 @@
+"""
+Reading statistics kept as rollups.
+
+StatsRollup holds one row per (grain, dim, key, period) with the number of
+reading sessions (ReadingHistory rows) and pages read (forward moves of
+Book.current_page via update_page):
+
+- grain: 'day', 'week' (period is the Monday) or 'total' (period is '')
+- dim:   'book' (key is the book id), 'category', 'author' or 'all' (key '')
+
+Triggers on ReadingHistory and Book add or subtract each event in all
+twelve combinations inside the writing transaction, so the /stats endpoints
+read a handful of primary-key rows no matter how long the history gets.
+Rows that drop back to zero are removed, which keeps day rows equal to the
+days with any reading activity. A book's totals count toward the category
+and author it has now: changing either moves them from the old key to the
+new one.
+"""
+from datetime import date, timedelta
+
+GRAINS = ('day', 'week', 'total')
+DIMS = ('book', 'category', 'author', 'all')
+
+
+def _combos(book_id, day):
+    """
+    SELECT yielding (dim, key, grain, period) for a book and a day, or no rows
+    when the book does not exist.
+    """
+    return f'''
+        SELECT d.dim, d.key, g.grain, g.period FROM
+            (SELECT 'book' AS dim, CAST(b.id AS TEXT) AS key FROM Book b WHERE b.id = {book_id}
+             UNION ALL SELECT 'category', coalesce(b.category, '') FROM Book b WHERE b.id = {book_id}
+             UNION ALL SELECT 'author', b.author FROM Book b WHERE b.id = {book_id}
+             UNION ALL SELECT 'all', '' FROM Book b WHERE b.id = {book_id}) AS d,
+            (SELECT 'day' AS grain, {day} AS period
+             UNION ALL SELECT 'week', date({day}, '-6 days', 'weekday 1')
+             UNION ALL SELECT 'total', '') AS g
+    '''
+
+
+def _apply(book_id, day, sessions, pages):
+    combos = _combos(book_id, day)
+    return f'''
+        INSERT INTO StatsRollup (dim, key, grain, period, sessions, pages)
+        SELECT dim, key, grain, period, {sessions}, {pages} FROM ({combos}) WHERE true
+        ON CONFLICT (grain, dim, key, period) DO UPDATE SET
+            sessions = sessions + excluded.sessions, pages = pages + excluded.pages;
+        DELETE FROM StatsRollup WHERE sessions <= 0 AND pages <= 0
+            AND (dim, key, grain, period) IN ({combos});
+    '''
+
+
+_DAY = "substr({}.time_stamp, 1, 10)"
+_TODAY = "date('now', 'localtime')"
+
+STATS_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS StatsRollup (
+        grain TEXT NOT NULL,
+        dim TEXT NOT NULL,
+        key TEXT NOT NULL,
+        period TEXT NOT NULL,
+        sessions INTEGER NOT NULL DEFAULT 0,
+        pages INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (grain, dim, key, period)
+    ) WITHOUT ROWID
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_history_ai AFTER INSERT ON ReadingHistory
+    WHEN new.time_stamp IS NOT NULL BEGIN
+        {_apply('new.book_id', _DAY.format('new'), 1, 0)}
+    END
+    ''',
+    # Skipped when the history goes with its book; stats_book_bd handles that
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_history_ad AFTER DELETE ON ReadingHistory
+    WHEN old.time_stamp IS NOT NULL BEGIN
+        {_apply('old.book_id', _DAY.format('old'), -1, 0)}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_history_au AFTER UPDATE OF time_stamp, book_id ON ReadingHistory
+    WHEN old.time_stamp IS NOT NULL AND new.time_stamp IS NOT NULL BEGIN
+        {_apply('old.book_id', _DAY.format('old'), -1, 0)}
+        {_apply('new.book_id', _DAY.format('new'), 1, 0)}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS stats_book_pages_au AFTER UPDATE OF current_page ON Book
+    WHEN new.current_page > old.current_page BEGIN
+        {_apply('new.id', _TODAY, 0, 'new.current_page - old.current_page')}
+    END
+    ''',
+    # Take a deleted book's totals out of its category, author and 'all' rows
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_book_bd BEFORE DELETE ON Book BEGIN
+        INSERT INTO StatsRollup (dim, key, grain, period, sessions, pages)
+        SELECT d.dim, d.key, r.grain, r.period, -r.sessions, -r.pages
+        FROM StatsRollup r,
+            (SELECT 'category' AS dim, coalesce(old.category, '') AS key
+             UNION ALL SELECT 'author', old.author
+             UNION ALL SELECT 'all', '') AS d
+        WHERE r.dim = 'book' AND r.key = CAST(old.id AS TEXT)
+        ON CONFLICT (grain, dim, key, period) DO UPDATE SET
+            sessions = sessions + excluded.sessions, pages = pages + excluded.pages;
+        DELETE FROM StatsRollup WHERE sessions <= 0 AND pages <= 0
+            AND dim IN ('category', 'author', 'all')
+            AND key IN (coalesce(old.category, ''), old.author, '');
+        DELETE FROM StatsRollup WHERE dim = 'book' AND key = CAST(old.id AS TEXT);
+    END
+    ''',
+    # Move a book's totals to its new category or author. BEFORE, so pages
+    # read in the same UPDATE are added to the new key only afterwards
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_book_keys_bu BEFORE UPDATE OF author, category ON Book
+    WHEN old.author IS NOT new.author OR coalesce(old.category, '') <> coalesce(new.category, '') BEGIN
+        INSERT INTO StatsRollup (dim, key, grain, period, sessions, pages)
+        SELECT d.dim, d.key, r.grain, r.period, d.sign * r.sessions, d.sign * r.pages
+        FROM StatsRollup r,
+            (SELECT 'category' AS dim, coalesce(old.category, '') AS key, -1 AS sign
+             UNION ALL SELECT 'category', coalesce(new.category, ''), 1
+             UNION ALL SELECT 'author', old.author, -1
+             UNION ALL SELECT 'author', new.author, 1) AS d
+        WHERE r.dim = 'book' AND r.key = CAST(old.id AS TEXT)
+        ON CONFLICT (grain, dim, key, period) DO UPDATE SET
+            sessions = sessions + excluded.sessions, pages = pages + excluded.pages;
+        DELETE FROM StatsRollup WHERE sessions <= 0 AND pages <= 0
+            AND dim IN ('category', 'author')
+            AND key IN (coalesce(old.category, ''), old.author);
+    END
+    '''
+]
+
+
+def create_stats_tables(cursor):
+    """
+    Create the rollup table and triggers. The first time, existing history
+    is rolled up as sessions; earlier page progress is not recorded anywhere
+    so it cannot be backfilled.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'StatsRollup'")
+    exists = cursor.fetchone() is not None
+    for statement in STATS_DDL:
+        cursor.execute(statement)
+    if not exists:
+        cursor.execute(f'''
+            INSERT INTO StatsRollup (dim, key, grain, period, sessions, pages)
+            SELECT d.dim,
+                   CASE d.dim WHEN 'book' THEN CAST(b.id AS TEXT) WHEN 'category' THEN coalesce(b.category, '')
+                              WHEN 'author' THEN b.author ELSE '' END,
+                   g.grain,
+                   CASE g.grain WHEN 'day' THEN {_DAY.format('h')}
+                                WHEN 'week' THEN date({_DAY.format('h')}, '-6 days', 'weekday 1') ELSE '' END,
+                   COUNT(*), 0
+            FROM ReadingHistory h
+            JOIN Book b ON b.id = h.book_id,
+                (SELECT 'book' AS dim UNION ALL SELECT 'category' UNION ALL SELECT 'author' UNION ALL SELECT 'all') AS d,
+                (SELECT 'day' AS grain UNION ALL SELECT 'week' UNION ALL SELECT 'total') AS g
+            WHERE h.time_stamp IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        ''')
+
+
+def rebuild_key_rollups(cursor):
+    """
+    Recompute the category and author rows from the book rows, under each
+    book's current category and author.
+    """
+    cursor.execute("DELETE FROM StatsRollup WHERE dim IN ('category', 'author')")
+    cursor.execute('''
+        INSERT INTO StatsRollup (dim, key, grain, period, sessions, pages)
+        SELECT d.dim, CASE d.dim WHEN 'category' THEN coalesce(b.category, '') ELSE b.author END,
+               r.grain, r.period, SUM(r.sessions), SUM(r.pages)
+        FROM StatsRollup r
+        JOIN Book b ON b.id = CAST(r.key AS INTEGER),
+            (SELECT 'category' AS dim UNION ALL SELECT 'author') AS d
+        WHERE r.dim = 'book'
+        GROUP BY 1, 2, 3, 4
+    ''')
+
+
+def rollup(cursor, grain, dim, key, start=None, end=None, limit=366):
+    """
+    Rows for one key, newest period first, optionally within [start, end].
+    """
+    sql = "SELECT period, sessions, pages FROM StatsRollup WHERE grain = ? AND dim = ? AND key = ?"
+    params = [grain, dim, key]
+    if start:
+        sql += " AND period >= ?"
+        params.append(start)
+    if end:
+        sql += " AND period <= ?"
+        params.append(end)
+    sql += " ORDER BY period DESC LIMIT ?"
+    params.append(limit)
+    cursor.execute(sql, params)
+    return [{"period": period, "sessions": sessions, "pages": pages} for period, sessions, pages in cursor.fetchall()]
+
+
+def totals(cursor, dim, key=None, limit=100):
+    """
+    All-time totals for one key, or for every key of `dim` (most sessions first).
+    """
+    if key is not None:
+        cursor.execute("SELECT key, sessions, pages FROM StatsRollup WHERE grain = 'total' AND dim = ? AND key = ?",
+                       (dim, key))
+    else:
+        cursor.execute('''
+            SELECT key, sessions, pages FROM StatsRollup WHERE grain = 'total' AND dim = ?
+            ORDER BY sessions DESC, pages DESC LIMIT ?
+        ''', (dim, limit))
+    return [{"key": k, "sessions": sessions, "pages": pages} for k, sessions, pages in cursor.fetchall()]
+
+
+def streaks(cursor, today=None):
+    """
+    Current and longest run of consecutive days with any reading. The current
+    streak still counts if the last active day was yesterday.
+    """
+    today = today or date.today()
+    cursor.execute('''
+        SELECT period FROM StatsRollup WHERE grain = 'day' AND dim = 'all' AND key = ''
+        ORDER BY period DESC
+    ''')
+    current = 0
+    expected = None
+    while True:
+        rows = cursor.fetchmany(64)
+        if not rows:
+            break
+        for (period,) in rows:
+            day = date.fromisoformat(period)
+            if expected is None:
+                if day < today - timedelta(days=1):
+                    break
+                expected = day
+            if day != expected:
+                break
+            current += 1
+            expected = day - timedelta(days=1)
+        else:
+            continue
+        break
+    cursor.execute('''
+        SELECT coalesce(MAX(n), 0) FROM (
+            SELECT COUNT(*) AS n FROM (
+                SELECT julianday(period) - ROW_NUMBER() OVER (ORDER BY period) AS island
+                FROM StatsRollup WHERE grain = 'day' AND dim = 'all' AND key = ''
+            ) GROUP BY island
+        )
+    ''')
+    return {"current": current, "longest": cursor.fetchone()[0]}
+
+
+def plan_progress(cursor, plan_id, today=None):
+    """
+    Progress of a ReadingPlan toward its expired_date, or None if no such plan.
+    The page count is known once the book's PDF has been processed.
+    """
+    today = today or date.today()
+    cursor.execute('''
+        SELECT p.id, p.book_id, p.expired_date, p.is_complete, b.current_page, i.page_count
+        FROM ReadingPlan p
+        JOIN Book b ON b.id = p.book_id
+        LEFT JOIN PdfInfo i ON i.book_id = p.book_id
+        WHERE p.id = ?
+    ''', (plan_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    plan_id, book_id, expired_date, is_complete, current_page, page_count = row
+    week_ago = (today - timedelta(days=6)).isoformat()
+    recent = rollup(cursor, 'day', 'book', str(book_id), start=week_ago, end=today.isoformat(), limit=7)
+    pages_per_day = sum(r["pages"] for r in recent) / 7
+    try:
+        days_left = (date.fromisoformat(expired_date[:10]) - today).days
+    except (TypeError, ValueError):
+        days_left = None
+
+    progress = {
+        "plan_id": plan_id,
+        "book_id": book_id,
+        "expired_date": expired_date,
+        "is_complete": bool(is_complete),
+        "current_page": current_page,
+        "page_count": page_count,
+        "days_left": days_left,
+        "recent_pages_per_day": pages_per_day,
+        "percent": None,
+        "required_pages_per_day": None,
+        "on_track": None
+    }
+    if page_count:
+        remaining = max(page_count - (current_page or 0), 0)
+        progress["percent"] = min((current_page or 0) / page_count, 1.0) * 100
+        if days_left is not None:
+            progress["required_pages_per_day"] = remaining / days_left if days_left > 0 else float(remaining)
+            progress["on_track"] = bool(is_complete) or remaining == 0 or (
+                days_left > 0 and pages_per_day >= progress["required_pages_per_day"])
+    return progress
@@ -0,0 +1,307 @@
+"""
+One SQLite database per library.
+
+With LIBRARY_TENANTS=1 a request names its library in the X-Library header
+or, when TENANT_DOMAIN is set, as the first label of a host under that
+domain. Everything a library owns lives under TENANT_FOLDER/<name>/: its
+library.db and its uploads folder. Requests that name no library use the
+default one (LIBRARY_DATABASE and uploads/) as before. Every library has
+its own write lock, so writes to different libraries no longer wait for
+each other.
+
+TenantRouter keeps one ConnectionPool per library in an LRU. Only
+libraries that already exist are opened: a name without a database is
+rejected with UnknownLibrary (404 for a request), so clients cannot create
+libraries on disk. A library is provisioned with create() (`python3
+migrations.py create --library <name>`), which creates and migrates an
+empty database, or on first use when TENANT_CREATE is set. At
+most TENANT_MAX_OPEN pools stay open: opening another closes the least
+recently used pool that is not serving a request, and a reaper thread
+closes pools left unused for TENANT_IDLE_TIMEOUT seconds. The next
+request to a closed library simply opens it again.
+
+TenantMiddleware binds the library's pool for the whole request, including
+a streamed body, so get_connection() and the per-library state built on it
+(the response cache, write-behind buffers, the change feed, PDF files and
+jobs) follow the request without a tenant being passed around. Background
+threads bind a library with use_tenant().
+"""
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from config import (TENANT_FOLDER, TENANT_HEADER, TENANT_DOMAIN, TENANT_CREATE, TENANT_MAX_OPEN,
+                    TENANT_IDLE_TIMEOUT, TENANT_POOL_SIZE)
+from pool import ConnectionPool, current_tenant, pool as default_pool, use_pool
+
+logger = logging.getLogger(__name__)
+
+_NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+
+
+class UnknownLibrary(LookupError):
+    pass
+
+
+def tenant_name(header=None, host=None):
+    """
+    The library a request names by header or host, None for the default
+    library. Raises ValueError for a name that is not a valid library name.
+    """
+    name = (header or '').strip().lower()
+    if not name and TENANT_DOMAIN and host:
+        host = host.split(':', 1)[0].lower()
+        suffix = '.' + TENANT_DOMAIN.lower().strip('.')
+        if host.endswith(suffix):
+            name = host[:-len(suffix)]
+    if not name:
+        return None
+    if not _NAME.match(name):
+        raise ValueError(f"invalid library name: {name!r}")
+    return name
+
+
+def storage_path(path):
+    """
+    `path`, a folder from config.py such as THUMBNAIL_FOLDER, inside the
+    current library's folder.
+    """
+    tenant = current_tenant()
+    return path if tenant is None else os.path.join(TENANT_FOLDER, tenant, path)
+
+
+class TenantRouter:
+    """
+    LRU of open per-library connection pools.
+    """
+
+    def __init__(self, folder=TENANT_FOLDER, max_open=TENANT_MAX_OPEN, idle_timeout=TENANT_IDLE_TIMEOUT,
+                 pool_size=TENANT_POOL_SIZE, create=TENANT_CREATE):
+        self.folder = folder
+        self.create_missing = create
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.pool_size = pool_size
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+        # name -> lock held while that library is being opened
+        self._opening = {}
+        # Libraries whose schema this process has brought up to date
+        self._ready = set()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.opened = 0
+        self.evicted = 0
+        self.idle_closed = 0
+
+    def database(self, name):
+        return os.path.join(self.folder, name, 'library.db')
+
+    def pool(self, name, create=False):
+        """
+        The pool of library `name`, or the default pool for None. Opens the
+        library, migrating its database if needed. Raises UnknownLibrary if
+        it has no database, unless `create` or TENANT_CREATE is set.
+        """
+        if name is None:
+            return default_pool
+        if not _NAME.match(name):
+            raise ValueError(f"invalid library name: {name!r}")
+        with self._lock:
+            conn_pool = self._pools.get(name)
+            if conn_pool is not None:
+                self._pools.move_to_end(name)
+                return conn_pool
+            opening = self._opening.setdefault(name, threading.Lock())
+        with opening:
+            with self._lock:
+                conn_pool = self._pools.get(name)
+                if conn_pool is not None:
+                    self._pools.move_to_end(name)
+                    return conn_pool
+            if not (create or self.create_missing or os.path.exists(self.database(name))):
+                with self._lock:
+                    self._opening.pop(name, None)
+                raise UnknownLibrary(f"library {name!r} does not exist")
+            conn_pool = ConnectionPool(self.database(name), size=self.pool_size, tenant=name)
+            if name not in self._ready:
+                try:
+                    self._bootstrap(conn_pool)
+                except Exception:
+                    conn_pool.retire()
+                    raise
+            with self._lock:
+                self._pools[name] = conn_pool
+                self._opening.pop(name, None)
+                self.opened += 1
+                self._evict()
+        self._start()
+        return conn_pool
+
+    def create(self, name):
+        """
+        Provision library `name`: create and migrate its database if it
+        does not exist yet. Returns its pool.
+        """
+        if name is None:
+            raise ValueError("the default library always exists")
+        return self.pool(name, create=True)
+
+    def _bootstrap(self, conn_pool):
+        from migrations import bootstrap
+        os.makedirs(os.path.dirname(conn_pool.database), exist_ok=True)
+        with use_pool(conn_pool):
+            try:
+                applied = bootstrap(seed=False)
+            finally:
+                conn_pool.release_thread()
+        if applied:
+            logger.info("library %s: applied %d migrations", conn_pool.tenant, len(applied))
+        self._ready.add(conn_pool.tenant)
+
+    def _evict(self):
+        # Called with the lock held; busy pools are skipped, so the LRU can
+        # run over max_open until their requests finish
+        while len(self._pools) > self.max_open:
+            victim = next((name for name, conn_pool in self._pools.items()
+                           if conn_pool.idle_seconds() is not None), None)
+            if victim is None:
+                return
+            self._pools.pop(victim).retire()
+            self.evicted += 1
+
+    def close_idle(self):
+        """
+        Close the pools of libraries unused for idle_timeout seconds.
+        Returns how many were closed.
+        """
+        with self._lock:
+            idle = [name for name, conn_pool in self._pools.items()
+                    if (conn_pool.idle_seconds() or 0) >= self.idle_timeout]
+            for name in idle:
+                self._pools.pop(name).retire()
+            self.idle_closed += len(idle)
+        return len(idle)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name='tenant-reaper', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while not self._stopping.wait(max(self.idle_timeout / 4, 1)):
+            try:
+                self.close_idle()
+            except Exception:
+                logger.exception("closing idle libraries failed")
+
+    def stop(self):
+        """
+        Stop the reaper and close every open library.
+        """
+        self._stopping.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), OrderedDict()
+        for conn_pool in pools:
+            conn_pool.retire()
+
+    def active(self):
+        """
+        The default library (None) and every library open right now.
+        """
+        with self._lock:
+            return [None] + list(self._pools)
+
+    def metrics(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            counters = {"opened": self.opened, "evicted": self.evicted, "idle_closed": self.idle_closed}
+        return {
+            "open": len(pools),
+            "max_open": self.max_open,
+            "connections": sum(conn_pool.metrics()['open'] for conn_pool in pools),
+            **counters
+        }
+
+
+tenant_router = TenantRouter()
+
+
+@contextmanager
+def use_tenant(name, create=False):
+    """
+    Work on library `name` (None for the default library) within the block;
+    see TenantRouter.pool() for `create`.
+    """
+    with use_pool(tenant_router.pool(name, create)) as conn_pool:
+        yield conn_pool
+
+
+class _BoundBody:
+    """
+    A response body that is iterated and closed with its library's pool bound.
+    """
+
+    def __init__(self, body, conn_pool):
+        self._body = body
+        self._pool = conn_pool
+        self._iter = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with use_pool(self._pool):
+            if self._iter is None:
+                self._iter = iter(self._body)
+            return next(self._iter)
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            with use_pool(self._pool):
+                self._body.close()
+
+
+def _error(start_response, status, message):
+    body = json.dumps({"message": message}, ensure_ascii=False).encode('utf-8')
+    start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class TenantMiddleware:
+    """
+    WSGI middleware that runs each request against the library it names.
+    """
+
+    def __init__(self, wsgi_app, router=tenant_router):
+        self.wsgi_app = wsgi_app
+        self.router = router
+        self.environ_header = 'HTTP_' + TENANT_HEADER.upper().replace('-', '_')
+
+    def __call__(self, environ, start_response):
+        try:
+            name = tenant_name(environ.get(self.environ_header), environ.get('HTTP_HOST'))
+        except ValueError:
+            return _error(start_response, '400 BAD REQUEST', "無效的圖書館名稱！")
+        if name is None:
+            return self.wsgi_app(environ, start_response)
+        try:
+            conn_pool = self.router.pool(name)
+        except UnknownLibrary:
+            return _error(start_response, '404 NOT FOUND', "圖書館不存在！")
+        with use_pool(conn_pool):
+            body = self.wsgi_app(environ, start_response)
+        # Files sent with the server's file wrapper read no database
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            return body
+        return _BoundBody(body, conn_pool)
@@ -0,0 +1,218 @@
+"""
+Duplicate-title handling for Book.
+
+add_book keeps the original naming rule: a new book whose title is already
+taken is stored as `title(n)` with the smallest free n >= 1. Instead of
+probing `title(1)`, `title(2)`, ... one query at a time, every title is split
+into (base_title, title_suffix), so `X(3)` is (X, 3) and `X` is (X, 0).
+Both are generated columns covered by idx_book_base_title, which means the
+highest suffix in use is a single index lookup. TitleGap holds, as ranges,
+every free suffix below it: holes left by deleted or renamed books and the
+ones skipped by a title such as `X(5)` entered by hand, so the smallest free
+suffix is the first gap or, without one, the highest suffix plus one.
+TitleAllocator applies this for add_book and for bulk imports alike.
+"""
+import re
+
+_SUFFIX = re.compile(r'^(.*)\(([1-9][0-9]*)\)$', re.DOTALL)
+
+# SQLite allows at most 32766 host parameters per statement
+_PARAM_BATCH = 500
+
+# SQL equivalent of split_title(), used by the generated columns. `p` is the
+# title without its closing ')' and trailing digits, i.e. ending in '(' when
+# the title has a numeric suffix.
+_P = "rtrim(substr(book_title, 1, length(book_title) - 1), '0123456789')"
+_DIGITS = f"substr(book_title, length({_P}) + 1, length(book_title) - length({_P}) - 1)"
+_HAS_SUFFIX = (f"(substr(book_title, -1) = ')' AND substr({_P}, -1) = '(' "
+               f"AND length({_DIGITS}) > 0 AND substr({_DIGITS}, 1, 1) <> '0')")
+BASE_TITLE_SQL = f"CASE WHEN {_HAS_SUFFIX} THEN substr({_P}, 1, length({_P}) - 1) ELSE book_title END"
+TITLE_SUFFIX_SQL = f"CASE WHEN {_HAS_SUFFIX} THEN CAST({_DIGITS} AS INTEGER) ELSE 0 END"
+
+GENERATED_COLUMNS = {
+    'base_title': f"TEXT GENERATED ALWAYS AS ({BASE_TITLE_SQL}) VIRTUAL",
+    'title_suffix': f"INTEGER GENERATED ALWAYS AS ({TITLE_SUFFIX_SQL}) VIRTUAL"
+}
+
+TITLE_DDL = [
+    'CREATE INDEX IF NOT EXISTS idx_book_base_title ON Book (base_title, title_suffix)',
+    # Free suffixes below the highest one in use, as ranges
+    '''
+    CREATE TABLE IF NOT EXISTS TitleGap (
+        base_title TEXT NOT NULL,
+        first_suffix INTEGER NOT NULL,
+        last_suffix INTEGER NOT NULL,
+        PRIMARY KEY (base_title, first_suffix)
+    ) WITHOUT ROWID
+    '''
+]
+
+
+def _occupy(row):
+    base, suffix = f"{row}.base_title", f"{row}.title_suffix"
+    containing = (f"first_suffix = (SELECT max(first_suffix) FROM TitleGap "
+                  f"WHERE base_title = {base} AND first_suffix <= {suffix})")
+    return f'''
+        INSERT INTO TitleGap (base_title, first_suffix, last_suffix)
+        SELECT {base}, top + 1, {suffix} - 1 FROM (SELECT max(
+            coalesce((SELECT title_suffix FROM Book WHERE base_title = {base} AND id <> {row}.id
+                      ORDER BY title_suffix DESC LIMIT 1), 0),
+            coalesce((SELECT last_suffix FROM TitleGap WHERE base_title = {base}
+                      ORDER BY first_suffix DESC LIMIT 1), 0)) AS top)
+        WHERE {suffix} > top + 1;
+        INSERT INTO TitleGap (base_title, first_suffix, last_suffix)
+        SELECT base_title, {suffix} + 1, last_suffix FROM TitleGap
+        WHERE base_title = {base} AND {containing} AND last_suffix > {suffix};
+        UPDATE TitleGap SET last_suffix = {suffix} - 1
+        WHERE base_title = {base} AND {containing} AND first_suffix < {suffix} AND last_suffix >= {suffix};
+        DELETE FROM TitleGap WHERE base_title = {base} AND first_suffix = {suffix};
+    '''
+
+
+def _free(row):
+    base, suffix = f"{row}.base_title", f"{row}.title_suffix"
+    return f'''
+        INSERT OR IGNORE INTO TitleGap (base_title, first_suffix, last_suffix)
+        SELECT {base}, {suffix}, {suffix}
+        WHERE {suffix} > 0 AND NOT EXISTS (SELECT 1 FROM Book WHERE base_title = {base} AND title_suffix = {suffix});
+    '''
+
+
+# A suffix taken past the highest one leaves those in between free, taking
+# one inside a gap splits it, and releasing the last book with a suffix
+# frees it
+TITLE_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS title_gap_ai AFTER INSERT ON Book WHEN new.title_suffix > 0 BEGIN {_occupy('new')} END",
+    f"CREATE TRIGGER IF NOT EXISTS title_gap_ad AFTER DELETE ON Book WHEN old.title_suffix > 0 BEGIN {_free('old')} END",
+    f'''
+    CREATE TRIGGER IF NOT EXISTS title_gap_au AFTER UPDATE OF book_title ON Book
+    WHEN old.title_suffix > 0 OR new.title_suffix > 0 BEGIN {_free('old')} {_occupy('new')} END
+    '''
+]
+
+
+def create_title_index(cursor):
+    """
+    Add the generated columns to an existing Book table if needed, then the
+    index, gap table and triggers.
+    """
+    cursor.execute("PRAGMA table_xinfo(Book)")
+    columns = {row[1] for row in cursor.fetchall()}
+    for name, definition in GENERATED_COLUMNS.items():
+        if name not in columns:
+            cursor.execute(f"ALTER TABLE Book ADD COLUMN {name} {definition}")
+    for statement in TITLE_DDL + TITLE_TRIGGERS:
+        cursor.execute(statement)
+
+
+def rebuild_title_gaps(cursor):
+    """
+    Recreate TitleGap and its triggers and fill it with every free suffix
+    below the highest one in use for each base title.
+    """
+    for trigger in ('title_gap_ai', 'title_gap_ad', 'title_gap_au', 'title_gap_au_new'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS TitleGap")
+    create_title_index(cursor)
+    cursor.execute('''
+        INSERT INTO TitleGap (base_title, first_suffix, last_suffix)
+        SELECT base_title, previous + 1, title_suffix - 1 FROM (
+            SELECT base_title, title_suffix,
+                   lag(title_suffix, 1, 0) OVER (PARTITION BY base_title ORDER BY title_suffix) AS previous
+            FROM Book WHERE title_suffix > 0
+        )
+        WHERE title_suffix > previous + 1
+    ''')
+
+
+def split_title(title):
+    """
+    Split `X(3)` into ('X', 3); titles without a numeric suffix give (title, 0).
+    """
+    match = _SUFFIX.match(title)
+    if match:
+        return match.group(1), int(match.group(2))
+    return title, 0
+
+
+class TitleAllocator:
+    """
+    Picks `title(n)` names the way TitleGap's triggers record them, for one
+    title or many rows at once.
+
+    load() reads, in batched queries, whether each title exists, its highest
+    suffix and its gaps; assign() then names books from memory and keeps
+    that state current as if each returned title had been inserted.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.exists = {}
+        # Highest suffix in use or inside a gap, and the gaps in order
+        self.top = {}
+        self.gaps = {}
+
+    def load(self, titles):
+        missing = list({t for t in titles if t not in self.exists})
+        for i in range(0, len(missing), _PARAM_BATCH):
+            batch = missing[i:i + _PARAM_BATCH]
+            marks = ', '.join('?' for _ in batch)
+            for title in batch:
+                self.exists[title] = False
+                self.top[title] = 0
+                self.gaps[title] = []
+            self.cursor.execute(f"SELECT book_title FROM Book WHERE book_title IN ({marks})", batch)
+            for (title,) in self.cursor.fetchall():
+                self.exists[title] = True
+            self.cursor.execute(
+                f"SELECT base_title, MAX(title_suffix) FROM Book WHERE base_title IN ({marks}) GROUP BY base_title",
+                batch)
+            for base, highest in self.cursor.fetchall():
+                self.top[base] = highest
+            self.cursor.execute(
+                f"SELECT base_title, first_suffix, last_suffix FROM TitleGap WHERE base_title IN ({marks}) "
+                f"ORDER BY base_title, first_suffix", batch)
+            for base, first, last in self.cursor.fetchall():
+                self.gaps[base].append([first, last])
+                self.top[base] = max(self.top[base], last)
+
+    def assign(self, title):
+        """
+        Return the title a new book called `title` should be stored under.
+        """
+        new_title = title
+        if self.exists.get(title):
+            gaps = self.gaps[title]
+            new_title = f"{title}({gaps[0][0] if gaps else self.top[title] + 1})"
+        # Record the new title against its own base and as an exact title,
+        # since later rows may use either
+        if new_title in self.exists:
+            self.exists[new_title] = True
+        base, suffix = split_title(new_title)
+        if suffix and base in self.top:
+            self._occupy(base, suffix)
+        return new_title
+
+    def _occupy(self, base, suffix):
+        gaps = self.gaps[base]
+        if suffix > self.top[base]:
+            if suffix > self.top[base] + 1:
+                gaps.append([self.top[base] + 1, suffix - 1])
+            self.top[base] = suffix
+            return
+        for i, (first, last) in enumerate(gaps):
+            if first <= suffix <= last:
+                gaps[i:i + 1] = [gap for gap in ([first, suffix - 1], [suffix + 1, last]) if gap[0] <= gap[1]]
+                return
+
+
+def next_book_title(cursor, title):
+    """
+    Return the title a new book called `title` should be stored under.
+
+    Call inside the transaction that inserts the book so that concurrent
+    writers cannot pick the same suffix.
+    """
+    allocator = TitleAllocator(cursor)
+    allocator.load([title])
+    return allocator.assign(title)
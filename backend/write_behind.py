@@ -0,0 +1,293 @@
+"""
+Write-behind buffering for page turns.
+
+Reader clients call /update_page and /add_history on every page turn, and
+committing each one costs an fsync. Instead the handlers validate the book
+id against an in-memory id set and hand the write to WriteBehind, which
+keeps only the latest page per book and a list of pending history rows. A
+flusher thread writes everything in one transaction every
+WRITE_BEHIND_INTERVAL seconds, or as soon as WRITE_BEHIND_MAX_EVENTS events
+are waiting, so sustained traffic costs a few commits per second.
+
+Pending writes are flushed by stop(), which runs at interpreter exit and on
+ASGI shutdown; only a hard kill can lose the last interval. Until a flush,
+reads return the previous page. Writes made inside a /batch transaction go
+straight to its connection instead (see PooledConnection.in_held_transaction).
+Events are kept per library (see tenants.py) and each library's events are
+written in their own transaction on its database.
+Set LIBRARY_WRITE_BEHIND=0 to commit every request as before.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from config import WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_EVENTS
+from pool import current_tenant, get_connection
+from cache import invalidate
+from tenants import use_tenant
+
+logger = logging.getLogger(__name__)
+
+
+def parse_book_id(value):
+    """
+    `value` as a book id. Raises ValueError with the message for the client
+    when it is missing or not an integer.
+    """
+    if value is None or str(value).strip() == '':
+        raise ValueError("書籍ID不得空白！")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("書籍ID必須是整數！")
+
+
+def parse_page(cursor, book_id, value):
+    """
+    `value` as a page of the book: an integer >= 0 and, once the book's PDF
+    has been processed, no more than its page count. Raises ValueError with
+    the message for the client otherwise, so a bad page is rejected before
+    it is buffered rather than failing every flush.
+    """
+    try:
+        page = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("頁數必須是非負整數！")
+    if page < 0:
+        raise ValueError("頁數必須是非負整數！")
+    cursor.execute("SELECT page_count FROM PdfInfo WHERE book_id = ?", (book_id,))
+    pdf_info = cursor.fetchone()
+    if pdf_info and pdf_info[0] is not None and page > pdf_info[0]:
+        raise ValueError(f"頁數超過書籍總頁數（{pdf_info[0]}）！")
+    return page
+
+
+class BookIds:
+    """
+    Set of Book ids known to exist. Ids missing from the set are looked up
+    once and remembered, so books added by other processes are found too;
+    ids seen inside a batch are not, as the batch may still roll back.
+    delete_book discards its id once the delete is committed. Rows whose
+    book was deleted elsewhere are dropped when they are flushed.
+    """
+
+    def __init__(self):
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, book_id):
+        key = (current_tenant(), book_id)
+        if key in self._ids:
+            return True
+        conn = get_connection()
+        try:
+            exists = conn.execute("SELECT 1 FROM Book WHERE id = ?", (book_id,)).fetchone() is not None
+            # A row seen inside a batch may still be rolled back
+            uncommitted = conn.in_held_transaction
+        finally:
+            conn.close()
+        if exists and not uncommitted:
+            with self._lock:
+                self._ids.add(key)
+        return exists
+
+    def discard(self, book_id):
+        with self._lock:
+            self._ids.discard((current_tenant(), book_id))
+
+    def clear(self):
+        """
+        Forget the current library's ids, e.g. after it was restored.
+        """
+        tenant = current_tenant()
+        with self._lock:
+            self._ids = {key for key in self._ids if key[0] != tenant}
+
+
+_INSERT_HISTORY = '''
+    INSERT INTO ReadingHistory (time_stamp, book_id, bookpage, note)
+    SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM Book WHERE id = ?)
+'''
+
+
+class WriteBehind:
+    """
+    Buffers current_page updates (last value per book) and ReadingHistory
+    inserts, and writes them in batches from a background thread.
+    """
+
+    def __init__(self, interval=WRITE_BEHIND_INTERVAL, max_events=WRITE_BEHIND_MAX_EVENTS):
+        self.interval = interval
+        self.max_events = max_events
+        self._pages = {}
+        self._history = []
+        self._events = 0
+        self._lock = threading.Lock()
+        # Serializes flushes so batches are written in the order they were taken
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.flushed_events = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._loop, name='write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the flusher and write everything still pending.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def update_page(self, book_id, page):
+        self.start()
+        key = (current_tenant(), book_id)
+        with self._lock:
+            if key in self._pages:
+                self.coalesced += 1
+            self._pages[key] = page
+            self._events += 1
+            full = self._events >= self.max_events
+        if full:
+            self._wakeup.set()
+
+    def add_history(self, time_stamp, book_id, bookpage, note):
+        self.start()
+        with self._lock:
+            self._history.append((current_tenant(), (time_stamp, book_id, bookpage, note, book_id)))
+            self._events += 1
+            full = self._events >= self.max_events
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pages) + len(self._history)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed, retrying")
+
+    def flush(self):
+        """
+        Write all buffered events, one transaction per library. Rows that
+        break a constraint are logged and dropped; when a library's write
+        fails otherwise (e.g. the database is locked) its events are put
+        back (behind any newer page for the same book) and the first error
+        is raised once the other libraries are written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pages, self._pages = self._pages, {}
+                history, self._history = self._history, []
+                events, self._events = self._events, 0
+            if not pages and not history:
+                return 0
+            start = time.perf_counter()
+            batches = {}
+            for (tenant, book_id), page in pages.items():
+                batches.setdefault(tenant, ({}, []))[0][book_id] = page
+            for tenant, row in history:
+                batches.setdefault(tenant, ({}, []))[1].append(row)
+            error = None
+            for tenant, (tenant_pages, tenant_history) in batches.items():
+                try:
+                    with use_tenant(tenant):
+                        dropped = self._write(tenant_pages, tenant_history)
+                    self.dropped += dropped
+                    events -= dropped
+                except Exception as e:
+                    failed = len(tenant_pages) + len(tenant_history)
+                    with self._lock:
+                        self._pages = {**{(tenant, book_id): page for book_id, page in tenant_pages.items()},
+                                       **self._pages}
+                        self._history = [(tenant, row) for row in tenant_history] + self._history
+                        self._events += failed
+                        self.failures += 1
+                    events -= failed
+                    error = error or e
+            if events:
+                self.flushes += 1
+                self.flushed_events += events
+                self.last_flush_seconds = time.perf_counter() - start
+            if error is not None:
+                raise error
+            return events
+
+    @staticmethod
+    def _write(pages, history):
+        """
+        Write one library's events. Returns how many rows were dropped.
+        """
+        conn = get_connection()
+        try:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("UPDATE Book SET current_page = ? WHERE id = ?",
+                                 [(page, book_id) for book_id, page in pages.items()])
+                # Skip rows whose book has been deleted since they were queued
+                conn.executemany(_INSERT_HISTORY, history)
+                dropped = 0
+            except sqlite3.IntegrityError:
+                # Find the offending rows one by one; a failed statement only
+                # undoes itself, so the rest of the transaction is kept
+                conn.rollback()
+                conn.execute("BEGIN IMMEDIATE")
+                dropped = 0
+                statements = [("UPDATE Book SET current_page = ? WHERE id = ?", (page, book_id))
+                              for book_id, page in pages.items()]
+                statements += [(_INSERT_HISTORY, row) for row in history]
+                for sql, params in statements:
+                    try:
+                        conn.execute(sql, params)
+                    except sqlite3.IntegrityError as e:
+                        logger.warning("write-behind: dropping %r: %s", params, e)
+                        dropped += 1
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        for book_id in pages:
+            invalidate('Book', book_id)
+        if history:
+            invalidate('ReadingHistory')
+        return dropped
+
+    def metrics(self):
+        return {
+            "pending": self.pending(),
+            "flushes": self.flushes,
+            "flushed_events": self.flushed_events,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "last_flush_seconds": self.last_flush_seconds
+        }
+
+
+book_ids = BookIds()
+write_behind = WriteBehind()